@@ -0,0 +1,119 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Capture information file (sidecar of the perf data file)
+#
+# perfcap saves <perf data>.info next to the perf data file with all the live state
+# of the capture host that the conversion needs, so that the perf data file can be
+# converted later on any host (perfcap --offline):
+#
+# {"threads": {tid: [libvirt_name, uuid, thread_type], ...},  qemu threads snapshot
+#  "instance_names": {uuid: name, ...},                      names converted by the plugin
+#  "topology": {"cpus": {cpu: [socket, core], ...},          CPU topology
+#               "nodes": {node: cpu list, ...}},
+#  "host": {"hostname": ..., "kernel": ...},
+#  "perf": {"header": ..., "buildids": ...}}                  perf report --header-only
+#                                                             and perf buildid-list output
+#
+# This module only depends on the python standard library so that it can be
+# imported from the perf embedded python interpreter.
+#
+import glob
+import json
+import os
+import re
+import subprocess
+
+from task_names import TaskNameResolver
+from task_names import read_file
+
+# environment variable for the capture information file used by the perf script handlers
+INFO_ENV = 'PERFWHIZ_INFO'
+# capture information file name suffix (added to the perf data file name)
+INFO_SUFFIX = '.info'
+
+cpu_dir_re = re.compile(r'.*/cpu(\d+)$')
+node_dir_re = re.compile(r'.*/node(\d+)$')
+
+def get_cpu_topology(sys_dir='/sys/devices/system'):
+    cpus = {}
+    for cpu_dir in glob.glob(sys_dir + '/cpu/cpu*'):
+        m = cpu_dir_re.match(cpu_dir)
+        socket = read_file(cpu_dir + '/topology/physical_package_id')
+        core = read_file(cpu_dir + '/topology/core_id')
+        if m and socket and core:
+            cpus[int(m.group(1))] = [int(socket), int(core)]
+    nodes = {}
+    for node_dir in glob.glob(sys_dir + '/node/node*'):
+        m = node_dir_re.match(node_dir)
+        cpulist = read_file(node_dir + '/cpulist')
+        if m and cpulist:
+            nodes[int(m.group(1))] = cpulist.strip()
+    return {'cpus': cpus, 'nodes': nodes}
+
+def get_instance_names(resolver):
+    # returns the names converted by the plugin of all the instances in the snapshot
+    # (instances unknown to the plugin keep their task name and are not listed)
+    names = {}
+    if not resolver.get_instance_name:
+        return names
+    for libvirt_name, uuid, thread_type in (resolver.threads or {}).itervalues():
+        if uuid not in names:
+            names[uuid] = resolver.get_instance_name(uuid)
+    return dict((uuid, name) for uuid, name in names.iteritems() if name)
+
+def get_perf_output(cmd):
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    output = process.communicate()[0]
+    return output if not process.returncode else None
+
+def save_capture_info(filename, resolver, perf_binary, perf_data_filename):
+    '''Save the capture information of a perf data file.
+
+    resolver: TaskNameResolver with the qemu threads snapshot and the plugin
+    '''
+    info = {'threads': resolver.threads or {},
+            'instance_names': get_instance_names(resolver),
+            'topology': get_cpu_topology(),
+            'host': {'hostname': os.uname()[1], 'kernel': os.uname()[2]},
+            'perf': {'header': get_perf_output([perf_binary, 'report', '--header-only',
+                                                '-i', perf_data_filename]),
+                     'buildids': get_perf_output([perf_binary, 'buildid-list', '-i', perf_data_filename])}}
+    with open(filename, 'w') as ff:
+        json.dump(info, ff)
+
+def load_capture_info(filename):
+    with open(filename, 'r') as ff:
+        info = json.load(ff)
+    # json keys are strings
+    info['threads'] = dict((int(tid), thread) for tid, thread in info['threads'].iteritems())
+    topology = info['topology']
+    for name in ['cpus', 'nodes']:
+        topology[name] = dict((int(key), value) for key, value in topology[name].iteritems())
+    return info
+
+def get_info_resolver(info):
+    '''Returns a TaskNameResolver that only uses the capture information (no /proc, no plugin).
+    '''
+    instance_names = info['instance_names']
+
+    def convert_name(name, tid, libvirt_name, uuid, thread_type):
+        return instance_names.get(uuid, name)
+    return TaskNameResolver(info['threads'], convert_name)
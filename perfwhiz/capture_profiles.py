@@ -0,0 +1,170 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Capture profiles (perfcap --profile)
+#
+# Each profile is the list of tracepoints enabled by perf record.
+# Recording sched:* and kvm:* enables more than 50 tracepoints and most of them are
+# only counted and dropped by the perf script handlers, which inflates the perf data file,
+# raises the risk of lost events and adds tracing overhead on the measured host.
+# - sched-min: context switches, runtime and sleep/iowait delays
+# - kvm-exits: kvm entry/exit
+# - min: sched-min and kvm-exits (everything stored in the cdict file)
+# - full: all the sched and kvm tracepoints (required by the stats of perf sched and perf kvm)
+# All the profiles have the task events used to name the qemu threads (see task_names.py).
+#
+# The per cpu ring buffers of perf record (-m) can also be sized from a short calibration
+# capture with the same profile (perfcap --mmap auto): the buffers must hold the events of
+# the busiest cpu during BUFFER_SECONDS, else events are lost when perf record is not
+# scheduled in time to drain them.
+#
+# The perf.data reader (numpy) is only imported by the calibration and the capture report
+# so that the profiles can be used on a capture host without numpy.
+#
+import os
+import subprocess
+
+TASK_EVENTS = ['sched:sched_process_fork', 'sched:sched_process_exec']
+SCHED_EVENTS = ['sched:sched_switch', 'sched:sched_stat_runtime', 'sched:sched_stat_sleep',
+                'sched:sched_stat_iowait']
+KVM_EVENTS = ['kvm:kvm_entry', 'kvm:kvm_exit']
+
+PROFILES = {
+    'sched-min': SCHED_EVENTS + TASK_EVENTS,
+    'kvm-exits': KVM_EVENTS + TASK_EVENTS,
+    'min': SCHED_EVENTS + KVM_EVENTS + TASK_EVENTS,
+    'full': ['sched:*', 'kvm:*']
+}
+DEFAULT_PROFILE = 'full'
+
+# where the available tracepoints are listed (debugfs)
+TRACING_EVENTS_DIR = '/sys/kernel/debug/tracing/events'
+
+# how long the ring buffers must hold the events of the busiest cpu
+BUFFER_SECONDS = 0.5
+CALIBRATION_SECONDS = 1
+# perf record -m takes a power of 2 number of pages
+PAGE_SIZE = 4096
+MIN_MMAP_PAGES = 128
+MAX_MMAP_PAGES = 16384
+
+def get_event_args(profile, events_dir=TRACING_EVENTS_DIR):
+    '''Returns the perf record arguments to enable the tracepoints of a profile.
+
+    Tracepoints that are not available on this kernel (for example the sched_stat ones
+    without CONFIG_SCHEDSTATS) are skipped as perf record fails on unknown tracepoints.
+    '''
+    args = []
+    check = os.path.isdir(events_dir)
+    for event in PROFILES[profile]:
+        if check and not event.endswith('*') and \
+           not os.path.isdir(os.path.join(events_dir, *event.split(':'))):
+            print 'Tracepoint %s not available, skipped' % (event)
+            continue
+        args += ['-e', event]
+    return args
+
+def report_capture(profile, perf_data_filename):
+    # print the event rate and file size of a capture
+    size = os.path.getsize(perf_data_filename)
+    try:
+        from perf_data import PerfDataFile
+        pdf = PerfDataFile(perf_data_filename)
+        records, _, lost_records = pdf.scan()
+        count = len(records)
+        first, last = pdf.get_time_range()
+        lost = pdf.get_lost_events(lost_records, records)
+    except (ImportError, ValueError) as exc:
+        print 'Profile %s: %s size %.1f MB (%s)' % (profile, perf_data_filename, size / 1e6, exc)
+        return
+    duration = (last - first) / 1e9 if count > 1 else 0
+    rate = count / duration if duration else 0
+    print 'Profile %s: %d events in %.1f sec (%d events/sec), %s size %.1f MB (%.2f MB/sec)' % \
+          (profile, count, duration, rate, perf_data_filename, size / 1e6,
+           size / 1e6 / duration if duration else 0)
+    if lost:
+        print 'WARNING: %d events lost on %d cpus, try a larger --mmap or --mmap auto' % \
+              (sum(event[3] for event in lost), len(set(event[0] for event in lost)))
+
+def get_peak_rate(perf_data_filename):
+    '''Returns the highest sample rate of a cpu in bytes/sec and the number of lost events.
+    '''
+    import numpy as np
+    from perf_data import EVENT_HEADER
+    from perf_data import PerfDataFile
+    from perf_data import read_ints
+    pdf = PerfDataFile(perf_data_filename)
+    records, _, lost_records = pdf.scan()
+    if len(records) < 2:
+        return 0, 0
+    buf = np.frombuffer(pdf.data, dtype=np.uint8)
+    layout = pdf.get_sample_layout()
+    # the record size is the last field of the record header
+    sizes = read_ints(buf, records + EVENT_HEADER.size - 2, 2)
+    cpus = read_ints(buf, records + layout['cpu'], 4)
+    first, last = pdf.get_time_range()
+    duration = max((last - first) / 1e9, 1e-3)
+    lost = sum(event[3] for event in pdf.get_lost_events(lost_records, records))
+    return np.bincount(cpus, weights=sizes).max() / duration, lost
+
+def get_mmap_pages(rate):
+    # number of ring buffer pages to hold BUFFER_SECONDS at rate bytes/sec
+    pages = max(int(rate * BUFFER_SECONDS / PAGE_SIZE), 1)
+    pages = 1 << (pages - 1).bit_length()
+    return min(max(pages, MIN_MMAP_PAGES), MAX_MMAP_PAGES)
+
+def calibrate_mmap(perf_binary, profile, output_dir='.'):
+    '''Record the profile for CALIBRATION_SECONDS and size the ring buffers for the busiest cpu.
+
+    Returns the perf record -m value (number of pages) or None if the calibration failed
+    '''
+    filename = os.path.join(output_dir, 'perf.calibration.data')
+    perf_cmd = [perf_binary, 'record', '-a', '-q'] + get_event_args(profile) + \
+               ['-o', filename, 'sleep', str(CALIBRATION_SECONDS)]
+    print 'Calibrating the perf buffer size with: ' + ' '.join(perf_cmd)
+    try:
+        rc = subprocess.call(perf_cmd)
+    except OSError:
+        rc = -1
+    if rc:
+        print 'Calibration capture failed, using the default perf buffer size'
+        return None
+    try:
+        rate, lost = get_peak_rate(filename)
+    except (ImportError, ValueError) as exc:
+        print 'Calibration failed (%s), using the default perf buffer size' % (exc)
+        return None
+    finally:
+        os.remove(filename)
+    pages = get_mmap_pages(rate)
+    print 'Busiest cpu %.2f MB/sec, perf buffer size set to %d pages per cpu (%.1f MB)' % \
+          (rate / 1e6, pages, pages * PAGE_SIZE / 1e6)
+    if lost:
+        print 'WARNING: %d events lost during the calibration, the buffer size may still be too small' % (lost)
+    return str(pages)
+
+def get_record_args(perf_binary, opts):
+    '''Returns the perf record arguments for the profile and buffer size options.
+
+    opts.mmap: None for the perf default, 'auto' to calibrate (once) or a perf record -m value
+    '''
+    args = get_event_args(opts.profile)
+    if opts.mmap == 'auto':
+        opts.mmap = calibrate_mmap(perf_binary, opts.profile, opts.tmpfs or '.')
+    if opts.mmap:
+        args += ['-m', opts.mmap]
+    return args
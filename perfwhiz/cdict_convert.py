@@ -0,0 +1,95 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Migration of old style cdict files (marshal based) to the current cdict format
+#
+# The old format has one sched__sched_stat_runtime event per runtime sample.
+# The current format fixes the runtime reporting bug by aggregating all runtime
+# durations into the next switch event on the same cpu and removing the runtime events.
+#
+import os
+
+import numpy as np
+import pandas
+from pandas import DataFrame
+
+from cdict_format import write_cdict
+from cdict_reader import load_cdict
+from cdict_reader import load_task_names
+
+def aggregate_runtime(df):
+    '''Aggregate the runtime events of each cpu into the next switch event of that cpu.
+
+    Same result as the sequential per cpu runtime counter of the perf script handler:
+    - the counter of a cpu is started by the first switch event on that cpu
+      (runtime events before that are ignored and the first switch duration is unchanged)
+    - each switch event gets the sum of the runtime events since the previous switch
+      on the same cpu, except swapper (pid 0) whose duration is unchanged
+    Returns a new data frame without the runtime events.
+    '''
+    is_runtime = (df['event'] == 'sched__sched_stat_runtime').values
+    if not is_runtime.any():
+        # already converted (the runtime is aggregated at capture time)
+        return df
+    is_switch = (df['event'] == 'sched__sched_switch').values
+    selected = is_runtime | is_switch
+    cpus = df['cpu'].values[selected]
+    switches = is_switch[selected]
+    # number of switch events seen so far on the same cpu (including the current row)
+    # runtime rows in segment N are aggregated into the switch of segment N + 1
+    segments = pandas.Series(switches.astype(np.int64)).groupby(cpus).cumsum().values
+    runtimes = df['duration'].values[selected]
+    in_segment = ~switches & (segments > 0)
+    sums = pandas.Series(runtimes[in_segment]).groupby([cpus[in_segment], segments[in_segment]]).sum()
+
+    # switch rows that have a running counter (not the first switch on their cpu)
+    sw_cpus = cpus[switches]
+    sw_segments = segments[switches] - 1
+    sw_rows = np.flatnonzero(selected)[switches]
+    update = (sw_segments > 0) & (df['pid'].values[sw_rows] != 0)
+    keys = pandas.MultiIndex.from_arrays([sw_cpus[update], sw_segments[update]])
+    durations = df['duration'].values.copy()
+    durations[sw_rows[update]] = sums.reindex(keys).fillna(0).values
+
+    df = df.assign(duration=durations)
+    # get rid of all the runtime events
+    return df[~is_runtime]
+
+def convert_df(df, new_cdict, task_names=None):
+    # convert an old style cdict data frame and save it to new_cdict
+    df = aggregate_runtime(df)
+    # missing numeric values (e.g. next_pid of kvm events) are stored as 0
+    df = df.fillna(dict((name, 0) for name in ['cpu', 'nsecs', 'pid', 'duration', 'next_pid']))
+    res = dict((name, df[name].values) for name in df.columns)
+    size = write_cdict(new_cdict, res, task_names=task_names)
+    print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
+          (new_cdict, len(df), size)
+
+def convert_cdict(cdict_file, new_cdict, from_nsecs=0, to_nsecs=0):
+    print 'Converting %s...' % (cdict_file)
+    convert_df(DataFrame(load_cdict(cdict_file, None, from_nsecs, to_nsecs)), new_cdict,
+               load_task_names(cdict_file))
+
+def convert_dir(cdict_dir, new_dir, from_nsecs=0, to_nsecs=0):
+    # convert all the cdict files in cdict_dir into new_dir (with same file names)
+    if not os.path.isdir(new_dir):
+        os.makedirs(new_dir)
+    cdict_files = sorted(name for name in os.listdir(cdict_dir) if name.endswith('.cdict'))
+    for name in cdict_files:
+        convert_cdict(os.path.join(cdict_dir, name), os.path.join(new_dir, name),
+                      from_nsecs, to_nsecs)
+    print 'Converted %d cdict files to %s' % (len(cdict_files), new_dir)
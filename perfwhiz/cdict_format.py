@@ -0,0 +1,486 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Writer for the chunked columnar cdict file format (version 2)
+#
+# This module only depends on the python standard library and msgpack so that
+# it can be imported from the perf embedded python interpreter on the capture host.
+# numpy is only used when available to encode the columns of a chunk in a few passes.
+#
+# File layout:
+#
+#   +----------------------------------------------------------+
+#   | MAGIC (8 bytes)                                          |
+#   | header length (uint32 LE) + msgpack header               |
+#   |   {'version': 2, 'chunk_rows': N,                        |
+#   |    'columns': [[name, encoding], ...]}                   |
+#   +----------------------------------------------------------+
+#   | chunk 0: one zlib compressed blob per column             |
+#   | chunk 1: ...                                             |
+#   +----------------------------------------------------------+
+#   | msgpack trailer                                          |
+#   |   {'rows': total, 'chunks': [{'offset': o, 'rows': n,    |
+#   |                               'sizes': [...],            |
+#   |                               'min_nsecs': t0,           |
+#   |                               'max_nsecs': t1}, ...],    |
+#   |    'strings': [value0, value1, ...],                     |
+#   |    'task_names': [[tid, name], ...],                     |
+#   |    'epoch': absolute nsecs of nsecs 0,                   |
+#   |    'lost': [[cpu, from_nsecs, to_nsecs, count], ...]}    |
+#   +----------------------------------------------------------+
+#   | trailer offset (uint64 LE) + MAGIC (16 bytes)            |
+#   +----------------------------------------------------------+
+#
+# Numeric columns are stored as fixed width little endian integer arrays.
+# Dictionary encoded columns (event and task names) are stored as int32 codes
+# into the string table saved in the trailer (-1 for a missing value), the
+# string table is shared by all dictionary encoded columns.
+# The columns written by this version are byte shuffled: the bytes of the values
+# are grouped by position (all the first bytes, then all the second bytes...) so that
+# the mostly zero high bytes of small values make long runs that zlib compresses well.
+# These columns are compressed with the zlib run length strategy (Z_RLE) that only
+# looks for repeated bytes: it is several times faster than the default strategy and
+# compresses the shuffled bytes as well or better (any zlib reader can decompress them).
+# Shuffled dictionary codes are stored plus 1 (0 for a missing value) for the same reason.
+# The time column (nanoseconds) is also delta encoded: the first value of each chunk
+# followed by the difference between consecutive values, which are small numbers
+# that compress much better than the absolute times.
+# Other columns are stored as a msgpack list of values.
+# Each column of each chunk is compressed independently so that a reader
+# can decode any subset of columns and chunks.
+# The min/max times of each chunk make a sparse time index that allows a reader
+# to only decode the chunks that overlap a given time window.
+# The task names table has the final name of the qemu threads that were resolved
+# during the conversion (see task_names.py).
+# The lost list has one entry per perf lost event record: count events were lost
+# on cpu (-1 if unknown) between from_nsecs and to_nsecs, all the rows in that
+# range may be missing and the durations that span it are not reliable.
+# Files written before the switch to nanoseconds have a 'usecs' time column instead
+# and no shuffled column: all their times and durations are in microseconds and their
+# chunks have 'min_usecs' and 'max_usecs' keys.
+#
+from array import array
+import operator
+import struct
+import sys
+import zlib
+
+try:
+    # try to use the faster version if available
+    from msgpack import packb
+    from msgpack import unpackb
+except ImportError:
+    # else fall back to the pure python version (slower)
+    from umsgpack import packb
+    from umsgpack import unpackb
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = 'PWCDICT2'
+VERSION = 2
+
+# number of rows in each chunk
+DEFAULT_CHUNK_ROWS = 256 * 1024
+
+# column encodings
+ENC_INT32 = '<i4'
+ENC_INT64 = '<i8'
+ENC_OBJECT = 'obj'
+ENC_DICT = 'dict'
+# byte shuffled encodings
+ENC_SHUFFLE32 = 'shuffle<i4'
+ENC_SHUFFLE64 = 'shuffle<i8'
+ENC_SHUFFLE_DICT = 'shuffle-dict'
+# int64 first value followed by the deltas between consecutive values, byte shuffled
+ENC_DELTA64 = 'delta<i8'
+
+# fixed width integer array of each integer encoding
+INT_ENCODINGS = {ENC_INT32: ENC_INT32,
+                 ENC_INT64: ENC_INT64,
+                 ENC_DICT: ENC_INT32,
+                 ENC_SHUFFLE32: ENC_INT32,
+                 ENC_SHUFFLE64: ENC_INT64,
+                 ENC_SHUFFLE_DICT: ENC_INT32,
+                 ENC_DELTA64: ENC_INT64}
+ITEM_SIZES = {ENC_INT32: 4,
+              ENC_INT64: 8}
+SHUFFLED_ENCODINGS = set([ENC_SHUFFLE32, ENC_SHUFFLE64, ENC_SHUFFLE_DICT, ENC_DELTA64])
+DICT_ENCODINGS = set([ENC_DICT, ENC_SHUFFLE_DICT])
+
+# array typecode for each integer encoding
+# the python 2 array module has no 'q' typecode but 'l' is 8 bytes on 64-bit Linux
+INT64_TYPECODE = 'l' if array('l').itemsize == 8 else 'q'
+TYPECODES = dict((encoding, 'i' if int_encoding == ENC_INT32 else INT64_TYPECODE)
+                 for encoding, int_encoding in INT_ENCODINGS.items())
+
+# The list of cdict columns and their encoding, in file order
+COLUMNS = [('event', ENC_SHUFFLE_DICT),
+           ('cpu', ENC_SHUFFLE32),
+           ('nsecs', ENC_DELTA64),
+           ('pid', ENC_SHUFFLE32),
+           ('task_name', ENC_SHUFFLE_DICT),
+           ('duration', ENC_SHUFFLE64),
+           ('next_pid', ENC_SHUFFLE32),
+           ('next_comm', ENC_SHUFFLE_DICT)]
+
+# the column used to build the time index (nanoseconds)
+TIME_COLUMN = 'nsecs'
+# time column of the files written before the switch to nanoseconds (microseconds)
+LEGACY_TIME_COLUMN = 'usecs'
+# legacy files have times and durations in usecs
+LEGACY_SCALE = 1000
+
+# zlib.h strategy constant (not exported by the python 2 zlib module)
+Z_RLE = 3
+
+HEADER_LEN = struct.Struct('<I')
+FOOTER = struct.Struct('<Q8s')
+
+def is_cdict_v2(data):
+    # data is the beginning of the file (at least 8 bytes)
+    return data[:len(MAGIC)] == MAGIC
+
+def get_time_column(columns):
+    # name of the time column in a list of [name, encoding] columns
+    names = [col[0] for col in columns]
+    return TIME_COLUMN if TIME_COLUMN in names else LEGACY_TIME_COLUMN
+
+def as_ndarray(values):
+    # zero copy numpy view of an int array (the array must not be resized while the view is used)
+    if np is not None and isinstance(values, array):
+        return np.frombuffer(values, dtype=values.typecode) if len(values) else np.zeros(0, values.typecode)
+    return values
+
+def get_offsets(values, origin):
+    '''Returns the int64 values minus origin (e.g. absolute times relative to an epoch).
+    '''
+    values = as_ndarray(values)
+    if hasattr(values, 'astype'):
+        return values.astype(ENC_INT64) - origin
+    return array(INT64_TYPECODE, [value - origin for value in values])
+
+def get_deltas(values):
+    # first value followed by the difference between consecutive values
+    if hasattr(values, 'astype'):
+        # numpy array or pandas series (a copy is made)
+        values = getattr(values, 'values', values).astype(ENC_INT64)
+        values[1:] = values[1:] - values[:-1]
+        return values
+    values = array(INT64_TYPECODE, values)
+    deltas = array(INT64_TYPECODE, map(operator.sub, values[1:], values[:-1]))
+    deltas.insert(0, values[0])
+    return deltas
+
+def shift_codes(codes):
+    # dictionary codes plus 1 (a missing value is stored as 0)
+    if hasattr(codes, 'astype'):
+        return codes + 1
+    return array(TYPECODES[ENC_INT32], map((1).__add__, codes))
+
+def shuffle_bytes(data, size):
+    # group the bytes of the size bytes values by position
+    return ''.join(data[index::size] for index in range(size))
+
+def unshuffle_bytes(data, size):
+    # inverse of shuffle_bytes()
+    count = len(data) // size
+    res = bytearray(len(data))
+    for index in range(size):
+        res[index::size] = data[index * count:(index + 1) * count]
+    return str(res)
+
+def encode_ints(values, encoding):
+    '''Returns the (uncompressed) bytes of a sequence of ints in one of the integer encodings.
+    '''
+    values = as_ndarray(values)
+    if encoding == ENC_DELTA64:
+        values = get_deltas(values)
+    elif encoding == ENC_SHUFFLE_DICT:
+        values = shift_codes(values)
+    int_encoding = INT_ENCODINGS[encoding]
+    if hasattr(values, 'astype'):
+        # numpy array (when writing from the analyzer side)
+        data = values.astype(int_encoding).tostring()
+    else:
+        typecode = TYPECODES[int_encoding]
+        try:
+            if isinstance(values, array) and values.typecode == typecode:
+                # array(typecode, values) would convert every value
+                arr = array(typecode, values.tostring()) if sys.byteorder == 'big' else values
+            else:
+                arr = array(typecode, values)
+        except TypeError:
+            # missing values (None) are stored as 0
+            arr = array(typecode, [int(value) if value else 0 for value in values])
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        data = arr.tostring()
+    if encoding in SHUFFLED_ENCODINGS:
+        data = shuffle_bytes(data, ITEM_SIZES[int_encoding])
+    return data
+
+def compress_ints(values, encoding):
+    '''Returns the compressed blob of a sequence of ints in one of the integer encodings.
+    '''
+    data = encode_ints(values, encoding)
+    if encoding in SHUFFLED_ENCODINGS:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS, 8, Z_RLE)
+        return compressor.compress(data) + compressor.flush()
+    return zlib.compress(data)
+
+def unpack_ints(data, encoding):
+    '''Returns the int array of the (uncompressed) bytes of one of the integer encodings.
+    '''
+    int_encoding = INT_ENCODINGS[encoding]
+    if encoding in SHUFFLED_ENCODINGS:
+        data = unshuffle_bytes(data, ITEM_SIZES[int_encoding])
+    values = array(TYPECODES[encoding])
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if encoding == ENC_DELTA64:
+        if np is not None and len(values):
+            view = as_ndarray(values)
+            np.cumsum(view, out=view)
+        else:
+            total = 0
+            for index, value in enumerate(values):
+                total += value
+                values[index] = total
+    elif encoding == ENC_SHUFFLE_DICT:
+        values = array(values.typecode, map((-1).__add__, values))
+    return values
+
+def encode_column(values, encoding):
+    if encoding == ENC_OBJECT:
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        return zlib.compress(packb(list(values)))
+    return compress_ints(values, encoding)
+
+
+class CdictWriter(object):
+    '''Write a cdict file one chunk at a time.
+    '''
+    def __init__(self, filename, columns=COLUMNS, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.filename = filename
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.time_column = get_time_column(columns)
+        self.chunks = []
+        self.rows = 0
+        # the string table and the code of each string indexed by string
+        self.strings = []
+        self.string_codes = {None: -1}
+        # final qemu thread names indexed by tid
+        self.task_names = {}
+        # absolute time in nsecs of nsecs 0 (None if unknown)
+        self.epoch = None
+        # lost events as [cpu, from_nsecs, to_nsecs, count]
+        self.lost = []
+        self.ff = open(filename, 'wb')
+        header = packb({'version': VERSION,
+                        'chunk_rows': chunk_rows,
+                        'columns': [list(col) for col in columns]})
+        self.ff.write(MAGIC)
+        self.ff.write(HEADER_LEN.pack(len(header)))
+        self.ff.write(header)
+        self.offset = len(MAGIC) + HEADER_LEN.size + len(header)
+
+    def get_code(self, value):
+        # returns the code of a value in the string table, adding it if new
+        try:
+            return self.string_codes[value]
+        except KeyError:
+            pass
+        if value != value:
+            # NaN is a missing value
+            return -1
+        if hasattr(value, 'item'):
+            # numpy scalar
+            value = value.item()
+        code = len(self.strings)
+        self.strings.append(value)
+        self.string_codes[value] = code
+        return code
+
+    def encode_codes(self, values, encoding):
+        if hasattr(values, 'categories'):
+            # pandas categorical (analyzer side): only the categories need a lookup
+            import numpy as np
+            lookup = [self.get_code(value) for value in values.categories]
+            # categorical code -1 (missing value) picks the last lookup entry
+            lookup = np.array(lookup + [-1], dtype=np.int32)
+            return compress_ints(lookup[values.codes], encoding)
+        if not isinstance(values, array):
+            values = self.get_codes(values)
+        return compress_ints(values, encoding)
+
+    def get_codes(self, values):
+        '''Returns the string table codes of a sequence of values as an int32 array.
+
+        The returned array can be passed to write_chunk() in place of the values.
+        '''
+        string_codes = self.string_codes
+        # add the new values once rather than looking up every value twice
+        for value in set(values).difference(string_codes):
+            self.get_code(value)
+        try:
+            codes = [string_codes[value] for value in values]
+        except KeyError:
+            # NaN missing values are not in the string table
+            codes = [string_codes.get(value, -1) for value in values]
+        return array(TYPECODES[ENC_INT32], codes)
+
+    def write_chunk(self, col_dict):
+        '''Write one chunk of rows.
+
+        col_dict: a dict of value sequences indexed by column name,
+                  all sequences must have the same length
+                  dict encoded columns can also be int32 arrays of codes (see get_codes())
+        '''
+        rows = len(col_dict[self.columns[0][0]])
+        if not rows:
+            return
+        blobs = []
+        for name, encoding in self.columns:
+            if encoding in DICT_ENCODINGS:
+                blobs.append(self.encode_codes(col_dict[name], encoding))
+            else:
+                blobs.append(encode_column(col_dict[name], encoding))
+        times = as_ndarray(col_dict[self.time_column])
+        if hasattr(times, 'min'):
+            self.write_blobs(blobs, rows, int(times.min()), int(times.max()))
+        else:
+            self.write_blobs(blobs, rows, int(min(times)), int(max(times)))
+
+    def write_blobs(self, blobs, rows, min_time, max_time):
+        '''Write one chunk of already encoded and compressed column blobs (in column order).
+
+        min_time, max_time: time range of the chunk rows (in the unit of the time column)
+        '''
+        sizes = []
+        for blob in blobs:
+            self.ff.write(blob)
+            sizes.append(len(blob))
+        self.chunks.append({'offset': self.offset, 'rows': rows, 'sizes': sizes,
+                            'min_' + self.time_column: min_time, 'max_' + self.time_column: max_time})
+        self.offset += sum(sizes)
+        self.rows += rows
+
+    def write_columns(self, col_dict):
+        '''Write an arbitrary number of rows, split in as many chunks as needed.
+        '''
+        count = len(col_dict[self.columns[0][0]])
+        for start in xrange(0, count, self.chunk_rows):
+            end = start + self.chunk_rows
+            self.write_chunk(dict((name, col_dict[name][start:end]) for name, _ in self.columns))
+
+    def close(self):
+        trailer = packb({'rows': self.rows, 'chunks': self.chunks, 'strings': self.strings,
+                         # pairs as some msgpack versions only accept string map keys
+                         'task_names': sorted(self.task_names.items()),
+                         'epoch': self.epoch, 'lost': self.lost})
+        self.ff.write(trailer)
+        self.ff.write(FOOTER.pack(self.offset, MAGIC))
+        self.ff.close()
+        self.offset += len(trailer) + FOOTER.size
+        # total file size
+        return self.offset
+
+def write_cdict(filename, col_dict, chunk_rows=DEFAULT_CHUNK_ROWS, task_names=None):
+    '''Write a complete cdict file from a dict of columns.
+
+    task_names: optional dict of final qemu thread names indexed by tid
+    Returns the size of the file in bytes
+    '''
+    writer = CdictWriter(filename, chunk_rows=chunk_rows)
+    writer.task_names = task_names or {}
+    writer.write_columns(col_dict)
+    return writer.close()
+
+def read_trailer(ff):
+    # returns the trailer of an open version 2 cdict file and its offset
+    ff.seek(-FOOTER.size, 2)
+    end = ff.tell()
+    trailer_offset, magic = FOOTER.unpack(ff.read(FOOTER.size))
+    if magic != MAGIC:
+        raise ValueError('Truncated cdict file (missing trailer)')
+    ff.seek(trailer_offset)
+    return unpackb(ff.read(end - trailer_offset)), trailer_offset
+
+def read_header(ff):
+    # returns the header of an open version 2 cdict file
+    ff.seek(0)
+    if not is_cdict_v2(ff.read(len(MAGIC))):
+        raise ValueError('Not a version 2 cdict file')
+    header_len = HEADER_LEN.unpack(ff.read(HEADER_LEN.size))[0]
+    return unpackb(ff.read(header_len))
+
+def read_chunks(filename, columns=None):
+    '''Decode a version 2 cdict file one chunk at a time (without numpy or pandas).
+
+    columns: list of column names to decode (default all columns)
+    Yields a dict of columns indexed by column name for each chunk:
+    integer columns are int arrays, dictionary encoded columns and other columns are lists
+    the times and durations of legacy files are converted to nsecs
+    '''
+    with open(filename, 'rb') as ff:
+        header = read_header(ff)
+        trailer, _ = read_trailer(ff)
+        file_columns = [tuple(col) for col in header['columns']]
+        time_column = get_time_column(file_columns)
+        if columns is not None and time_column != TIME_COLUMN:
+            columns = [time_column if name == TIME_COLUMN else name for name in columns]
+        # a missing value has code -1
+        lookup = [None] + trailer['strings']
+        for chunk in trailer['chunks']:
+            res = {}
+            offset = chunk['offset']
+            for (name, encoding), size in zip(file_columns, chunk['sizes']):
+                if columns is None or name in columns:
+                    ff.seek(offset)
+                    data = zlib.decompress(ff.read(size))
+                    if encoding == ENC_OBJECT:
+                        res[name] = unpackb(data)
+                    elif encoding in DICT_ENCODINGS:
+                        res[name] = [lookup[code + 1] for code in unpack_ints(data, encoding)]
+                    else:
+                        res[name] = unpack_ints(data, encoding)
+                offset += size
+            if time_column in res and time_column != TIME_COLUMN:
+                # legacy files are in usecs
+                res[TIME_COLUMN] = array(INT64_TYPECODE, [value * LEGACY_SCALE for value in res.pop(time_column)])
+                if 'duration' in res:
+                    res['duration'] = array(INT64_TYPECODE, [value * LEGACY_SCALE for value in res['duration']])
+            yield res
+
+def update_trailer(filename, **fields):
+    '''Update some fields of the trailer of a version 2 cdict file in place.
+
+    The chunks are not rewritten, only the trailer and footer at the end of the file.
+    '''
+    with open(filename, 'r+b') as ff:
+        trailer, trailer_offset = read_trailer(ff)
+        trailer.update(fields)
+        ff.seek(trailer_offset)
+        ff.truncate()
+        ff.write(packb(trailer))
+        ff.write(FOOTER.pack(trailer_offset, MAGIC))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Synthetic cdict file generator (for benchmarking perfmap without a real capture)
+#
+# Writes the same columns and events as the perf script handlers (see mkcdict_perf_script.py):
+# - sched__sched_switch: runtime of the task switched out, next task
+# - sched__sched_stat_sleep: sleep time of the task woken up
+# - kvm_exit: vcpu run time, exit reason in next_comm
+# - kvm_entry: time spent outside of the vcpu (kvm + sleep)
+# The tasks are qemu threads (1 emulator and VCPUS_PER_VM vcpus per instance) and host tasks,
+# each task runs mostly on its own core. Only the kvm events come from vcpu threads.
+# Rows are generated and written one chunk at a time so that any event count can be
+# generated in bounded memory.
+#
+from optparse import OptionParser
+import sys
+
+import numpy as np
+import pandas
+
+from cdict_format import CdictWriter
+from cdict_format import DEFAULT_CHUNK_ROWS
+
+VCPUS_PER_VM = 2
+# probability that an event of a task happens on its own core
+PINNED = 0.8
+# mean durations in usecs (times and durations are written in nsecs)
+MEAN_RUNTIME = 500
+MEAN_SLEEP = 2000
+MEAN_VCPU_RUN = 50
+MEAN_VCPU_EXIT = 20
+# exit reason: percentage of kvm exits (see kvm_exit_reasons.py for the reason names)
+DEFAULT_EXIT_REASONS = '12:40,1:25,30:15,48:10,32:10'
+HOST_TASKS = ['ksoftirqd/%d', 'kworker/%d:1', 'ovs-vswitchd', 'libvirtd', 'sshd', 'rcu_sched']
+FIRST_TID = 1000
+
+def parse_count(count):
+    # 1000, 10K, 1M...
+    count = count.upper()
+    for suffix, factor in [('K', 1000), ('M', 1000000), ('G', 1000000000)]:
+        if count.endswith(suffix):
+            return int(float(count[:-1]) * factor)
+    return int(count)
+
+def parse_exit_reasons(mix):
+    # '12:40,1:25' -> reasons array, probabilities array
+    pairs = [item.split(':') for item in mix.split(',')]
+    reasons = np.array([int(reason) for reason, _ in pairs], dtype=np.int64)
+    weights = np.array([float(weight) for _, weight in pairs])
+    return reasons, weights / weights.sum()
+
+def get_vcpu_name(instance, vcpu):
+    return 'instance-%08x.vcpu%d' % (instance + 1, vcpu)
+
+def get_tasks(task_count):
+    '''Returns the list of task names, the tids and a mask of the vcpu threads.
+
+    A quarter of the tasks (at least 1) are host tasks, the others are qemu threads.
+    '''
+    host_count = max(task_count // 4, 1)
+    names = []
+    is_vcpu = []
+    for index in range(task_count - host_count):
+        instance, thread = divmod(index, VCPUS_PER_VM + 1)
+        if thread:
+            names.append(get_vcpu_name(instance, thread - 1))
+        else:
+            names.append('instance-%08x.emulator' % (instance + 1))
+        is_vcpu.append(thread > 0)
+    for index in range(host_count):
+        name = HOST_TASKS[index % len(HOST_TASKS)]
+        names.append(name % (index) if '%' in name else name)
+        is_vcpu.append(False)
+    tids = np.arange(FIRST_TID, FIRST_TID + task_count, dtype=np.int64)
+    return names, tids, np.array(is_vcpu)
+
+def generate_cdict(filename, events, tasks=64, cores=16, exit_reasons=DEFAULT_EXIT_REASONS,
+                   switch_rate=0.2, sleep_rate=0.05, duration=10, seed=0, chunk_rows=DEFAULT_CHUNK_ROWS):
+    '''Write a synthetic cdict file.
+
+    events: number of rows
+    switch_rate, sleep_rate: fraction of context switch and sleep events, the other events
+                             are kvm exits and entries in equal numbers
+    duration: time span of the rows in seconds
+    Returns the size of the file in bytes
+    '''
+    rng = np.random.RandomState(seed)
+    names, tids, is_vcpu = get_tasks(tasks)
+    if not is_vcpu.any():
+        raise ValueError('Not enough tasks for a vcpu thread')
+    vcpus = np.flatnonzero(is_vcpu)
+    home_cpus = np.arange(tasks) % cores
+    reasons, reason_weights = parse_exit_reasons(exit_reasons)
+    event_names = ['sched__sched_switch', 'sched__sched_stat_sleep', 'kvm_exit', 'kvm_entry']
+    kvm_rate = (1 - switch_rate - sleep_rate) / 2
+    event_weights = [switch_rate, sleep_rate, kvm_rate, kvm_rate]
+    # host tasks can share a name (categories must be unique)
+    categories = sorted(set(names))
+    name_codes = np.array([categories.index(name) for name in names], dtype=np.int64)
+    # next_comm holds a task name or an exit reason
+    next_categories = categories + reasons.tolist()
+    mean_gap = duration * 1e6 / max(events, 1)
+
+    writer = CdictWriter(filename, chunk_rows=chunk_rows)
+    # final names of the qemu threads
+    writer.task_names = dict((int(tid), name) for tid, name in zip(tids, names) if name.startswith('instance-'))
+    writer.epoch = 0
+    usecs_base = 0.0
+    for start in xrange(0, events, chunk_rows):
+        count = min(chunk_rows, events - start)
+        kinds = rng.choice(len(event_names), count, p=event_weights)
+        is_kvm = kinds >= 2
+        # kvm events only come from vcpu threads
+        task = rng.randint(0, tasks, count)
+        task[is_kvm] = vcpus[rng.randint(0, len(vcpus), np.count_nonzero(is_kvm))]
+        cpu = np.where(rng.random_sample(count) < PINNED, home_cpus[task], rng.randint(0, cores, count))
+        times = usecs_base + np.cumsum(rng.exponential(mean_gap, count))
+        usecs_base = times[-1]
+        durations = np.select([kinds == 0, kinds == 1, kinds == 2],
+                              [rng.exponential(MEAN_RUNTIME, count), rng.exponential(MEAN_SLEEP, count),
+                               rng.exponential(MEAN_VCPU_RUN, count)],
+                              rng.exponential(MEAN_VCPU_EXIT, count))
+        is_switch = kinds == 0
+        next_task = rng.randint(0, tasks, count)
+        next_codes = np.where(is_switch, name_codes[next_task], -1)
+        is_exit = kinds == 2
+        next_codes[is_exit] = len(categories) + rng.choice(len(reasons), np.count_nonzero(is_exit), p=reason_weights)
+        writer.write_chunk({'event': pandas.Categorical.from_codes(kinds, event_names),
+                            'cpu': cpu,
+                            'nsecs': (times * 1000).astype(np.int64),
+                            'pid': tids[task],
+                            'task_name': pandas.Categorical.from_codes(name_codes[task], categories),
+                            'duration': (durations * 1000).astype(np.int64) + 1,
+                            'next_pid': np.where(is_switch, tids[next_task], 0),
+                            'next_comm': pandas.Categorical.from_codes(next_codes, next_categories)})
+    return writer.close()
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] <cdict_file>")
+    parser.add_option('-n', '--events', dest='events',
+                      action='store',
+                      default='1M',
+                      help='number of events (K, M, G suffixes allowed), defaults to 1M',
+                      metavar='<count>')
+    parser.add_option('--tasks', dest='tasks',
+                      action='store',
+                      type='int',
+                      default=64,
+                      help='number of tasks (3/4 are qemu threads), defaults to 64',
+                      metavar='<count>')
+    parser.add_option('--cores', dest='cores',
+                      action='store',
+                      type='int',
+                      default=16,
+                      help='number of cores, defaults to 16',
+                      metavar='<count>')
+    parser.add_option('--exit-reasons', dest='exit_reasons',
+                      action='store',
+                      default=DEFAULT_EXIT_REASONS,
+                      help='kvm exit reason mix as <reason>:<weight> pairs, defaults to %s '
+                           '(HLT, external interrupt, I/O, EPT violation, WRMSR)' % (DEFAULT_EXIT_REASONS),
+                      metavar='<mix>')
+    parser.add_option('--switch-rate', dest='switch_rate',
+                      action='store',
+                      type='float',
+                      default=0.2,
+                      help='fraction of context switch events, defaults to 0.2',
+                      metavar='<fraction>')
+    parser.add_option('--sleep-rate', dest='sleep_rate',
+                      action='store',
+                      type='float',
+                      default=0.05,
+                      help='fraction of sleep events, defaults to 0.05 (the other events are kvm events)',
+                      metavar='<fraction>')
+    parser.add_option('--duration', dest='duration',
+                      action='store',
+                      type='float',
+                      default=10,
+                      help='time span of the events in seconds, defaults to 10',
+                      metavar='<seconds>')
+    parser.add_option('--seed', dest='seed',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='random seed, defaults to 0',
+                      metavar='<seed>')
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    if opts.switch_rate + opts.sleep_rate > 1:
+        print 'The switch and sleep rates cannot exceed 1'
+        sys.exit(1)
+    events = parse_count(opts.events)
+    size = generate_cdict(args[0], events, opts.tasks, opts.cores, opts.exit_reasons,
+                          opts.switch_rate, opts.sleep_rate, opts.duration, opts.seed)
+    print 'Synthetic cdict written to %s %d entries size=%d bytes' % (args[0], events, size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Reader for all the cdict file formats:
+# - version 2 chunked columnar format (see cdict_format.py)
+# - zlib compressed msgpack dict of lists
+# - zlib compressed marshal dict of lists (legacy)
+#
+import marshal
+import mmap
+import zlib
+
+try:
+    # try to use the faster version if available
+    from msgpack import unpackb
+except ImportError:
+    # else fall back to the pure python version (slower)
+    from umsgpack import unpackb
+import numpy as np
+import pandas
+
+from cdict_format import DICT_ENCODINGS
+from cdict_format import ENC_DELTA64
+from cdict_format import ENC_OBJECT
+from cdict_format import ENC_SHUFFLE_DICT
+from cdict_format import FOOTER
+from cdict_format import HEADER_LEN
+from cdict_format import INT_ENCODINGS
+from cdict_format import ITEM_SIZES
+from cdict_format import LEGACY_SCALE
+from cdict_format import LEGACY_TIME_COLUMN
+from cdict_format import MAGIC
+from cdict_format import SHUFFLED_ENCODINGS
+from cdict_format import TIME_COLUMN
+from cdict_format import get_time_column
+from cdict_format import is_cdict_v2
+from phase_profile import profile_phase
+
+def get_time_mask(nsecs, from_nsecs, to_nsecs):
+    # boolean mask of the rows inside the time window (to_nsecs=0 means unlimited)
+    mask = nsecs >= from_nsecs
+    if to_nsecs:
+        mask &= nsecs <= to_nsecs
+    return mask
+
+def decode_ints(data, encoding):
+    # decode the (uncompressed) bytes of one of the integer encodings (see encode_ints())
+    int_encoding = INT_ENCODINGS[encoding]
+    if encoding in SHUFFLED_ENCODINGS:
+        planes = np.frombuffer(data, dtype=np.uint8).reshape(ITEM_SIZES[int_encoding], -1)
+        values = planes.T.copy().view(int_encoding).ravel()
+    else:
+        values = np.frombuffer(data, dtype=int_encoding)
+    if encoding == ENC_DELTA64:
+        return np.cumsum(values)
+    if encoding == ENC_SHUFFLE_DICT:
+        return values - 1
+    return values
+
+def get_file_columns(columns, time_column):
+    # names of the requested columns in a file which time column may be the legacy one
+    if columns is None or time_column == TIME_COLUMN:
+        return columns
+    return [time_column if name == TIME_COLUMN else name for name in columns]
+
+def convert_legacy_columns(perf_dict):
+    # convert the columns of a legacy file (usecs) to nsecs in place
+    if LEGACY_TIME_COLUMN in perf_dict:
+        perf_dict[TIME_COLUMN] = np.asarray(perf_dict.pop(LEGACY_TIME_COLUMN), dtype=np.int64) * LEGACY_SCALE
+        if 'duration' in perf_dict:
+            perf_dict['duration'] = np.asarray(perf_dict['duration'], dtype=np.int64) * LEGACY_SCALE
+    return perf_dict
+
+def make_categorical(codes, strings):
+    # only keep the strings used in this column as categories
+    used = np.bincount(codes + 1, minlength=len(strings) + 1)[1:] > 0
+    lookup = np.empty(len(strings) + 1, dtype=np.int32)
+    lookup[0] = -1
+    lookup[1:][used] = np.arange(np.count_nonzero(used), dtype=np.int32)
+    categories = [strings[index] for index in np.flatnonzero(used)]
+    return pandas.Categorical.from_codes(lookup[codes + 1], categories)
+
+def filter_column(values, mask):
+    if isinstance(values, list):
+        return [value for value, keep in zip(values, mask) if keep]
+    return values[mask]
+
+
+class CdictReader(object):
+    '''Decode a version 2 cdict file held in memory or memory mapped.
+
+    Only the compressed blobs of the requested columns are accessed so
+    that a memory mapped file does not need to be entirely paged in.
+    '''
+    def __init__(self, data):
+        self.data = data
+        offset = len(MAGIC)
+        header_len = HEADER_LEN.unpack_from(data, offset)[0]
+        offset += HEADER_LEN.size
+        header = unpackb(data[offset:offset + header_len])
+        self.version = header['version']
+        self.chunk_rows = header['chunk_rows']
+        self.columns = [tuple(col) for col in header['columns']]
+        trailer_offset, magic = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('Truncated cdict file (missing trailer)')
+        trailer = unpackb(data[trailer_offset:len(data) - FOOTER.size])
+        self.rows = trailer['rows']
+        self.chunks = trailer['chunks']
+        self.strings = trailer['strings']
+        # files written before the task names table was added have none
+        self.task_names = dict(trailer.get('task_names', []))
+        # epoch and lost events as stored (in the unit of the time column)
+        self.epoch = trailer.get('epoch')
+        self.lost = trailer.get('lost', [])
+        self.time_column = get_time_column(self.columns)
+        self.time_index = [name for name, _ in self.columns].index(self.time_column)
+        self.time_scale = 1 if self.time_column == TIME_COLUMN else LEGACY_SCALE
+        # [cpu, from_nsecs, to_nsecs, count] of each lost event record
+        self.lost_nsecs = [[cpu, from_time * self.time_scale, to_time * self.time_scale, count]
+                           for cpu, from_time, to_time, count in self.lost]
+
+    def get_blob(self, chunk, col_index):
+        # returns the compressed blob of a column in a chunk
+        offset = chunk['offset'] + sum(chunk['sizes'][:col_index])
+        return self.data[offset:offset + chunk['sizes'][col_index]]
+
+    def decode_column(self, chunk, col_index):
+        name, encoding = self.columns[col_index]
+        with profile_phase('zlib decompress'):
+            blob = zlib.decompress(self.get_blob(chunk, col_index))
+        with profile_phase('unpack'):
+            if encoding == ENC_OBJECT:
+                return unpackb(blob)
+            return decode_ints(blob, encoding)
+
+    def get_time_range(self, chunk):
+        # time range of a chunk in nsecs
+        return (chunk['min_' + self.time_column] * self.time_scale,
+                chunk['max_' + self.time_column] * self.time_scale)
+
+    def get_chunks(self, from_nsecs=0, to_nsecs=0):
+        # use the time index to find the chunks that overlap the time window
+        chunks = []
+        for chunk in self.chunks:
+            min_nsecs, max_nsecs = self.get_time_range(chunk)
+            if max_nsecs >= from_nsecs and (not to_nsecs or min_nsecs <= to_nsecs):
+                chunks.append(chunk)
+        return chunks
+
+    def read(self, columns=None, from_nsecs=0, to_nsecs=0):
+        '''Decode the given columns (default all columns) of all chunks in a time window.
+
+        from_nsecs, to_nsecs: only return rows with from_nsecs <= nsecs <= to_nsecs
+                              (to_nsecs=0 means unlimited)
+        Returns a dict of columns indexed by column name
+        numeric columns are numpy arrays, dictionary encoded columns are
+        pandas categoricals, other columns are lists
+        the times and durations of legacy files are converted to nsecs
+        '''
+        chunks = self.get_chunks(from_nsecs, to_nsecs)
+        # chunks that straddle a window boundary need a row mask
+        masks = []
+        for chunk in chunks:
+            min_nsecs, max_nsecs = self.get_time_range(chunk)
+            if min_nsecs < from_nsecs or (to_nsecs and max_nsecs > to_nsecs):
+                nsecs = self.decode_column(chunk, self.time_index) * self.time_scale
+                with profile_phase('time filtering'):
+                    masks.append(get_time_mask(nsecs, from_nsecs, to_nsecs))
+            else:
+                masks.append(None)
+        columns = get_file_columns(columns, self.time_column)
+        res = {}
+        for col_index, (name, encoding) in enumerate(self.columns):
+            if columns and name not in columns:
+                continue
+            parts = []
+            for chunk, mask in zip(chunks, masks):
+                part = self.decode_column(chunk, col_index)
+                if mask is not None:
+                    with profile_phase('time filtering'):
+                        part = filter_column(part, mask)
+                parts.append(part)
+            with profile_phase('unpack'):
+                if encoding == ENC_OBJECT:
+                    res[name] = [value for part in parts for value in part]
+                    continue
+                dtype = INT_ENCODINGS[encoding]
+                values = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+                if encoding in DICT_ENCODINGS:
+                    values = make_categorical(values, self.strings)
+                res[name] = values
+        return convert_legacy_columns(res)
+
+def get_trailer_field(cdict_file, name, default):
+    # returns a trailer field of a version 2 cdict file (default for other formats)
+    with open(cdict_file, 'rb') as ff:
+        if not is_cdict_v2(ff.read(len(MAGIC))):
+            return default
+        mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return getattr(CdictReader(mm), name)
+    finally:
+        mm.close()
+
+def load_task_names(cdict_file):
+    '''Returns the final qemu thread names table of a cdict file indexed by tid.
+
+    Only version 2 files have a table (empty for other formats)
+    '''
+    return get_trailer_field(cdict_file, 'task_names', {})
+
+def load_lost_events(cdict_file):
+    '''Returns the list of [cpu, from_nsecs, to_nsecs, count] lost events of a cdict file.
+
+    Only version 2 files record lost events (empty for other formats)
+    '''
+    return get_trailer_field(cdict_file, 'lost_nsecs', [])
+
+def load_cdict(cdict_file, columns=None, from_nsecs=0, to_nsecs=0):
+    '''Load a cdict file of any format into a dict of columns indexed by column name.
+
+    columns: list of column names to load (default all columns)
+    from_nsecs, to_nsecs: only load rows within that time window (to_nsecs=0 means unlimited)
+    Version 2 files are memory mapped and only the requested columns of the chunks
+    overlapping the time window are decoded, older formats have to be entirely
+    decompressed before dropping unneeded columns and rows.
+    Files written in usecs are returned in nsecs.
+    '''
+    with open(cdict_file, 'rb') as ff:
+        if is_cdict_v2(ff.read(len(MAGIC))):
+            with profile_phase('file read'):
+                mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+                reader = CdictReader(mm)
+            try:
+                return reader.read(columns, from_nsecs, to_nsecs)
+            finally:
+                mm.close()
+        ff.seek(0)
+        with profile_phase('file read'):
+            cdict = ff.read()
+    with profile_phase('zlib decompress'):
+        decomp = zlib.decompress(cdict)
+    del cdict
+    with profile_phase('unpack'):
+        try:
+            perf_dict = unpackb(decomp)
+        except Exception:
+            # old serialization format
+            perf_dict = marshal.loads(decomp)
+    # these formats were only written in usecs
+    if columns:
+        columns = get_file_columns(columns, LEGACY_TIME_COLUMN)
+        perf_dict = dict((name, perf_dict[name]) for name in set(columns) | set([LEGACY_TIME_COLUMN]))
+    perf_dict = convert_legacy_columns(perf_dict)
+    if from_nsecs or to_nsecs:
+        with profile_phase('time filtering'):
+            mask = get_time_mask(perf_dict[TIME_COLUMN], from_nsecs, to_nsecs)
+            perf_dict = dict((name, filter_column(values, mask)) for name, values in perf_dict.items())
+    if columns and LEGACY_TIME_COLUMN not in columns:
+        del perf_dict[TIME_COLUMN]
+    return perf_dict
@@ -0,0 +1,142 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Remapping of task names from a CSV mapping file
+#
+# The mapping is applied to the unique tids of a column and the resulting
+# name codes are then broadcast to all rows, so the per row cost is a
+# few numpy operations regardless of the number of events.
+#
+import csv
+import mmap
+
+import numpy as np
+import pandas
+
+from cdict_format import CdictWriter
+from cdict_format import MAGIC
+from cdict_format import compress_ints
+from cdict_format import is_cdict_v2
+from cdict_format import write_cdict
+from cdict_reader import CdictReader
+from cdict_reader import load_cdict
+
+# pairs of tid and task name columns to remap
+REMAP_COLUMNS = [('pid', 'task_name'), ('next_pid', 'next_comm')]
+
+# code for rows that are not remapped
+NOT_MAPPED = -2
+
+def load_task_map(csv_map):
+    # returns a mapping dict of task names indexed by the tid
+    map_dict = {}
+    with open(csv_map, 'r') as ff:
+        # 19236,instance-000019f4,emulator,8f81e3a1-3ebd-4015-bbee-e291f0672d02,FULL,5,CSR
+        reader = csv.DictReader(ff, fieldnames=['tid', 'libvirt_id', 'thread_type', 'uuid', 'chain_type',
+                                                'chain_id', 'nvf_name'])
+        for row in reader:
+            task_name = '%s.%02d.%s' % (row['nvf_name'], int(row['chain_id']), row['thread_type'])
+            map_dict[int(row['tid'])] = task_name
+    return map_dict
+
+def remap_codes(pids, codes, tid_codes):
+    '''Replace the name code of all rows which tid is in tid_codes.
+
+    pids: array of tids
+    codes: array of name codes
+    tid_codes: a dict of new name codes indexed by tid
+    Returns the new array of codes and the number of remapped rows
+    '''
+    inverse, tids = pandas.factorize(pids)
+    # inverse is -1 for missing tids, which picks the last lookup entry
+    lookup = np.array([tid_codes.get(tid, NOT_MAPPED) for tid in tids] + [NOT_MAPPED], dtype=np.int32)
+    new_codes = lookup[inverse]
+    mapped = new_codes != NOT_MAPPED
+    return np.where(mapped, new_codes, codes), np.count_nonzero(mapped)
+
+def remap_names(pids, names, map_dict):
+    '''Remap a column of names (list or categorical) from a dict of names indexed by tid.
+
+    Returns the remapped names as a categorical and the number of remapped rows
+    '''
+    names = pandas.Categorical(names)
+    additions = set(map_dict.values()) - set(names.categories)
+    names = names.add_categories(sorted(additions))
+    categories = names.categories
+    tid_codes = dict((tid, categories.get_loc(name)) for tid, name in map_dict.items())
+    codes, count = remap_codes(pids, names.codes, tid_codes)
+    names = pandas.Categorical.from_codes(codes, categories)
+    # the names that are no longer referenced are dropped
+    return names.remove_unused_categories(), count
+
+def remap_task_names(perf_dict, map_dict):
+    '''Remap the task names of a dict of columns in place.
+
+    Name columns that are not loaded are skipped.
+    Returns the number of remapped task names
+    '''
+    count = 0
+    for pid_column, name_column in REMAP_COLUMNS:
+        if name_column in perf_dict:
+            perf_dict[name_column], col_count = remap_names(perf_dict[pid_column],
+                                                            perf_dict[name_column], map_dict)
+            count += col_count
+    return count
+
+def remap_cdict(cdict_file, new_cdict, map_dict):
+    '''Write a copy of a cdict file with remapped task names.
+
+    For version 2 files, only the tid and name columns are decoded and the
+    name columns re-encoded against an extended string table, all other
+    column blobs are copied as is.
+    Returns the number of remapped task names
+    '''
+    with open(cdict_file, 'rb') as ff:
+        if not is_cdict_v2(ff.read(len(MAGIC))):
+            perf_dict = load_cdict(cdict_file)
+            count = remap_task_names(perf_dict, map_dict)
+            write_cdict(new_cdict, perf_dict)
+            return count
+        mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        reader = CdictReader(mm)
+        writer = CdictWriter(new_cdict, columns=reader.columns, chunk_rows=reader.chunk_rows)
+        writer.task_names = reader.task_names
+        writer.epoch = reader.epoch
+        writer.lost = reader.lost
+        # the string table is extended with the new names, existing codes are unchanged
+        for value in reader.strings:
+            writer.get_code(value)
+        tid_codes = dict((tid, writer.get_code(name)) for tid, name in map_dict.items())
+        col_names = [name for name, _ in reader.columns]
+        pairs = [(col_names.index(pid_column), col_names.index(name_column))
+                 for pid_column, name_column in REMAP_COLUMNS]
+        count = 0
+        for chunk in reader.chunks:
+            blobs = [reader.get_blob(chunk, col_index) for col_index in range(len(col_names))]
+            for pid_index, name_index in pairs:
+                codes, col_count = remap_codes(reader.decode_column(chunk, pid_index),
+                                               reader.decode_column(chunk, name_index), tid_codes)
+                blobs[name_index] = compress_ints(codes, reader.columns[name_index][1])
+                count += col_count
+            # the time column and range are copied as is (usecs for legacy files)
+            writer.write_blobs(blobs, chunk['rows'], chunk['min_' + reader.time_column],
+                               chunk['max_' + reader.time_column])
+        writer.close()
+    finally:
+        mm.close()
+    return count
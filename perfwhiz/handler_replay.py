@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Replay harness for the perf script handlers (does not require perf or tracing privileges)
+#
+# Feeds an event stream to the handlers of mkcdict_perf_script.py with the same arguments
+# as perf script (event name, context, common fields then the tracepoint fields in format
+# order) and reports the handler throughput (events/sec) and memory per million events.
+# The events come from:
+# - a recorded perf.data file, decoded with the native reader (see perf_data.py)
+# - or a synthetic stream of context switch, runtime, sleep, wakeup and kvm entry/exit events
+# Events are decoded or generated in batches and only the handler calls are timed.
+# The memory is the highest RSS growth sampled after each batch, relative to the RSS
+# with the first batch in memory (the handlers only keep the rows of the current chunk
+# so it should not grow with the number of events).
+#
+import json
+from optparse import OptionParser
+import os
+import time
+
+import numpy as np
+
+from cdict_gen import parse_count
+import mkcdict_perf_script as handlers
+from perf_data import PerfDataFile
+from perf_data import read_data_locs
+from perf_data import read_ints
+from perf_data import read_strings
+from phase_profile import get_rss
+
+# number of events decoded or generated at once
+BATCH_EVENTS = 100000
+
+def get_handler(event_name):
+    # returns the handler function and its number of tracepoint field arguments (None if no handler)
+    handler = getattr(handlers, event_name, None)
+    if handler is None:
+        return None, 0
+    # event_name, context and the 5 common fields come first
+    return handler, handler.func_code.co_argcount - 7
+
+def make_calls(handler, arg_count, event_name, cpus, times, pids, comms, columns):
+    # returns the list of (handler, args) of the rows of one tracepoint
+    # kernels may have more tracepoint fields than the handler arguments (or less)
+    columns = (columns + [[0] * len(cpus)] * arg_count)[:arg_count]
+    secs, nsecs = np.divmod(times, 1000000000)
+    return [(handler, (event_name, None) + common + fields)
+            for common, fields in zip(zip(cpus.tolist(), secs.tolist(), nsecs.tolist(), pids.tolist(), comms),
+                                      zip(*columns) if columns else [()] * len(cpus))]
+
+def perf_data_batches(perf_data_filename, batch_events=BATCH_EVENTS):
+    '''Decode the samples of a perf.data file in time order, one batch at a time.
+
+    Yields lists of (handler, args)
+    '''
+    pdf = PerfDataFile(perf_data_filename)
+    records, comm_by_tid, _ = pdf.scan()
+    buf = np.frombuffer(pdf.data, dtype=np.uint8)
+    layout = pdf.get_sample_layout()
+    times = read_ints(buf, records + layout['time'], 8)
+    records = records[np.argsort(times, kind='mergesort')]
+    for start in xrange(0, len(records), batch_events):
+        batch = records[start:start + batch_events]
+        raw = batch + layout['raw']
+        types = read_ints(buf, raw, 2)
+        cpus = read_ints(buf, batch + layout['cpu'], 4)
+        times = read_ints(buf, batch + layout['time'], 8)
+        pids = read_ints(buf, raw + 4, 4, True)
+        calls = [None] * len(batch)
+        for type_id in np.unique(types):
+            rows = np.flatnonzero(types == type_id)
+            fmt = pdf.formats.get(type_id)
+            handler, arg_count = get_handler(fmt.name.replace(':', '__')) if fmt else (None, 0)
+            if not handler:
+                continue
+            columns = []
+            for name in fmt.arg_names[:arg_count]:
+                offset, size, signed, is_string = fmt.fields[name]
+                positions = raw[rows] + offset
+                if name in fmt.data_locs:
+                    columns.append(read_data_locs(pdf.data, raw[rows], read_ints(buf, positions, 4)))
+                elif is_string:
+                    strings, inverse = read_strings(buf, positions, size)
+                    columns.append([strings[index] for index in inverse])
+                elif size in (1, 2, 4, 8):
+                    columns.append(read_ints(buf, positions, size, signed).tolist())
+                else:
+                    # arrays other than strings
+                    columns.append([0] * len(rows))
+            comms = [comm_by_tid.get(pid, ':%d' % (pid)) for pid in pids[rows].tolist()]
+            rows_calls = make_calls(handler, arg_count, fmt.name.replace(':', '__'),
+                                    cpus[rows], times[rows], pids[rows], comms, columns)
+            for row, call in zip(rows.tolist(), rows_calls):
+                calls[row] = call
+        yield [call for call in calls if call]
+
+def synthetic_batches(events, cpus=16, vcpus=32, tasks=32, seed=0, batch_events=BATCH_EVENTS):
+    '''Generate a synthetic event stream, one batch at a time.
+
+    vcpus: number of vcpu threads (the only ones with kvm events)
+    tasks: number of other tasks
+    Yields lists of (handler, args)
+    '''
+    rng = np.random.RandomState(seed)
+    names = ['CPU %d/KVM' % (index) for index in range(vcpus)] + ['task-%d' % (index) for index in range(tasks)]
+    tids = np.arange(10000, 10000 + len(names), dtype=np.int64)
+    # event name, weight
+    kinds = [('sched__sched_switch', 0.15), ('sched__sched_stat_runtime', 0.15), ('sched__sched_stat_sleep', 0.05),
+             ('sched__sched_wakeup', 0.05), ('kvm__kvm_entry', 0.3), ('kvm__kvm_exit', 0.3)]
+    weights = np.array([weight for _, weight in kinds])
+    reasons = np.array([1, 12, 30, 32, 48], dtype=np.int64)
+    now = 5000000000000
+    for start in xrange(0, events, batch_events):
+        count = min(batch_events, events - start)
+        kind = rng.choice(len(kinds), count, p=weights / weights.sum())
+        task = rng.randint(0, len(names), count)
+        is_kvm = kind >= 4
+        task[is_kvm] = rng.randint(0, vcpus, np.count_nonzero(is_kvm))
+        other = rng.randint(0, len(names), count)
+        cpu = rng.randint(0, cpus, count)
+        times = now + np.cumsum(rng.randint(100, 2000, count))
+        now = int(times[-1])
+        values = rng.randint(1, 100000, count)
+        calls = [None] * count
+        for index, (event_name, _) in enumerate(kinds):
+            rows = np.flatnonzero(kind == index)
+            if not len(rows):
+                continue
+            handler, arg_count = get_handler(event_name)
+            pids = tids[task[rows]]
+            comms = [names[task_index] for task_index in task[rows].tolist()]
+            others = [names[task_index] for task_index in other[rows].tolist()]
+            other_pids = tids[other[rows]].tolist()
+            count_rows = len(rows)
+            if event_name == 'sched__sched_switch':
+                # prev_comm, prev_pid, prev_prio, prev_state, next_comm, next_pid, next_prio
+                columns = [comms, pids.tolist(), [120] * count_rows, [1] * count_rows,
+                           others, other_pids, [120] * count_rows]
+            elif event_name == 'sched__sched_stat_runtime':
+                # comm, pid, runtime, vruntime
+                columns = [comms, pids.tolist(), values[rows].tolist(), [0] * count_rows]
+            elif event_name == 'sched__sched_stat_sleep':
+                # comm, pid, delay (of the task woken up)
+                columns = [others, other_pids, (values[rows] * 10).tolist()]
+            elif event_name == 'sched__sched_wakeup':
+                # comm, pid, prio, success, target_cpu
+                columns = [others, other_pids, [120] * count_rows, [1] * count_rows, cpu[rows].tolist()]
+            elif event_name == 'kvm__kvm_entry':
+                # vcpu_id
+                columns = [[0] * count_rows]
+            else:
+                # exit_reason, guest_rip, isa, info1, info2
+                columns = [reasons[values[rows] % len(reasons)].tolist(), [0xffff] * count_rows,
+                           [1] * count_rows, [0] * count_rows, [0] * count_rows]
+            rows_calls = make_calls(handler, arg_count, event_name, cpu[rows], times[rows], pids, comms, columns)
+            for row, call in zip(rows.tolist(), rows_calls):
+                calls[row] = call
+        yield calls
+
+def replay(batches, cdict_filename):
+    '''Feed all the batches to the handlers and write the cdict file.
+
+    Returns a dict of results
+    '''
+    start_rss = None
+    max_growth = 0
+    events = 0
+    handler_secs = 0.0
+    start = time.time()
+    handlers.trace_begin()
+    begin_secs = time.time() - start
+    for calls in batches:
+        if start_rss is None:
+            # the next batches reuse the memory of the first batch
+            start_rss = get_rss()
+        start = time.time()
+        for handler, args in calls:
+            handler(*args)
+        handler_secs += time.time() - start
+        events += len(calls)
+        max_growth = max(max_growth, get_rss() - start_rss)
+    start = time.time()
+    handlers.trace_end()
+    end_secs = time.time() - start
+    os.rename('perf.cdict', cdict_filename)
+    return {'events': events,
+            'rows': handlers.cdict_writer.rows,
+            'trace_begin_secs': begin_secs,
+            'handler_secs': handler_secs,
+            'trace_end_secs': end_secs,
+            'events_per_sec': events / handler_secs if handler_secs else 0,
+            'rss_growth_mb': max_growth / 1e6,
+            'mb_per_million_events': max_growth / 1e6 / (events / 1e6) if events else 0}
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-i', '--perf-data', dest='perf_data',
+                      action='store',
+                      help='replay the samples of a perf data file (default: synthetic events)',
+                      metavar='<perf data file>')
+    parser.add_option('-n', '--events', dest='events',
+                      action='store',
+                      default='1M',
+                      help='number of synthetic events (K, M, G suffixes allowed), defaults to 1M',
+                      metavar='<count>')
+    parser.add_option('--cpus', dest='cpus',
+                      action='store',
+                      type='int',
+                      default=16,
+                      help='number of cpus of the synthetic events, defaults to 16',
+                      metavar='<count>')
+    parser.add_option('--vcpus', dest='vcpus',
+                      action='store',
+                      type='int',
+                      default=32,
+                      help='number of vcpu threads of the synthetic events, defaults to 32',
+                      metavar='<count>')
+    parser.add_option('--tasks', dest='tasks',
+                      action='store',
+                      type='int',
+                      default=32,
+                      help='number of other tasks of the synthetic events, defaults to 32',
+                      metavar='<count>')
+    parser.add_option('--seed', dest='seed',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='random seed of the synthetic events, defaults to 0',
+                      metavar='<seed>')
+    parser.add_option('-o', '--output', dest='output',
+                      action='store',
+                      default='replay.cdict',
+                      help='cdict file written by the handlers, defaults to replay.cdict',
+                      metavar='<cdict file>')
+    parser.add_option('--json', dest='json',
+                      action='store',
+                      help='save the results to a json file',
+                      metavar='<json file>')
+    (opts, args) = parser.parse_args()
+
+    if opts.perf_data:
+        batches = perf_data_batches(opts.perf_data)
+        source = opts.perf_data
+    else:
+        events = parse_count(opts.events)
+        batches = synthetic_batches(events, opts.cpus, opts.vcpus, opts.tasks, opts.seed)
+        source = 'synthetic (%d events)' % (events)
+    res = replay(batches, opts.output)
+    res['source'] = source
+    print 'Replayed %d events from %s: %d rows written to %s' % (res['events'], source, res['rows'], opts.output)
+    print '   handlers    %8.2f sec  %10d events/sec' % (res['handler_secs'], res['events_per_sec'])
+    print '   trace_begin %8.2f sec' % (res['trace_begin_secs'])
+    print '   trace_end   %8.2f sec' % (res['trace_end_secs'])
+    print '   memory      %8.1f MB RSS growth, %.1f MB per million events' % \
+          (res['rss_growth_mb'], res['mb_per_million_events'])
+    if opts.json:
+        with open(opts.json, 'w') as ff:
+            json.dump(res, ff, indent=2)
+
+if __name__ == '__main__':
+    main()
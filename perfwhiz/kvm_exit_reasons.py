@@ -0,0 +1,187 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# KVM exit reason codes and names
+#
+# The cdict next_comm column of the kvm_exit events contains the VMX basic exit
+# reason code whatever the converter (perf script handlers, perf data or perf script text)
+# The perf script text output has the kernel name of the reason instead (for example
+# "reason EPT_VIOLATION"), which is converted back to its code with get_exit_reason_code().
+#
+# This module only depends on the python standard library so that it can be
+# imported from the perf embedded python interpreter.
+#
+
+# code stored for the exit reasons that are not known
+UNKNOWN_EXIT_REASON = -1
+
+# KVM exit reasons
+# Intel64 and IA32 Architecture Software Developer's Manual Vol 3B, System Programming Guide Part 2
+# Appendix I
+KVM_EXIT_REASONS = [
+    'Exception or NMI',     # 0
+    'External Interrupt',
+    'Triple Fault',
+    'INIT',
+    'Startup IPI',
+    'I/O SMI (System Management Interrupt)',
+    'Other SMI',
+    'Interrupt Window',
+    'NMI window',
+    'Task Switch',
+    'CPUID',                # 10
+    'GETSEC',
+    'HLT',                  # 12
+    'INVD',
+    'INVLPG',
+    'RDPMC',
+    'RDTSC',
+    'RSM',
+    'VMCALL',
+    'VMCLEAR',
+    'VMLAUNCH',             # 20
+    'VMPTRLD',
+    'VMPTRST',
+    'VMREAD',
+    'VMRESUME',
+    'VMWRITE',
+    'VMXOFF',
+    'VMXON',
+    'Control Register Access',
+    'MOV DR',
+    'I/O Instruction',      # 30
+    'RDMSR',
+    'WRMSR',
+    'VM Entry Failure (invalid guest state)',
+    'VM Entry Failure (MSR loading)',
+    'n/a 35',
+    'MWAIT',
+    'Monitor trap flag',
+    'n/a 38',
+    'MONITOR',
+    'PAUSE',                # 40
+    'VM Entry Failure (machine check)',
+    'n/a 42',
+    'TPR below threshold',
+    'APIC Access',
+    'Virtualized EOI',
+    'Access to GDTR or IDTR',
+    'Access to LDTR or TR',
+    'EPT violation',
+    'EPT misconfiguration',
+    'INVEPT',               # 50
+    'RDTSCP',
+    'VMX preemption timer expired',
+    'INVVPID',
+    'WBINVD',
+    'XSETBV',
+    'APIC write',
+    'RDRAND',
+    'INVPCID',
+    'VMFUNC',
+    'ENCLS',                # 60
+    'RDSEED',
+    'Page modification log full',
+    'XSAVES',
+    'XRSTORS'
+]
+
+# kernel names of the exit reasons (arch/x86/include/uapi/asm/vmx.h) as printed by
+# the kvm:kvm_exit tracepoint
+KERNEL_EXIT_REASONS = {
+    'EXCEPTION_NMI': 0,
+    'EXTERNAL_INTERRUPT': 1,
+    'TRIPLE_FAULT': 2,
+    'INIT_SIGNAL': 3,
+    'SIPI_SIGNAL': 4,
+    'PENDING_INTERRUPT': 7,
+    'INTERRUPT_WINDOW': 7,
+    'NMI_WINDOW': 8,
+    'TASK_SWITCH': 9,
+    'CPUID': 10,
+    'HLT': 12,
+    'INVD': 13,
+    'INVLPG': 14,
+    'RDPMC': 15,
+    'RDTSC': 16,
+    'VMCALL': 18,
+    'VMCLEAR': 19,
+    'VMLAUNCH': 20,
+    'VMPTRLD': 21,
+    'VMPTRST': 22,
+    'VMREAD': 23,
+    'VMRESUME': 24,
+    'VMWRITE': 25,
+    'VMOFF': 26,
+    'VMON': 27,
+    'CR_ACCESS': 28,
+    'DR_ACCESS': 29,
+    'IO_INSTRUCTION': 30,
+    'MSR_READ': 31,
+    'MSR_WRITE': 32,
+    'INVALID_STATE': 33,
+    'MSR_LOAD_FAIL': 34,
+    'MWAIT_INSTRUCTION': 36,
+    'MONITOR_TRAP_FLAG': 37,
+    'MONITOR_INSTRUCTION': 39,
+    'PAUSE_INSTRUCTION': 40,
+    'MCE_DURING_VMENTRY': 41,
+    'TPR_BELOW_THRESHOLD': 43,
+    'APIC_ACCESS': 44,
+    'EOI_INDUCED': 45,
+    'GDTR_IDTR': 46,
+    'LDTR_TR': 47,
+    'EPT_VIOLATION': 48,
+    'EPT_MISCONFIG': 49,
+    'INVEPT': 50,
+    'RDTSCP': 51,
+    'PREEMPTION_TIMER': 52,
+    'INVVPID': 53,
+    'WBINVD': 54,
+    'XSETBV': 55,
+    'APIC_WRITE': 56,
+    'RDRAND': 57,
+    'INVPCID': 58,
+    'VMFUNC': 59,
+    'ENCLS': 60,
+    'RDSEED': 61,
+    'PML_FULL': 62,
+    'XSAVES': 63,
+    'XRSTORS': 64
+}
+
+def get_exit_reason_code(reason):
+    '''Returns the exit reason code of a kernel exit reason name or number.
+
+    reason: kernel name (e.g. 'HLT') or code in decimal or hex as printed by perf script
+    Returns UNKNOWN_EXIT_REASON if the reason is not known
+    '''
+    try:
+        return KERNEL_EXIT_REASONS[reason]
+    except KeyError:
+        pass
+    try:
+        return int(reason, 0)
+    except (ValueError, TypeError):
+        return UNKNOWN_EXIT_REASON
+
+def get_exit_reason_name(code):
+    '''Returns the display name of an exit reason code (tolerates unknown codes).
+    '''
+    if 0 <= code < len(KVM_EXIT_REASONS):
+        return KVM_EXIT_REASONS[code]
+    return 'unknown'
@@ -0,0 +1,109 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Incremental aggregates for live streaming (perfcap --live)
+#
+# This module only depends on the python standard library so that it can be
+# imported from the perf embedded python interpreter.
+#
+# The perf script handlers feed the events as they are decoded from the
+# perf record pipe and one JSON line is written for every second of trace time:
+#
+# {"time": 12,                                         seconds since the first event
+#  "core_runs": [["nova.vcpu0", 3, 412345, 210], ...],  task, cpu, runtime usec, switches
+#  "kvm_exits": {"HLT": 1002, ...}}                     kvm exit count per reason
+#
+import json
+import socket
+import sys
+
+from kvm_exit_reasons import get_exit_reason_name
+
+# aggregation interval in nsecs
+INTERVAL_NSECS = 1000000000
+
+def open_output(output):
+    '''Open the output stream of the aggregates.
+
+    output: '-' for stdout, <host>:<port> for a TCP socket or the path of a unix socket
+    Returns a file like object
+    '''
+    if output == '-':
+        return sys.stdout
+    if '/' in output:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(output)
+    else:
+        host, port = output.rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+    return sock.makefile('w')
+
+
+class LiveStats(object):
+    '''Per second aggregates of the switch and kvm exit events.
+    '''
+    def __init__(self, output):
+        self.output = open_output(output)
+        self.interval = 0
+        self.next_nsecs = INTERVAL_NSECS
+        self.reset()
+
+    def reset(self):
+        # [runtime, switch count] indexed by (task name, cpu)
+        self.core_runs = {}
+        # kvm exit count indexed by exit reason code
+        self.kvm_exits = {}
+
+    def add(self, name, cpu, nsecs, task_name, duration, reason=None):
+        '''Add one event.
+
+        nsecs: event time since the first event
+        duration: runtime in nsec for a switch event
+        reason: exit reason code for a kvm_exit event
+        '''
+        if nsecs >= self.next_nsecs:
+            self.flush()
+            # skip the intervals without events
+            self.interval = nsecs // INTERVAL_NSECS
+            self.next_nsecs = (self.interval + 1) * INTERVAL_NSECS
+        if name == 'sched__sched_switch':
+            try:
+                run = self.core_runs[(task_name, cpu)]
+                run[0] += duration
+                run[1] += 1
+            except KeyError:
+                self.core_runs[(task_name, cpu)] = [duration, 1]
+        elif name == 'kvm_exit':
+            self.kvm_exits[reason] = self.kvm_exits.get(reason, 0) + 1
+
+    def flush(self):
+        # runtimes are summed in nsec and reported in usec
+        core_runs = [[task_name, cpu, run[0] // 1000, run[1]]
+                     for (task_name, cpu), run in sorted(self.core_runs.iteritems())]
+        kvm_exits = {}
+        for reason, count in self.kvm_exits.iteritems():
+            name = get_exit_reason_name(reason)
+            kvm_exits[name] = kvm_exits.get(name, 0) + count
+        line = json.dumps({'time': self.interval, 'core_runs': core_runs, 'kvm_exits': kvm_exits})
+        self.output.write(line + '\n')
+        self.output.flush()
+        self.reset()
+
+    def close(self):
+        self.flush()
+        if self.output is not sys.stdout:
+            self.output.close()
@@ -5,15 +5,21 @@
 #
 # This script reads a perf binary file (through perf script -s) and generates a cdict file
 # named perf.cdict.
-# The cdict file is a compressed json dump of a python dictionary that contains
+# When the PERFWHIZ_SLICE environment variable is set, the script converts one time slice
+# (perf script --time) of a parallel conversion into the cdict file named by that variable
+# and saves the state needed to stitch the slices together (see perf_slices.py).
+# When the PERFWHIZ_LIVE environment variable is set, no cdict file is created and the
+# events are aggregated every second to the output named by that variable (see live_stats.py).
+# The cdict file is a chunked columnar file (see cdict_format.py) that contains
 # a subset of the perf traces in a form that is ready to be loaded into a pandas dataframe.
 #
 # Functions in this script are also called from mkcdict.py when the python scripting of perf is not compiled in.
 #
+from array import array
+import gc
 import os
 import sys
 from os.path import expanduser
-import re
 
 # Location of the perf python helper files
 try:
@@ -35,19 +41,85 @@ try:
 except ImportError:
     # else fall back to the pure python version (slower)
     from umsgpack import packb
-import zlib
 
-event_name_list = []
-cpu_list = []
-usecs_list = []
-pid_list = []
-comm_list = []
-duration_list = []
-next_pid_list = []
-next_comm_list = []
-
-# a dict of task names indexed by tid
-name_by_tid = {}
+from capture_info import INFO_ENV
+from capture_info import get_info_resolver
+from capture_info import load_capture_info
+from cdict_format import COLUMNS
+from cdict_format import CdictWriter
+from cdict_format import get_offsets
+from cdict_format import TIME_COLUMN
+from cdict_format import TYPECODES
+from live_stats import LiveStats
+from perf_text import PENDING_KVM
+from perf_text import PENDING_SWITCH
+from task_names import TASK_EXEC
+from task_names import TASK_FORK
+from task_names import TaskNameResolver
+
+# Each stored event appends its row straight into the columns of the current chunk:
+# int arrays for the numeric columns (the nsecs are absolute until the chunk is written)
+# and lists of the names appended since the last pack for the event and task name columns.
+# Every PACK_ROWS rows (and before each task event so that the task names are resolved in
+# time order), the task names are resolved, the events are counted and the names
+# are replaced by their string table codes (see pack_records()), so that a row takes about
+# 40 bytes instead of python objects. Full chunks are written to the cdict file while the
+# trace is being processed so that memory usage does not grow with the length of the trace.
+# The arrays are emptied in place after each chunk so that the bound append methods used
+# by the handlers stay valid.
+COLUMN_TYPECODES = dict((name, TYPECODES[encoding]) for name, encoding in COLUMNS)
+cpu_column = array(COLUMN_TYPECODES['cpu'])
+time_column = array(COLUMN_TYPECODES[TIME_COLUMN])
+pid_column = array(COLUMN_TYPECODES['pid'])
+duration_column = array(COLUMN_TYPECODES['duration'])
+next_pid_column = array(COLUMN_TYPECODES['next_pid'])
+# string table codes of the packed rows
+event_codes = array(COLUMN_TYPECODES['event'])
+task_codes = array(COLUMN_TYPECODES['task_name'])
+next_codes = array(COLUMN_TYPECODES['next_comm'])
+# names of the rows appended since the last pack
+event_names = []
+comms = []
+next_comms = []
+add_event = event_names.append
+add_cpu = cpu_column.append
+add_nsecs = time_column.append
+add_pid = pid_column.append
+add_comm = comms.append
+add_duration = duration_column.append
+add_next_pid = next_pid_column.append
+add_next_comm = next_comms.append
+PACK_ROWS = 16 * 1024
+# in live mode the rows are passed to the live aggregates in small batches
+LIVE_PACK_ROWS = 1000
+# number of rows that triggers a pack_records(), set in trace_begin()
+pack_rows = PACK_ROWS
+
+# absolute nsecs of the first stored or kvm event (nsecs 0), None until known
+epoch = None
+
+# the cdict file writer, created in trace_begin()
+cdict_writer = None
+
+# environment variable for the cdict file name of a time slice
+SLICE_ENV = 'PERFWHIZ_SLICE'
+# the slice state file is saved next to the slice cdict file
+STATE_SUFFIX = '.state'
+
+# In slice mode the nsecs are absolute and the rows that depend on the events of
+# the previous slices are stored with a 0 duration and listed in slice_state
+# the task names are not resolved, the task events are listed in slice_state instead
+slice_state = None
+# runtime accumulated on the cpus that did not switch yet in this slice
+slice_runtime_by_cpu = {}
+
+# environment variable for the output of the live aggregates
+LIVE_ENV = 'PERFWHIZ_LIVE'
+# the live aggregates, only in live mode
+live_stats = None
+
+# resolver of the qemu thread names, created in trace_begin()
+resolver = None
 
 # A dict of counts indexed by event name
 # counts how many are being ignored (not counted) in the cdict
@@ -63,24 +135,138 @@ def drop_event(event_name):
     except KeyError:
         event_drops[event_name] = 1
 
-def count_event(event_name):
-    try:
-        event_counts[event_name] += 1
-    except KeyError:
-        event_counts[event_name] = 1
+def resolve_names(tids, names):
+    # final name of each row, each distinct (tid, name) of the pack is resolved once
+    get_task_name = resolver.get_task_name
+    pairs = zip(tids, names)
+    final_names = {}
+    for tid, name in set(pairs):
+        final_names[(tid, name)] = get_task_name(tid, name)
+    return map(final_names.__getitem__, pairs)
+
+def get_name_codes(tids, names):
+    # string table codes of the final name of each row, each distinct (tid, name) is resolved once
+    get_task_name = resolver.get_task_name
+    get_code = cdict_writer.get_code
+    pairs = zip(tids, names)
+    codes = {}
+    for tid, name in set(pairs):
+        codes[(tid, name)] = get_code(get_task_name(tid, name))
+    return map(codes.__getitem__, pairs)
+
+def clear_columns():
+    for column in [cpu_column, time_column, pid_column, duration_column, next_pid_column,
+                   event_codes, task_codes, next_codes]:
+        del column[:]
+
+def flush_chunk():
+    if len(time_column):
+        cdict_writer.write_chunk({'event': event_codes,
+                                  'cpu': cpu_column,
+                                  TIME_COLUMN: get_offsets(time_column, epoch),
+                                  'pid': pid_column,
+                                  'task_name': task_codes,
+                                  'duration': duration_column,
+                                  'next_pid': next_pid_column,
+                                  'next_comm': next_codes})
+        clear_columns()
+
+def pack_records():
+    global epoch
+    if not event_names:
+        return
+    if epoch is None:
+        epoch = time_column[0]
+    for name in set(event_names):
+        event_counts[name] = event_counts.get(name, 0) + event_names.count(name)
+    if live_stats:
+        names = resolve_names(pid_column, comms)
+        # the kvm rows have a 0 next_pid and the exit reason in next_comm (left as is)
+        reasons = resolve_names(next_pid_column, next_comms)
+        for row in zip(event_names, cpu_column, [nsecs - epoch for nsecs in time_column], names,
+                       duration_column, reasons):
+            live_stats.add(*row)
+        clear_columns()
+    else:
+        # first row of this pack in the numeric columns
+        start = len(event_codes)
+        get_codes = cdict_writer.get_codes
+        event_codes.extend(get_codes(event_names))
+        if slice_state is None:
+            task_codes.fromlist(get_name_codes(pid_column[start:], comms))
+            next_codes.fromlist(get_name_codes(next_pid_column[start:], next_comms))
+        else:
+            # in slice mode the names are resolved when the slices are merged
+            task_codes.extend(get_codes(comms))
+            next_codes.extend(get_codes(next_comms))
+    del event_names[:]
+    del comms[:]
+    del next_comms[:]
+    if cdict_writer and len(time_column) >= cdict_writer.chunk_rows:
+        flush_chunk()
+
+def add_pending(kind, key, value):
+    # the pending row is the next row added
+    slice_state['pending'].append([cdict_writer.rows + len(time_column),
+                                   kind, key, value])
+
+def add_task_event(kind, tid, value):
+    if slice_state is not None:
+        # the task event applies to the rows after the row index
+        slice_state['tasks'].append([cdict_writer.rows + len(time_column), kind, tid, value])
+    else:
+        # the names of the rows before the task event are resolved before applying it
+        pack_records()
+        resolver.add_task_events([(kind, tid, value)])
 
 def trace_begin():
-    global plugin_convert_name
+    global resolver
+    global cdict_writer
+    global slice_state
+    global epoch
+    global live_stats
+    global pack_rows
+    # the handlers create no reference cycles, the garbage collector would only keep
+    # scanning the buffered names
+    gc.disable()
+    if LIVE_ENV in os.environ:
+        live_stats = LiveStats(os.environ[LIVE_ENV])
+        pack_rows = LIVE_PACK_ROWS
+        # keep stdout for the aggregates
+        sys.stdout = sys.stderr
+    elif SLICE_ENV in os.environ:
+        cdict_writer = CdictWriter(os.environ[SLICE_ENV])
+        slice_state = {'pending': [], 'tasks': []}
+        epoch = 0
+    else:
+        cdict_writer = CdictWriter('perf.cdict')
+    # the capture information saved by perfcap has everything needed to resolve the task names
+    try:
+        resolver = get_info_resolver(load_capture_info(os.environ[INFO_ENV]))
+        return
+    except (KeyError, IOError):
+        # a snapshot is taken on first use
+        resolver = TaskNameResolver()
     # try to import
     try:
         from mkcdict_plugin import plugin_init
         print 'Initializing plugin...'
         if plugin_init():
             from mkcdict_plugin import plugin_convert_name
+            resolver.convert_name = plugin_convert_name
     except ImportError:
-        plugin_convert_name = None
+        print 'Using default qemu task name mapping (no plugin found)'
+    except ValueError:
+        print 'Using default qemu task name mapping (OpenStack credentials not found)'
 
 def trace_end():
+    if not live_stats:
+        print 'End of trace, encoding and compressing...'
+    # pack the last rows (also counts their events) and write the last partial chunk
+    pack_records()
+    if cdict_writer:
+        flush_chunk()
+    gc.enable()
     # report dropped kvm events
     print 'Dropped events (not stored in cdict file):'
     for name in sorted(event_drops, key=event_drops.get, reverse=True):
@@ -90,118 +276,43 @@ def trace_end():
     for name in sorted(event_counts, key=event_counts.get, reverse=True):
         print '   %6d %s' % (event_counts[name], name)
     print
-    # build cdict
-    res = {'event': event_name_list,
-           'cpu': cpu_list,
-           'usecs': usecs_list,
-           'pid': pid_list,
-           'task_name': comm_list,
-           'duration': duration_list,
-           'next_pid': next_pid_list,
-           'next_comm': next_comm_list}
-    print 'End of trace, marshaling and compressing...'
-    compressed = zlib.compress(packb(res))
-    with open('perf.cdict', 'w') as ff:
-        ff.write(compressed)
-    print 'Compressed dictionary written to perf.cdict %d entries size=%d bytes' % \
-          (len(cpu_list), len(compressed))
-
-uuid_re = re.compile('-uuid ([a-fA-F0-9\-]*)')
-# /proc/pid/cpuset output
-# /machine/instance-000065d7.libvirt-qemu/emulator
-# /machine/instance-000065d3.libvirt-qemu/vcpu0
-cpuset_re = re.compile('/machine/(instance-[a-fA-F0-9]*).libvirt-qemu/(\w*)')
-
-def decode_cpuset(pid):
-    name = None
-    thread_type = None
-    try:
-        with open('/proc/%d/cpuset' % (pid)) as f:
-            cpuset = f.read()
-            res = cpuset_re.match(cpuset)
-            if res:
-                name = res.group(1)
-                thread_type = res.group(2)
-    except IOError:
-        pass
-    return name, thread_type
-
-def decode_pid(pid):
-    name = None
-    uuid = None
-    thread_type = None
-    try:
-        with open('/proc/%d/cmdline' % (pid)) as f:
-            cmdline = f.read()
-            # this is a nul separated tokens
-            cmdline = cmdline.replace('\x00', ' ')
-            if cmdline.startswith('/usr/bin/qemu-system'):
-                res = uuid_re.search(cmdline)
-                if res:
-                    uuid = res.group(1)
-                    name, thread_type = decode_cpuset(pid)
-    except IOError:
-        pass
-    return name, uuid, thread_type
-
-def get_final_name(tid, name):
-    if not tid:
-        return name
-    try:
-        return name_by_tid[tid]
-    except KeyError:
-        pass
-    # check if it is a kvm thread from the look of the name
-    libvirt_name, uuid, thread_type = decode_pid(tid)
-    if libvirt_name:
-        if plugin_convert_name:
-            name = plugin_convert_name(name, tid, libvirt_name, uuid, thread_type)
-        # append the thread type to the name
-        name += '.' + thread_type
-
-    name_by_tid[tid] = name
-    return name
-
-def get_usecs(secs, nsecs):
-    global epoch
-    try:
-        usecs = (secs * 1000000) + (nsecs / 1000) - epoch
-    except NameError:
-        epoch = (secs * 1000000) + (nsecs / 1000)
-        usecs = 0
-    return usecs
-
-def add_event(name, cpu, secs, nsecs, pid, comm, duration=0, next_pid=0, next_comm=None):
-    event_name_list.append(name)
-    cpu_list.append(cpu)
-    usecs_list.append(get_usecs(secs, nsecs))
-    pid_list.append(pid)
-    comm_list.append(get_final_name(pid, comm))
-    # duration in usec
-    duration_list.append(duration / 1000)
-    next_pid_list.append(next_pid)
-    next_comm_list.append(get_final_name(next_pid, next_comm))
-    count_event(name)
-
-def add_kvm_event(name, cpu, secs, nsecs, pid, comm, prev_usecs, reason=None):
-    usecs = get_usecs(secs, nsecs)
-    event_name_list.append(name)
-    cpu_list.append(cpu)
-    usecs_list.append(usecs)
-    pid_list.append(pid)
-    comm_list.append(get_final_name(pid, comm))
-    duration_list.append(usecs - prev_usecs)
-    next_pid_list.append(None)
-    next_comm_list.append(reason)
-    count_event(name)
-    return usecs
+    if live_stats:
+        live_stats.close()
+        return
+    cdict_writer.task_names = resolver.get_name_table()
+    if slice_state is None:
+        # None if there was no event
+        cdict_writer.epoch = epoch
+    size = cdict_writer.close()
+    print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
+          (cdict_writer.filename, cdict_writer.rows, size)
+    if slice_state is not None:
+        slice_state['runtime_by_cpu'] = runtime_by_cpu
+        slice_state['slice_runtime_by_cpu'] = slice_runtime_by_cpu
+        slice_state['kvm_times'] = dict((tid, [kvm_entry_nsecs[slot], kvm_exit_nsecs[slot]])
+                                        for tid, slot in kvm_slots.iteritems())
+        slice_state['drops'] = event_drops
+        with open(cdict_writer.filename + STATE_SUFFIX, 'wb') as ff:
+            ff.write(packb(slice_state))
+
+# The handlers of the stored events append their row inline (no function call per event)
+# the nsecs are absolute until the chunk is written
 
 def sched__sched_stat_sleep(event_name, context, common_cpu,
                             common_secs, common_nsecs, common_pid, common_comm,
                             comm, pid, delay):
     # the delay (time slept) applies to comm/pid
     # not common_comm/common_pid
-    add_event(event_name, common_cpu, common_secs, common_nsecs, pid, comm, delay)
+    add_event(event_name)
+    add_cpu(common_cpu)
+    add_nsecs(common_secs * 1000000000 + common_nsecs)
+    add_pid(pid)
+    add_comm(comm)
+    add_duration(delay)
+    add_next_pid(0)
+    add_next_comm(None)
+    if len(event_names) >= pack_rows:
+        pack_records()
 
 
 def sched__sched_wakeup_new(event_name, context, common_cpu,
@@ -227,7 +338,8 @@ def sched__sched_stat_runtime(event_name, context, common_cpu,
         runtime_by_cpu[common_cpu] += runtime
     except KeyError:
         # the counter is set in on the first sched switch for each cpu
-        pass
+        if slice_state is not None:
+            slice_runtime_by_cpu[common_cpu] = slice_runtime_by_cpu.get(common_cpu, 0) + runtime
 
 def sched__sched_switch(event_name, context, common_cpu,
                         common_secs, common_nsecs, common_pid, common_comm,
@@ -235,79 +347,127 @@ def sched__sched_switch(event_name, context, common_cpu,
                         next_comm, next_pid, next_prio):
     try:
         runtime = runtime_by_cpu[common_cpu]
-        add_event(event_name, common_cpu, common_secs, common_nsecs, prev_pid, prev_comm, runtime, next_pid, next_comm)
     except KeyError:
-        pass
-    runtime_by_cpu[common_cpu] = 0
+        runtime_by_cpu[common_cpu] = 0
+        if slice_state is None:
+            return
+        # the cpu may have switched in a previous slice
+        add_pending(PENDING_SWITCH, common_cpu, slice_runtime_by_cpu.get(common_cpu, 0))
+        runtime = 0
+    else:
+        runtime_by_cpu[common_cpu] = 0
+    add_event(event_name)
+    add_cpu(common_cpu)
+    add_nsecs(common_secs * 1000000000 + common_nsecs)
+    add_pid(prev_pid)
+    add_comm(prev_comm)
+    add_duration(runtime)
+    add_next_pid(next_pid)
+    add_next_comm(next_comm)
+    if len(event_names) >= pack_rows:
+        pack_records()
 
 def sched__sched_stat_iowait(event_name, context, common_cpu,
                              common_secs, common_nsecs, common_pid, common_comm,
                              comm, pid, delay):
-    add_event(event_name, common_cpu, common_secs, common_nsecs, pid, comm, delay)
-
-
-class KvmTime(object):
-    def __init__(self, tid):
-        self.tid = tid
-        # all units are usecs since beginning of traces
-        self.entry_time = 0
-        self.exit_time = 0
-
-    def add_entry(self, cpu, secs, nsecs, comm):
-        if self.exit_time:
-            self.entry_time = add_kvm_event('kvm_entry', cpu, secs, nsecs, self.tid,
-                                            comm, self.exit_time)
-        else:
-            self.entry_time = get_usecs(secs, nsecs)
-
-    def add_exit(self, cpu, secs, nsecs, comm, reason):
-        if self.entry_time:
-            self.exit_time = add_kvm_event('kvm_exit', cpu, secs, nsecs, self.tid,
-                                           comm, self.entry_time, reason)
-        else:
-            self.exit_time = get_usecs(secs, nsecs)
-
-# A dict of last kvm entry/exit time indexed by tid
-kvm_time_dict = {}
+    add_event(event_name)
+    add_cpu(common_cpu)
+    add_nsecs(common_secs * 1000000000 + common_nsecs)
+    add_pid(pid)
+    add_comm(comm)
+    add_duration(delay)
+    add_next_pid(0)
+    add_next_comm(None)
+    if len(event_names) >= pack_rows:
+        pack_records()
+
+# The kvm state of each tid is a slot in the kvm_entry_nsecs/kvm_exit_nsecs lists:
+# absolute nsecs of the last entry/exit of the tid, 0 if none
+# kvm_entry rows have the time spent outside of the vcpu since the last exit,
+# kvm_exit rows have the vcpu run time since the last entry and the exit reason in next_comm
+# As with the nsecs relative to the epoch of the other converters, an entry or exit at the
+# epoch does not count as a previous event
+kvm_slots = {}
+kvm_entry_nsecs = []
+kvm_exit_nsecs = []
+
+def add_kvm_slot(tid, nsecs):
+    global epoch
+    if epoch is None:
+        # the first kvm event sets the epoch unless a row was stored before
+        epoch = time_column[0] if len(time_column) else nsecs
+    slot = kvm_slots[tid] = len(kvm_entry_nsecs)
+    kvm_entry_nsecs.append(0)
+    kvm_exit_nsecs.append(0)
+    return slot
 
 def kvm__kvm_entry(event_name, context, common_cpu,
                    common_secs, common_nsecs, common_pid, common_comm,
                    vcpu_id):
+    nsecs = common_secs * 1000000000 + common_nsecs
     try:
-        kt = kvm_time_dict[common_pid]
-    except:
-        kt = KvmTime(common_pid)
-        kvm_time_dict[common_pid] = kt
-    kt.add_entry(common_cpu, common_secs, common_nsecs, common_comm)
+        slot = kvm_slots[common_pid]
+    except KeyError:
+        slot = add_kvm_slot(common_pid, nsecs)
+    exit_nsecs = kvm_exit_nsecs[slot]
+    kvm_entry_nsecs[slot] = nsecs
+    if exit_nsecs > epoch:
+        duration = nsecs - exit_nsecs
+    elif slice_state is not None:
+        # the last exit may be in a previous slice
+        add_pending(PENDING_KVM, common_pid, False)
+        duration = 0
+    else:
+        return
+    add_event('kvm_entry')
+    add_cpu(common_cpu)
+    add_nsecs(nsecs)
+    add_pid(common_pid)
+    add_comm(common_comm)
+    add_duration(duration)
+    add_next_pid(0)
+    add_next_comm(None)
+    if len(event_names) >= pack_rows:
+        pack_records()
 
 def kvm__kvm_exit(event_name, context, common_cpu,
                   common_secs, common_nsecs, common_pid, common_comm,
                   exit_reason, guest_rip, isa, info1,
                   info2):
+    nsecs = common_secs * 1000000000 + common_nsecs
     try:
-        kt = kvm_time_dict[common_pid]
-    except:
-        kt = KvmTime(common_pid)
-        kvm_time_dict[common_pid] = kt
-    kt.add_exit(common_cpu, common_secs, common_nsecs, common_comm, exit_reason)
+        slot = kvm_slots[common_pid]
+    except KeyError:
+        slot = add_kvm_slot(common_pid, nsecs)
+    entry_nsecs = kvm_entry_nsecs[slot]
+    kvm_exit_nsecs[slot] = nsecs
+    if entry_nsecs > epoch:
+        duration = nsecs - entry_nsecs
+    elif slice_state is not None:
+        # the last entry may be in a previous slice
+        add_pending(PENDING_KVM, common_pid, True)
+        duration = 0
+    else:
+        return
+    add_event('kvm_exit')
+    add_cpu(common_cpu)
+    add_nsecs(nsecs)
+    add_pid(common_pid)
+    add_comm(common_comm)
+    add_duration(duration)
+    add_next_pid(0)
+    add_next_comm(exit_reason)
+    if len(event_names) >= pack_rows:
+        pack_records()
 
 # These are scale down versions of kvm__kvm_entry/exit that only require the minimum arguments
 # used for manual parsing when the perf python extension is not compiled in
 def kvm_entry(common_cpu, common_secs, common_nsecs, common_pid, common_comm):
-    try:
-        kt = kvm_time_dict[common_pid]
-    except:
-        kt = KvmTime(common_pid)
-        kvm_time_dict[common_pid] = kt
-    kt.add_entry(common_cpu, common_secs, common_nsecs, common_comm)
+    kvm__kvm_entry('kvm__kvm_entry', None, common_cpu, common_secs, common_nsecs, common_pid, common_comm, 0)
 
 def kvm_exit(common_cpu, common_secs, common_nsecs, common_pid, common_comm, exit_reason):
-    try:
-        kt = kvm_time_dict[common_pid]
-    except:
-        kt = KvmTime(common_pid)
-        kvm_time_dict[common_pid] = kt
-    kt.add_exit(common_cpu, common_secs, common_nsecs, common_comm, exit_reason)
+    kvm__kvm_exit('kvm__kvm_exit', None, common_cpu, common_secs, common_nsecs, common_pid, common_comm,
+                  exit_reason, 0, 0, 0, 0)
 
 def sched__sched_process_hang(event_name, context, common_cpu,
                               common_secs, common_nsecs, common_pid, common_comm,
@@ -336,12 +496,14 @@ def sched__sched_stat_wait(event_name, context, common_cpu,
 def sched__sched_process_exec(event_name, context, common_cpu,
                               common_secs, common_nsecs, common_pid, common_comm,
                               filename, pid, old_pid):
+    add_task_event(TASK_EXEC, pid, filename)
     drop_event(event_name)
 
 
 def sched__sched_process_fork(event_name, context, common_cpu,
                               common_secs, common_nsecs, common_pid, common_comm,
                               parent_comm, parent_pid, child_comm, child_pid):
+    add_task_event(TASK_FORK, parent_pid, child_pid)
     drop_event(event_name)
 
 
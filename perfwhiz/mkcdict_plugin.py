@@ -21,11 +21,32 @@
 # and extract the type of service and service chain name from the instance name
 # and store the resulting descriptive string in a dictionary indexed by the uuid
 #
+# The dictionary is cached on disk (CACHE_FILE) so that repeated captures do not list
+# all the servers of the cloud every time:
+# - a cache younger than the TTL is used as is (Nova is not contacted)
+# - an older cache is refreshed with only the servers changed since the last refresh
+#   (changes-since query, which also returns the deleted servers)
+# - all the servers are listed if there is no cache or if the changes-since query fails
+#
+# The cache file contains:
+# {"auth_url": "http://...",               the cache is only valid for the same cloud
+#  "saved": 1449000000.0,                   time of the last refresh
+#  "changes_since": "2015-12-01T20:00:00Z", start of the last refresh (UTC)
+#  "names": {uuid: "CSR.01", ...}}
+#
 
 import credentials
+import json
 import os
 import re
-from novaclient.client import Client
+import time
+try:
+    from novaclient.client import Client
+    from novaclient.exceptions import ClientException
+except ImportError:
+    # only a stand-in nova client can be passed to plugin_init()
+    Client = None
+    ClientException = ()
 
 # Config file to specify the OpenStack crendentials needed to connect to the controller
 # The file must contain the rc variable to point to the OpenStack credentials file
@@ -33,6 +54,11 @@ from novaclient.client import Client
 # rc=../admin-oper.sh
 CFG_FILE = '.mkcdict.cfg'
 
+# Cache of the service chain names (in the current directory like the config file)
+CACHE_FILE = '.mkcdict.cache'
+# Default cache TTL in seconds (nova_cache_ttl option)
+CACHE_TTL = 3600
+
 # Extract the VM type and service chain ID from the instance name
 # ESC_Day0-3__68540__MT__MTPerftest-FULL-01ESC_Day0-31.1__0__ASA__0
 # ESC_Day0-3__62940__MT__MTPerftest_FULL_01ESC_Day0-31.1__0__CSR__0
@@ -66,27 +92,92 @@ class OptionsHolder(object):
                         setattr(self, m.group(1), m.group(2))
 
 
-def plugin_init(opts=None):
-    # Parse the credentials of the OpenStack cloud
+def get_full_name(server):
+    chain_id, nvf = decode_instance_name(server.name)
+    if chain_id:
+        return '%s.%02d' % (nvf, chain_id)
+    return None
+
+def load_cache(auth_url):
+    try:
+        with open(CACHE_FILE, 'r') as ff:
+            cache = json.load(ff)
+    except (IOError, ValueError):
+        return None
+    if cache.get('auth_url') != auth_url:
+        return None
+    return cache
+
+def save_cache(cache):
+    # write to a temporary file first so that a concurrent capture never reads a partial file
+    tmp_file = CACHE_FILE + '.tmp'
+    with open(tmp_file, 'w') as ff:
+        json.dump(cache, ff)
+    os.rename(tmp_file, CACHE_FILE)
+
+def list_servers(nova_client, changes_since=None):
+    search_opts = {'all_tenants': 1}
+    if changes_since:
+        search_opts['changes-since'] = changes_since
+    return nova_client.servers.list(detailed=True, search_opts=search_opts)
+
+def plugin_init(opts=None, nova_client=None, auth_url=None):
+    '''Load the service chain names of all the instances.
+
+    nova_client: optional nova client (or a stand-in with the same servers.list() call),
+                 default is to create one from the OpenStack credentials
+    auth_url: cloud of the cache when nova_client is passed (the credentials are then not read)
+    '''
+    if not nova_client and not Client:
+        raise ImportError('novaclient is not installed')
     if not opts:
         opts = OptionsHolder()
-    cred = credentials.Credentials(opts)
-    creds_nova = cred.get_nova_credentials_v2()
-    # Create the nova and neutron instances
-    nova_client = Client(**creds_nova)
-
-    opts = {'all_tenants': 1}
-    servers = nova_client.servers.list(detailed=True, search_opts=opts)
-    count = 0
+    cred = None
+    if not nova_client:
+        # Parse the credentials of the OpenStack cloud
+        cred = credentials.Credentials(opts)
+        auth_url = cred.rc_auth_url
+    ttl = int(getattr(opts, 'nova_cache_ttl', None) or CACHE_TTL)
+    cache = load_cache(auth_url)
+    if cache and time.time() - cache['saved'] < ttl:
+        by_uuid.update(cache['names'])
+        print 'Plugin loaded with %d service chain names from %s' % (len(cache['names']), CACHE_FILE)
+        return True
+    if not nova_client:
+        creds_nova = cred.get_nova_credentials_v2()
+        # Create the nova and neutron instances
+        nova_client = Client(**creds_nova)
+
+    # the next refresh starts from the time of this query (changes-since is inclusive)
+    now = time.time()
+    servers = None
+    if cache:
+        try:
+            servers = list_servers(nova_client, cache['changes_since'])
+            names = cache['names']
+        except ClientException as exc:
+            print 'Cannot list the changed servers (%s), listing all servers' % (exc)
+    if servers is None:
+        servers = list_servers(nova_client)
+        names = {}
     for server in servers:
-        chain_id, nvf = decode_instance_name(server.name)
-        if chain_id:
-            full_name = '%s.%02d' % (nvf, chain_id)
-            by_uuid[server.id] = full_name
-            count += 1
-    print 'Plugin loaded with %d service chain names from Nova' % (count)
+        full_name = get_full_name(server)
+        if full_name and getattr(server, 'status', None) != 'DELETED':
+            names[server.id] = full_name
+        else:
+            names.pop(server.id, None)
+    save_cache({'auth_url': auth_url,
+                'saved': now,
+                'changes_since': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now)),
+                'names': names})
+    by_uuid.update(names)
+    print 'Plugin loaded with %d service chain names from Nova (%d servers listed)' % (len(names), len(servers))
     return True
 
+def plugin_get_instance_name(uuid):
+    # returns the service chain name of an instance uuid or None (does not change by_uuid)
+    return by_uuid.get(uuid)
+
 def plugin_convert_name(name, tid, libvirt_name, uuid, thread_type):
     try:
         return by_uuid[uuid]
@@ -0,0 +1,691 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Native reader for perf.data files (does not require perf or the perf python extension)
+#
+# Only supports what perfcap records: tracepoint samples (perf record -a -e sched:* -e kvm:*
+# or a subset, see capture_profiles.py)
+# in a little endian perf.data file.
+# The sample records of the tracepoints used by the cdict file are located with
+# a single pass over the record headers, then all fields are decoded in bulk with numpy
+# and the stateful processing of the perf script handlers (runtime aggregation per cpu,
+# kvm entry/exit pairing per tid) is done with vectorized operations on the time sorted events.
+# The task events (fork, exec) are applied to the task name resolver in time order, the
+# names of the rows of a tid before one of its task events are resolved before applying it
+# (see task_names.py).
+# Lost event records (perf could not keep up and dropped events from a cpu ring buffer)
+# are reported as [cpu, from_ns, to_ns, count] ranges: the runtime of the context switches
+# and the duration of the kvm entry/exit pairs that span a lost range are not reliable.
+#
+import mmap
+import re
+import struct
+
+import numpy as np
+
+from cdict_format import CdictWriter
+from cdict_format import read_trailer
+from cdict_format import update_trailer
+from task_names import TASK_EXEC
+from task_names import TASK_FORK
+from task_names import get_event_tid
+
+PERF_MAGIC = 'PERFILE2'
+
+# struct perf_file_header (without the magic): size, attr_size, attrs, data, event_types
+FILE_HEADER = struct.Struct('<QQQQQQQQ')
+# feature bitmap (256 bits)
+FEATURES = struct.Struct('<4Q')
+HEADER_TRACING_DATA = 1
+# struct perf_file_section
+FILE_SECTION = struct.Struct('<QQ')
+# struct perf_event_header
+EVENT_HEADER = struct.Struct('<IHH')
+# type and sample_type in struct perf_event_attr
+ATTR_TYPE = struct.Struct('<I')
+ATTR_SAMPLE_TYPE = struct.Struct('<Q')
+ATTR_SAMPLE_TYPE_OFFSET = 24
+# flags in struct perf_event_attr
+ATTR_FLAGS = struct.Struct('<Q')
+ATTR_FLAGS_OFFSET = 40
+# all records have the sample id fields at their end
+ATTR_SAMPLE_ID_ALL = 1 << 18
+PERF_TYPE_TRACEPOINT = 2
+
+# record types
+PERF_RECORD_LOST = 2
+PERF_RECORD_COMM = 3
+PERF_RECORD_SAMPLE = 9
+PERF_RECORD_LOST_SAMPLES = 13
+
+# sample_type bits
+PERF_SAMPLE_IP = 1 << 0
+PERF_SAMPLE_TID = 1 << 1
+PERF_SAMPLE_TIME = 1 << 2
+PERF_SAMPLE_ADDR = 1 << 3
+PERF_SAMPLE_READ = 1 << 4
+PERF_SAMPLE_CALLCHAIN = 1 << 5
+PERF_SAMPLE_ID = 1 << 6
+PERF_SAMPLE_CPU = 1 << 7
+PERF_SAMPLE_PERIOD = 1 << 8
+PERF_SAMPLE_STREAM_ID = 1 << 9
+PERF_SAMPLE_RAW = 1 << 10
+PERF_SAMPLE_IDENTIFIER = 1 << 16
+
+TRACING_MAGIC = '\027\010\104tracing'
+
+# field:char prev_comm[16];	offset:8;	size:16;	signed:1;
+field_re = re.compile(r'\s*field:(.*?)\s+(\w+)(\[\w*\])?;\s*offset:(\d+);\s*size:(\d+);\s*signed:(\d+);')
+name_re = re.compile(r'name: (\w+)')
+id_re = re.compile(r'ID: (\d+)')
+
+# tracepoints used to build the cdict and the raw fields needed for each
+TRACEPOINTS = {
+    'sched:sched_switch': ['prev_comm', 'prev_pid', 'next_comm', 'next_pid'],
+    'sched:sched_stat_runtime': ['runtime'],
+    'sched:sched_stat_sleep': ['comm', 'pid', 'delay'],
+    'sched:sched_stat_iowait': ['comm', 'pid', 'delay'],
+    'kvm:kvm_entry': [],
+    'kvm:kvm_exit': ['exit_reason'],
+    'sched:sched_process_fork': ['parent_pid', 'child_pid'],
+    'sched:sched_process_exec': ['filename', 'pid']
+}
+
+# max number of rows gathered at once (bounds the size of the gather index arrays)
+GATHER_ROWS = 1024 * 1024
+
+
+class TraceFormat(object):
+    '''Layout of the raw data of one tracepoint.
+    '''
+    def __init__(self, system, text):
+        self.name = system + ':' + name_re.search(text).group(1)
+        self.id = int(id_re.search(text).group(1))
+        # a dict of (offset, size, signed, is_string) indexed by field name
+        self.fields = {}
+        # the non common field names in format order (the perf script handler arguments)
+        self.arg_names = []
+        # the names of the __data_loc (variable length string) fields
+        self.data_locs = set()
+        for line in text.split('\n'):
+            m = field_re.match(line)
+            if m:
+                ftype, fname, array_len, offset, size, signed = m.groups()
+                is_string = bool(array_len) and ftype.endswith('char')
+                self.fields[fname] = (int(offset), int(size), signed == '1', is_string)
+                if not fname.startswith('common_'):
+                    self.arg_names.append(fname)
+                if ftype.startswith('__data_loc'):
+                    self.data_locs.add(fname)
+
+def read_cstring(data, offset):
+    end = data.find('\0', offset)
+    return data[offset:end], end + 1
+
+def parse_tracing_data(data, offset):
+    '''Parse the HEADER_TRACING_DATA feature section.
+
+    Returns a dict of TraceFormat indexed by tracepoint id
+    '''
+    if data[offset:offset + len(TRACING_MAGIC)] != TRACING_MAGIC:
+        raise ValueError('Invalid tracing data section')
+    offset += len(TRACING_MAGIC)
+    _, offset = read_cstring(data, offset)
+    big_endian, _ = struct.unpack_from('BB', data, offset)
+    if big_endian:
+        raise ValueError('Big endian perf data files are not supported')
+    offset += 2 + 4
+    # header_page and header_event
+    for _ in range(2):
+        _, offset = read_cstring(data, offset)
+        size = struct.unpack_from('<Q', data, offset)[0]
+        offset += 8 + size
+    # ftrace formats
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    for _ in range(count):
+        size = struct.unpack_from('<Q', data, offset)[0]
+        offset += 8 + size
+    # event formats per system
+    formats = {}
+    systems = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    for _ in range(systems):
+        system, offset = read_cstring(data, offset)
+        count = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        for _ in range(count):
+            size = struct.unpack_from('<Q', data, offset)[0]
+            offset += 8
+            fmt = TraceFormat(system, data[offset:offset + size])
+            formats[fmt.id] = fmt
+            offset += size
+    return formats
+
+
+class PerfDataFile(object):
+    '''A memory mapped perf.data file.
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as ff:
+            self.data = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+        if data[:len(PERF_MAGIC)] != PERF_MAGIC:
+            raise ValueError('Not a perf.data file or unsupported perf.data format: ' + filename)
+        (_, attr_size, attrs_offset, attrs_size, self.data_offset, self.data_size,
+         _, _) = FILE_HEADER.unpack_from(data, len(PERF_MAGIC))
+        features = FEATURES.unpack_from(data, len(PERF_MAGIC) + FILE_HEADER.size)
+        # all the attrs must have the same sample type
+        sample_types = set()
+        self.sample_id_all = False
+        for offset in range(attrs_offset, attrs_offset + attrs_size, attr_size):
+            if ATTR_TYPE.unpack_from(data, offset)[0] == PERF_TYPE_TRACEPOINT:
+                sample_types.add(ATTR_SAMPLE_TYPE.unpack_from(data, offset + ATTR_SAMPLE_TYPE_OFFSET)[0])
+                flags = ATTR_FLAGS.unpack_from(data, offset + ATTR_FLAGS_OFFSET)[0]
+                self.sample_id_all = bool(flags & ATTR_SAMPLE_ID_ALL)
+        if len(sample_types) != 1:
+            raise ValueError('perf.data file must have tracepoints with the same sample type')
+        self.sample_type = sample_types.pop()
+        self.formats = {}
+        if features[0] & (1 << HEADER_TRACING_DATA):
+            # the feature sections follow the data section, in feature bit order
+            # tracing data is the first feature after the reserved bit 0
+            offset, _ = FILE_SECTION.unpack_from(data, self.data_offset + self.data_size)
+            self.formats = parse_tracing_data(data, offset)
+        if not self.formats:
+            raise ValueError('perf.data file has no tracing data')
+
+    def get_sample_layout(self):
+        # returns the offsets of the time, cpu and raw data in a sample record
+        # (all relative to the beginning of the record)
+        sample_type = self.sample_type
+        if sample_type & (PERF_SAMPLE_READ | PERF_SAMPLE_CALLCHAIN):
+            raise ValueError('Unsupported sample type (read values or callchain)')
+        for required in [PERF_SAMPLE_TIME, PERF_SAMPLE_CPU, PERF_SAMPLE_RAW]:
+            if not sample_type & required:
+                raise ValueError('Samples need time, cpu and raw data')
+        offset = EVENT_HEADER.size
+        layout = {}
+        for bit, name in [(PERF_SAMPLE_IDENTIFIER, None),
+                          (PERF_SAMPLE_IP, None),
+                          (PERF_SAMPLE_TID, None),
+                          (PERF_SAMPLE_TIME, 'time'),
+                          (PERF_SAMPLE_ADDR, None),
+                          (PERF_SAMPLE_ID, None),
+                          (PERF_SAMPLE_STREAM_ID, None),
+                          (PERF_SAMPLE_CPU, 'cpu'),
+                          (PERF_SAMPLE_PERIOD, None)]:
+            if sample_type & bit:
+                if name:
+                    layout[name] = offset
+                offset += 8
+        # skip the raw data size
+        layout['raw'] = offset + 4
+        return layout
+
+    def get_sample_id_layout(self):
+        # returns the offsets of the time and cpu in the sample id fields at the end of
+        # the non sample records (relative to the end of the record), None if there are none
+        if not self.sample_id_all:
+            return None
+        back = 0
+        layout = {}
+        for bit, name in [(PERF_SAMPLE_IDENTIFIER, None),
+                          (PERF_SAMPLE_CPU, 'cpu'),
+                          (PERF_SAMPLE_STREAM_ID, None),
+                          (PERF_SAMPLE_ID, None),
+                          (PERF_SAMPLE_TIME, 'time'),
+                          (PERF_SAMPLE_TID, None)]:
+            if self.sample_type & bit:
+                back += 8
+                if name:
+                    layout[name] = back
+        if len(layout) != 2:
+            return None
+        return layout
+
+    def scan(self):
+        '''Scan all the record headers.
+
+        Returns an array of sample record offsets,
+        a dict of the last task name (comm) indexed by tid
+        and the list of lost event record offsets
+        '''
+        data = self.data
+        unpack_from = EVENT_HEADER.unpack_from
+        samples = []
+        comm_by_tid = {}
+        lost = []
+        offset = self.data_offset
+        end = self.data_offset + self.data_size
+        while offset < end:
+            rtype, _, size = unpack_from(data, offset)
+            if rtype == PERF_RECORD_SAMPLE:
+                samples.append(offset)
+            elif rtype == PERF_RECORD_COMM:
+                # u32 pid, u32 tid, char comm[]
+                tid = struct.unpack_from('<I', data, offset + 12)[0]
+                comm_by_tid[tid] = read_cstring(data, offset + 16)[0]
+            elif rtype == PERF_RECORD_LOST or rtype == PERF_RECORD_LOST_SAMPLES:
+                lost.append(offset)
+            if not size:
+                raise ValueError('Corrupted perf.data file (null record size at %d)' % (offset))
+            offset += size
+        return np.array(samples, dtype=np.int64), comm_by_tid, lost
+
+    def get_time_range(self):
+        # returns the time in ns of the first and last samples (None if no sample)
+        records = self.scan()[0]
+        if not len(records):
+            return None, None
+        buf = np.frombuffer(self.data, dtype=np.uint8)
+        times = read_ints(buf, records + self.get_sample_layout()['time'], 8)
+        return int(times.min()), int(times.max())
+
+    def get_lost_events(self, lost_records, records):
+        '''Returns the list of [cpu, from_ns, to_ns, count] lost event ranges.
+
+        lost_records: the lost event record offsets returned by scan()
+        records: the sample record offsets returned by scan()
+        A lost range goes from the last sample on the same cpu to the time of the lost
+        record. When the records have no sample id (cpu and time), the cpu is -1 and
+        the range covers the whole trace.
+        '''
+        if not lost_records:
+            return []
+        data = self.data
+        buf = np.frombuffer(data, dtype=np.uint8)
+        layout = self.get_sample_layout()
+        times = read_ints(buf, records + layout['time'], 8)
+        cpus = read_ints(buf, records + layout['cpu'], 4)
+        id_layout = self.get_sample_id_layout()
+        # sorted sample times of each cpu
+        cpu_times = {}
+        if id_layout:
+            for cpu in np.unique(cpus):
+                cpu_times[cpu] = np.sort(times[cpus == cpu])
+        first = int(times.min()) if len(times) else 0
+        last = int(times.max()) if len(times) else 0
+        lost = []
+        for offset in lost_records:
+            rtype, _, size = EVENT_HEADER.unpack_from(data, offset)
+            # PERF_RECORD_LOST has a u64 id before the u64 count
+            count_offset = offset + EVENT_HEADER.size + (8 if rtype == PERF_RECORD_LOST else 0)
+            count = struct.unpack_from('<Q', data, count_offset)[0]
+            if not id_layout:
+                lost.append([-1, first, last, count])
+                continue
+            end = offset + size
+            to_ns = struct.unpack_from('<Q', data, end - id_layout['time'])[0]
+            cpu = struct.unpack_from('<I', data, end - id_layout['cpu'])[0]
+            before = cpu_times.get(cpu, times[:0])
+            index = np.searchsorted(before, to_ns, 'right')
+            from_ns = int(before[index - 1]) if index else first
+            lost.append([cpu, from_ns, to_ns, count])
+        return lost
+
+def gather(buf, positions, size):
+    # returns a (len(positions), size) array of the bytes at each position
+    res = np.empty((len(positions), size), dtype=np.uint8)
+    span = np.arange(size)
+    for start in range(0, len(positions), GATHER_ROWS):
+        chunk = positions[start:start + GATHER_ROWS]
+        res[start:start + len(chunk)] = buf[chunk[:, None] + span]
+    return res
+
+def read_ints(buf, positions, size, signed=False):
+    dtype = ('<i%d' if signed else '<u%d') % (size)
+    return gather(buf, positions, size).view(dtype)[:, 0].astype(np.int64)
+
+def read_strings(buf, positions, size):
+    # returns a list of unique strings and the index of each row in that list
+    values = gather(buf, positions, size).view('S%d' % (size))[:, 0]
+    uniques, inverse = np.unique(values, return_inverse=True)
+    # the bytes after the nul character are not always cleared by the kernel
+    return [value.split('\0', 1)[0] for value in uniques], inverse
+
+def read_data_locs(data, raw_positions, locs):
+    # a __data_loc field holds the offset (low 16 bits) and the size of a string in the raw data
+    return [data[pos + (loc & 0xffff):pos + (loc & 0xffff) + (loc >> 16)].split('\0', 1)[0]
+            for pos, loc in zip(raw_positions.tolist(), locs.tolist())]
+
+def get_previous(group_starts, positions):
+    # for each row of a grouped array, the position of the previous row in the same group
+    # positions holds the row position for candidate rows and -1 for other rows
+    last = np.maximum.accumulate(positions)
+    previous = np.empty_like(last)
+    previous[0] = -1
+    previous[1:] = last[:-1]
+    previous[previous < group_starts] = -1
+    return previous
+
+def get_loss_mask(lost_times, starts, ends):
+    # for each (start, end] interval, True if it contains a lost event time
+    lost_times = np.sort(lost_times)
+    return np.searchsorted(lost_times, starts, 'right') < np.searchsorted(lost_times, ends, 'right')
+
+def get_group_starts(keys):
+    # keys must be sorted, returns for each row the position of the first row with the same key
+    starts = np.zeros(len(keys), dtype=np.int64)
+    if len(keys):
+        changes = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        starts[changes] = changes
+    return np.maximum.accumulate(starts)
+
+# factor of the tid in the (tid, row) keys of the task events (rows < 2**32)
+ROW_FACTOR = 1 << 32
+
+class NameTable(object):
+    '''Table of final task names, each name is resolved once per unique (tid, generation, comm).
+
+    The generation of a row is the number of task events of its tid before the row: the names
+    of a generation are resolved just before the next task event of the tid is applied.
+    '''
+    def __init__(self, resolver=None, tasks=None):
+        '''
+        resolver: optional TaskNameResolver
+        tasks: list of (row, kind, tid, value) of the task events sorted by row
+        '''
+        self.resolver = resolver
+        self.tasks = tasks or []
+        # tid * ROW_FACTOR + row of the task events, sorted
+        self.task_keys = np.sort(np.array([get_event_tid(kind, tid, value) * ROW_FACTOR + row
+                                           for row, kind, tid, value in self.tasks], dtype=np.int64))
+        # code 0 is for missing names
+        self.keys = [None]
+        self.key_codes = {None: 0}
+
+    def get_generations(self, tids, rows):
+        # number of task events of each tid before each row
+        starts = np.searchsorted(self.task_keys, tids * ROW_FACTOR)
+        return np.searchsorted(self.task_keys, tids * ROW_FACTOR + rows) - starts
+
+    def get_codes(self, tids, comms, inverse, rows):
+        '''Returns the key code of each row (see get_names()).
+
+        tids: array of tids
+        comms: list of unique raw task names
+        inverse: array of indexes in comms for each row
+        rows: array of row indexes (in time order)
+        '''
+        tids = np.asarray(tids, dtype=np.int64)
+        generations = self.get_generations(tids, rows)
+        key_factor = len(comms) * (len(self.tasks) + 1)
+        keys, key_inverse = np.unique(tids * key_factor + generations * len(comms) + inverse,
+                                      return_inverse=True)
+        codes = []
+        for key in keys:
+            tid, remainder = divmod(int(key), key_factor)
+            generation, comm_index = divmod(remainder, len(comms))
+            key = (tid, generation, comms[comm_index])
+            try:
+                codes.append(self.key_codes[key])
+            except KeyError:
+                self.key_codes[key] = len(self.keys)
+                codes.append(len(self.keys))
+                self.keys.append(key)
+        return np.array(codes, dtype=np.int64)[key_inverse]
+
+    def get_names(self):
+        '''Returns the final name of each key code, the task events are applied in time order.
+        '''
+        names = [None] * len(self.keys)
+        pending = {}
+        for code, key in enumerate(self.keys):
+            if key is not None:
+                pending.setdefault(key[:2], []).append(code)
+
+        def resolve(tid, generation):
+            for code in pending.pop((tid, generation), []):
+                name = self.keys[code][2]
+                if self.resolver and tid:
+                    name = self.resolver.get_task_name(tid, name)
+                names[code] = name
+        generations = {}
+        for _, kind, tid, value in self.tasks:
+            event_tid = get_event_tid(kind, tid, value)
+            generation = generations.get(event_tid, 0)
+            resolve(event_tid, generation)
+            generations[event_tid] = generation + 1
+            self.resolver.add_task_events([(kind, tid, value)])
+        for tid, generation in sorted(pending):
+            resolve(tid, generation)
+        return names
+
+def get_lost_nsecs(lost, epoch):
+    # make the lost event ranges relative to the epoch of a cdict file
+    return [[cpu, from_ns - epoch, to_ns - epoch, count]
+            for cpu, from_ns, to_ns, count in lost]
+
+def add_lost_events(perf_data_filename, cdict_filename):
+    '''Store the lost events of a perf.data file into the cdict file converted from it.
+
+    The perf script handlers never see the lost event records, the cdict file must have an epoch.
+    Returns the list of lost events
+    '''
+    pdf = PerfDataFile(perf_data_filename)
+    records, _, lost_records = pdf.scan()
+    lost = pdf.get_lost_events(lost_records, records)
+    with open(cdict_filename, 'rb') as ff:
+        epoch = read_trailer(ff)[0].get('epoch')
+    if lost and epoch is not None:
+        update_trailer(cdict_filename, lost=get_lost_nsecs(lost, epoch))
+    return lost
+
+def convert_perf_data(perf_data_filename, cdict_filename, resolver=None):
+    '''Convert a perf.data file into a cdict file without perf.
+
+    resolver: optional TaskNameResolver to resolve the final task name of the tids
+    Returns the number of events stored in the cdict file
+    '''
+    pdf = PerfDataFile(perf_data_filename)
+    layout = pdf.get_sample_layout()
+    print 'Scanning %s...' % (perf_data_filename)
+    records, comm_by_tid, lost_records = pdf.scan()
+    lost = pdf.get_lost_events(lost_records, records)
+    # lost event times indexed by cpu (lost records without cpu and time cannot be placed)
+    lost_by_cpu = {}
+    for cpu, _, to_ns, _ in lost:
+        if cpu >= 0:
+            lost_by_cpu.setdefault(cpu, []).append(to_ns)
+    if lost:
+        print 'WARNING: %d events lost in %d ranges (perf record could not keep up, try a larger --mmap)' % \
+              (sum(count for _, _, _, count in lost), len(lost))
+    buf = np.frombuffer(pdf.data, dtype=np.uint8)
+    raw = records + layout['raw']
+
+    # find the tracepoint of each sample
+    types = read_ints(buf, raw, 2)
+    formats = dict((fmt.name, fmt) for fmt in pdf.formats.values() if fmt.name in TRACEPOINTS)
+    selected = np.in1d(types, [fmt.id for fmt in formats.values()])
+    print 'Decoding %d samples out of %d...' % (np.count_nonzero(selected), len(records))
+    records = records[selected]
+    raw = raw[selected]
+    types = types[selected]
+    # sort all events by time (samples are not in time order across cpus in the perf.data file)
+    times = read_ints(buf, records + layout['time'], 8)
+    order = np.argsort(times, kind='mergesort')
+    records = records[order]
+    raw = raw[order]
+    types = types[order]
+    times = times[order]
+    count = len(records)
+    cpus = read_ints(buf, records + layout['cpu'], 4)
+    common_pids = read_ints(buf, raw + 4, 4, True)
+
+
+    event_names = np.empty(count, dtype=object)
+    keep = np.zeros(count, dtype=bool)
+    pids = np.zeros(count, dtype=np.int64)
+    task_codes = np.zeros(count, dtype=np.int64)
+    durations = np.zeros(count, dtype=np.int64)
+    next_pids = np.zeros(count, dtype=np.int64)
+    next_codes = np.zeros(count, dtype=np.int64)
+    # next_comm holds the exit reason for kvm_exit events
+    next_reasons = np.zeros(count, dtype=np.int64)
+    is_reason = np.zeros(count, dtype=bool)
+
+    def get_rows(name):
+        if name in formats:
+            return np.flatnonzero(types == formats[name].id)
+        return np.empty(0, dtype=np.int64)
+
+    def read_field(tp_name, rows, field):
+        offset, size, signed, is_string = formats[tp_name].fields[field]
+        if is_string:
+            return read_strings(buf, raw[rows] + offset, size)
+        return read_ints(buf, raw[rows] + offset, size, signed)
+
+    if resolver:
+        # (row, kind, tid, value) of all the task events
+        tasks = []
+        rows = get_rows('sched:sched_process_fork')
+        if len(rows):
+            tasks.extend(zip(rows.tolist(), [TASK_FORK] * len(rows),
+                             read_field('sched:sched_process_fork', rows, 'parent_pid').tolist(),
+                             read_field('sched:sched_process_fork', rows, 'child_pid').tolist()))
+        rows = get_rows('sched:sched_process_exec')
+        if len(rows):
+            tasks.extend(zip(rows.tolist(), [TASK_EXEC] * len(rows),
+                             read_field('sched:sched_process_exec', rows, 'pid').tolist(),
+                             read_data_locs(pdf.data, raw[rows],
+                                            read_field('sched:sched_process_exec', rows, 'filename'))))
+        tasks.sort(key=lambda task: task[0])
+        names = NameTable(resolver, tasks)
+    else:
+        names = NameTable()
+
+    # sched_stat_sleep and sched_stat_iowait: the delay applies to pid/comm
+    for tp_name in ['sched:sched_stat_sleep', 'sched:sched_stat_iowait']:
+        rows = get_rows(tp_name)
+        if len(rows):
+            event_names[rows] = tp_name.replace(':', '__')
+            keep[rows] = True
+            pids[rows] = read_field(tp_name, rows, 'pid')
+            comms, inverse = read_field(tp_name, rows, 'comm')
+            task_codes[rows] = names.get_codes(pids[rows], comms, inverse, rows)
+            durations[rows] = read_field(tp_name, rows, 'delay')
+
+    # sched_switch: runtime accumulated per cpu since the previous switch on the same cpu
+    # the first switch on each cpu starts the counter and is not stored
+    sw_rows = get_rows('sched:sched_switch')
+    rt_rows = get_rows('sched:sched_stat_runtime')
+    if len(sw_rows):
+        rows = np.concatenate([sw_rows, rt_rows])
+        rows.sort()
+        is_switch = types[rows] == formats['sched:sched_switch'].id
+        runtimes = np.zeros(len(rows), dtype=np.int64)
+        if len(rt_rows):
+            runtimes[~is_switch] = read_field('sched:sched_stat_runtime', rows[~is_switch], 'runtime')
+        # group by cpu, keeping the time order within each cpu
+        by_cpu = np.argsort(cpus[rows], kind='mergesort')
+        rows = rows[by_cpu]
+        is_switch = is_switch[by_cpu]
+        cumulated = np.cumsum(runtimes[by_cpu])
+        group_starts = get_group_starts(cpus[rows])
+        positions = np.where(is_switch, np.arange(len(rows)), -1)
+        previous = get_previous(group_starts, positions)
+        emit = is_switch & (previous >= 0)
+        # sum of the runtimes between the previous switch (excluded) and this switch
+        runtime = cumulated[emit] - cumulated[previous[emit]]
+        # the runtime is unknown if events were lost on that cpu since the previous switch
+        previous_times = times[rows[previous[emit]]]
+        rows = rows[emit]
+        for cpu, lost_times in lost_by_cpu.items():
+            on_cpu = np.flatnonzero(cpus[rows] == cpu)
+            runtime[on_cpu[get_loss_mask(lost_times, previous_times[on_cpu], times[rows[on_cpu]])]] = 0
+        event_names[rows] = 'sched__sched_switch'
+        keep[rows] = True
+        pids[rows] = read_field('sched:sched_switch', rows, 'prev_pid')
+        comms, inverse = read_field('sched:sched_switch', rows, 'prev_comm')
+        task_codes[rows] = names.get_codes(pids[rows], comms, inverse, rows)
+        durations[rows] = runtime
+        next_pids[rows] = read_field('sched:sched_switch', rows, 'next_pid')
+        comms, inverse = read_field('sched:sched_switch', rows, 'next_comm')
+        next_codes[rows] = names.get_codes(next_pids[rows], comms, inverse, rows)
+
+    # kvm_entry/kvm_exit: duration since the last event of the other type for the same tid
+    entry_rows = get_rows('kvm:kvm_entry')
+    exit_rows = get_rows('kvm:kvm_exit')
+    rows = np.concatenate([entry_rows, exit_rows])
+    rows.sort()
+    # same epoch as the perf script handler: the first stored or kvm event
+    nsecs = times.copy()
+    stamped = keep.copy()
+    stamped[rows] = True
+    epoch = None
+    if stamped.any():
+        epoch = int(nsecs[np.argmax(stamped)])
+        nsecs -= epoch
+    if len(rows):
+        by_tid = np.argsort(common_pids[rows], kind='mergesort')
+        rows = rows[by_tid]
+        is_exit = np.in1d(rows, exit_rows)
+        group_starts = get_group_starts(common_pids[rows])
+        index = np.arange(len(rows))
+        previous_exit = get_previous(group_starts, np.where(is_exit, index, -1))
+        previous_entry = get_previous(group_starts, np.where(is_exit, -1, index))
+        previous = np.where(is_exit, previous_entry, previous_exit)
+        # same as the perf script handler: a time of 0 means no previous event
+        emit = previous >= 0
+        emit[emit] = nsecs[rows[previous[emit]]] > 0
+        # a vcpu thread can run on any cpu: drop the pairs that span any lost range
+        lost_times = [to_ns for cpu_times in lost_by_cpu.values() for to_ns in cpu_times]
+        if lost_times:
+            emit[emit] = ~get_loss_mask(lost_times, times[rows[previous[emit]]], times[rows[emit]])
+        durations[rows[emit]] = nsecs[rows[emit]] - nsecs[rows[previous[emit]]]
+        is_exit = is_exit[emit]
+        rows = rows[emit]
+        keep[rows] = True
+        event_names[rows] = np.where(is_exit, 'kvm_exit', 'kvm_entry')
+        pids[rows] = common_pids[rows]
+        tids = common_pids[rows]
+        comms = sorted(set(comm_by_tid.get(tid, ':%d' % tid) for tid in np.unique(tids)))
+        comm_index = dict((comm, index) for index, comm in enumerate(comms))
+        inverse = np.array([comm_index[comm_by_tid.get(tid, ':%d' % tid)] for tid in tids], dtype=np.int64)
+        task_codes[rows] = names.get_codes(tids, comms, inverse, rows)
+        exit_rows = rows[is_exit]
+        if len(exit_rows):
+            next_reasons[exit_rows] = read_field('kvm:kvm_exit', exit_rows, 'exit_reason')
+            is_reason[exit_rows] = True
+
+    names = np.array(names.get_names(), dtype=object)
+    next_comms = names[next_codes]
+    next_comms[is_reason] = next_reasons[is_reason]
+    res = {'event': event_names[keep],
+           'cpu': cpus[keep],
+           'nsecs': nsecs[keep],
+           'pid': pids[keep],
+           'task_name': names[task_codes[keep]],
+           'duration': durations[keep],
+           'next_pid': next_pids[keep],
+           'next_comm': next_comms[keep]}
+    print 'Events stored in cdict file:'
+    stored, counts = np.unique(res['event'].astype(str), return_counts=True)
+    for index in np.argsort(-counts):
+        print '   %6d %s' % (counts[index], stored[index])
+    writer = CdictWriter(cdict_filename)
+    if resolver:
+        writer.task_names = resolver.get_name_table()
+    writer.epoch = epoch
+    if epoch is not None:
+        writer.lost = get_lost_nsecs(lost, epoch)
+    writer.write_columns(res)
+    size = writer.close()
+    print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
+          (cdict_filename, writer.rows, size)
+    return writer.rows
@@ -0,0 +1,159 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Parallel conversion of a perf.data file in time slices
+#
+# The time range of the perf.data file is split into N slices that are converted
+# concurrently by N "perf script --time" processes running mkcdict_perf_script.py
+# in slice mode. Each slice produces a cdict file with absolute nsecs and a state
+# file with its pending rows (first switch of each cpu, first kvm entry/exit of each tid)
+# and its end state (per cpu runtime counters, per tid kvm times).
+# The slices are then merged in time order the same way as the ranges of a perf
+# script text file (see perf_text.py), which also applies the epoch of the first slice
+# to all slices and resolves the task names.
+# The slice cdict files are read one chunk at a time so that merging does not hold
+# a whole slice in memory: a first pass finds the times needed to resolve the pending
+# rows, a second pass merges the rows.
+#
+import os
+import subprocess
+
+try:
+    # try to use the faster version if available
+    from msgpack import unpackb
+except ImportError:
+    # else fall back to the pure python version (slower)
+    from umsgpack import unpackb
+
+from cdict_format import read_chunks
+from mkcdict_perf_script import SLICE_ENV
+from mkcdict_perf_script import STATE_SUFFIX
+from perf_data import PerfDataFile
+from perf_text import PENDING_SWITCH
+from perf_text import RangeMerger
+from perf_text import RangeResult
+from task_names import TaskNameResolver
+
+def format_time(nsecs):
+    # perf script --time format (seconds with ns resolution)
+    return '%d.%09d' % divmod(nsecs, 1000000000)
+
+def get_time_slices(perf_data_filename, count):
+    '''Split the time range of a perf.data file into count slices.
+
+    Returns a list of perf script --time arguments (inclusive ranges)
+    '''
+    first, last = PerfDataFile(perf_data_filename).get_time_range()
+    if first is None:
+        return [',']
+    step = (last - first) // count + 1
+    starts = [first + index * step for index in range(1, count)]
+    bounds = [''] + [format_time(start) for start in starts]
+    ends = [format_time(start - 1) for start in starts] + ['']
+    return [start + ',' + end for start, end in zip(bounds, ends)]
+
+# RangeResult attribute of each cdict column
+SLICE_COLUMNS = [('events', 'event'), ('cpus', 'cpu'), ('nsecs', 'nsecs'), ('pids', 'pid'),
+                 ('comms', 'task_name'), ('durations', 'duration'), ('next_pids', 'next_pid'),
+                 ('next_comms', 'next_comm')]
+
+def load_slice_state(slice_filename):
+    '''Load the state of a slice into a RangeResult without its rows.
+
+    Returns the RangeResult and the nsecs of its pending rows indexed by row
+    '''
+    with open(slice_filename + STATE_SUFFIX, 'rb') as ff:
+        state = unpackb(ff.read())
+    res = RangeResult()
+    res.pending = [tuple(pending) for pending in state['pending']]
+    res.runtime_tails = dict(state['slice_runtime_by_cpu'])
+    res.runtime_tails.update(state['runtime_by_cpu'])
+    res.switch_cpus = set(state['runtime_by_cpu'])
+    res.kvm_times = dict((tid, [value or None for value in times])
+                         for tid, times in state['kvm_times'].iteritems())
+    res.tasks = [tuple(task) for task in state['tasks']]
+    res.drops = state['drops']
+
+    # every row except pending switch rows has set the epoch in the handler
+    pending_switches = set(row for row, kind, _, _ in res.pending if kind == PENDING_SWITCH)
+    pending_nsecs = dict((row, None) for row, _, _, _ in res.pending)
+    # (row, previous nsecs) of the kvm rows which previous event is at the first nsecs so far
+    candidates = []
+    row = 0
+    for chunk in read_chunks(slice_filename, ['event', 'nsecs', 'duration']):
+        for event, nsecs, duration in zip(chunk['event'], chunk['nsecs'], chunk['duration']):
+            if row not in pending_switches and (res.first_nsecs is None or nsecs < res.first_nsecs):
+                res.first_nsecs = nsecs
+            if row in pending_nsecs:
+                pending_nsecs[row] = nsecs
+            elif nsecs - duration == res.first_nsecs and event in ('kvm_entry', 'kvm_exit'):
+                candidates.append((row, nsecs - duration))
+            row += 1
+    # kvm rows which previous event is at first_nsecs
+    res.first_nsecs_rows = [row for row, previous in candidates if previous == res.first_nsecs]
+    return res, pending_nsecs
+
+def merge_slice(merger, slice_filename):
+    # merge the rows of a slice one chunk at a time
+    res, pending_nsecs = load_slice_state(slice_filename)
+    merger.start_range(res, pending_nsecs)
+    for chunk in read_chunks(slice_filename):
+        rows = RangeResult()
+        for attr, name in SLICE_COLUMNS:
+            setattr(rows, attr, chunk[name])
+        merger.write_rows(rows)
+    merger.end_range()
+
+def convert_slices(perf_binary, perf_data_filename, cdict_filename, count, resolver=None):
+    '''Convert a perf.data file with count parallel perf script processes.
+
+    resolver: TaskNameResolver to resolve the final task name of the tids
+              (default is a resolver with a snapshot of the local qemu threads)
+    Returns the first non zero return code of the perf script processes or 0 if success
+    '''
+    time_slices = get_time_slices(perf_data_filename, count)
+    print 'Converting %s in %d time slices...' % (perf_data_filename, len(time_slices))
+    procs = []
+    for index, time_slice in enumerate(time_slices):
+        slice_filename = '%s.slice%d' % (cdict_filename, index)
+        env = dict(os.environ)
+        env[SLICE_ENV] = slice_filename
+        with open(slice_filename + '.log', 'w') as log:
+            proc = subprocess.Popen([perf_binary, 'script', '-s', 'mkcdict_perf_script.py',
+                                     '-i', perf_data_filename, '--time', time_slice],
+                                    env=env, stdout=log, stderr=subprocess.STDOUT)
+        procs.append((proc, slice_filename))
+    rcs = [proc.wait() for proc, _ in procs]
+    slice_filenames = [slice_filename for _, slice_filename in procs]
+    try:
+        for rc, slice_filename in zip(rcs, slice_filenames):
+            if rc:
+                print 'Error converting time slice (see %s.log)' % (slice_filename)
+                return rc
+        merger = RangeMerger(cdict_filename, resolver or TaskNameResolver())
+        for slice_filename in slice_filenames:
+            merge_slice(merger, slice_filename)
+            os.remove(slice_filename + '.log')
+        size = merger.close()
+        print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
+              (cdict_filename, merger.writer.rows, size)
+    finally:
+        for slice_filename in slice_filenames:
+            for filename in [slice_filename, slice_filename + STATE_SUFFIX]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+    return 0
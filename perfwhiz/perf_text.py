@@ -0,0 +1,421 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Conversion of the perf script text output into a cdict file
+# (only when the perf python extension is not available)
+#
+# The text file is split into byte ranges aligned on line boundaries and each
+# range is parsed by a pool of processes. The stateful part of the perf script
+# handlers cannot be resolved inside a range because it depends on the events
+# of the previous ranges:
+# - the first sched_switch of each cpu in a range needs the runtime accumulated
+#   on that cpu since the last switch of the previous ranges
+# - the first kvm_entry (kvm_exit) of each tid in a range needs the time of the
+#   last kvm_exit (kvm_entry) of that tid in the previous ranges
+# Each range therefore returns its rows with these pending rows marked, along with
+# the state at the end of the range, and the pending rows are resolved when the
+# ranges are merged in file order. Only a few ranges per worker process are parsed
+# ahead of the merge so that the memory use does not depend on the file size.
+# The task names are also resolved when merging, after applying the task events
+# (fork, exec) of the range (see task_names.py).
+#
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing import Pool
+import os
+import re
+
+from cdict_format import CdictWriter
+from kvm_exit_reasons import get_exit_reason_code
+from kvm_exit_reasons import UNKNOWN_EXIT_REASON
+from task_names import TASK_EXEC
+from task_names import TASK_FORK
+
+# size of each byte range parsed by a worker process
+RANGE_SIZE = 16 * 1024 * 1024
+# maximum number of ranges parsed or waiting to be merged per worker process
+IN_FLIGHT_FACTOR = 2
+
+#  qemu-system-x86 27637 [006] 622048.897809: kvm:kvm_entry: vcpu 0
+# (622048.897809123 with perf script --ns)
+trace_re = re.compile(r' *(.+?) +(\d+) +\[(\d+)\] +(\d+)\.(\d+): +(\w+):(\w+): ?(.*)')
+# sched:sched_switch: prev_comm=qemu-system-x86 prev_pid=28823 prev_prio=120 prev_state=S ==>
+# next_comm=swapper/7 next_pid=0 next_prio=120
+switch_re = re.compile(r'prev_comm=(.*?) prev_pid=(-?\d+) .*?==> next_comm=(.*?) next_pid=(-?\d+)')
+# sched:sched_stat_runtime: comm=qemu-system-x86 pid=28823 runtime=36140 [ns] vruntime=3273999068253 [ns]
+runtime_re = re.compile(r'comm=(.*?) pid=(-?\d+) runtime=(\d+)')
+# sched:sched_stat_sleep: comm=qemu-system-x86 pid=28823 delay=386438 [ns]
+delay_re = re.compile(r'comm=(.*?) pid=(-?\d+) delay=(\d+)')
+# kvm:kvm_exit: reason APIC_ACCESS rip 0xffffffff810271ee info 10b0 0
+exit_re = re.compile(r'.*?reason (\S+)')
+# sched:sched_process_fork: comm=qemu-system-x86 pid=28823 child_comm=qemu-system-x86 child_pid=28830
+fork_re = re.compile(r'comm=(.*?) pid=(-?\d+) child_comm=(.*?) child_pid=(-?\d+)')
+# sched:sched_process_exec: filename=/usr/bin/qemu-system-x86_64 pid=28823 old_pid=28823
+exec_re = re.compile(r'filename=(.*?) pid=(-?\d+)')
+
+# kinds of pending rows
+PENDING_SWITCH = 0
+PENDING_KVM = 1
+
+def get_ranges(filename, range_size=RANGE_SIZE):
+    # returns a list of (start, end) byte ranges that end on a line boundary
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as ff:
+        start = 0
+        while start < size:
+            ff.seek(min(start + range_size, size))
+            ff.readline()
+            end = min(ff.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+class RangeResult(object):
+    '''Rows parsed from one byte range and the state needed to merge it with the other ranges.
+    '''
+    def __init__(self):
+        self.events = []
+        self.cpus = []
+        self.nsecs = []
+        self.pids = []
+        self.comms = []
+        self.durations = []
+        self.next_pids = []
+        self.next_comms = []
+        # (row, kind, key, value) of the rows that depend on the previous ranges
+        # PENDING_SWITCH: key is the cpu, value the runtime in ns before the row
+        # PENDING_KVM: key is the tid, value True for kvm_exit
+        self.pending = []
+        # runtime in ns accumulated on each cpu after its last switch (or on all the range if no switch)
+        self.runtime_tails = {}
+        # cpus that have at least one switch in this range
+        self.switch_cpus = set()
+        # last kvm entry and exit nsecs of each tid in this range (None if none)
+        self.kvm_times = {}
+        # nsecs of the first event that sets the epoch in the handler (excluding pending switch rows)
+        self.first_nsecs = None
+        # kvm rows which previous event is at first_nsecs
+        self.first_nsecs_rows = []
+        # (row, kind, tid, value) of the task events in time order, row is the index of the
+        # first row after the event (see TaskNameResolver.add_task_events)
+        self.tasks = []
+        self.drops = {}
+
+    def add_row(self, event, cpu, nsecs, pid, comm, duration, next_pid, next_comm):
+        self.events.append(event)
+        self.cpus.append(cpu)
+        self.nsecs.append(nsecs)
+        self.pids.append(pid)
+        self.comms.append(comm)
+        self.durations.append(duration)
+        self.next_pids.append(next_pid)
+        self.next_comms.append(next_comm)
+        return len(self.events) - 1
+
+    def stamp(self, nsecs):
+        if self.first_nsecs is None:
+            self.first_nsecs = nsecs
+
+    def add_kvm(self, event, cpu, nsecs, tid, comm, is_exit, reason):
+        try:
+            times = self.kvm_times[tid]
+        except KeyError:
+            times = [None, None]
+            self.kvm_times[tid] = times
+        self.stamp(nsecs)
+        # the previous event of the other type
+        previous = times[0] if is_exit else times[1]
+        if previous is None:
+            row = self.add_row(event, cpu, nsecs, tid, comm, 0, 0, reason)
+            self.pending.append((row, PENDING_KVM, tid, is_exit))
+        else:
+            row = self.add_row(event, cpu, nsecs, tid, comm, nsecs - previous, 0, reason)
+            if previous == self.first_nsecs:
+                # dropped when merging if first_nsecs turns out to be the epoch
+                self.first_nsecs_rows.append(row)
+        times[1 if is_exit else 0] = nsecs
+
+def parse_range(args):
+    '''Parse the lines of a byte range of a perf script text file.
+
+    args: (filename, start, end)
+    Returns a RangeResult
+    '''
+    filename, start, end = args
+    res = RangeResult()
+    runtime_tails = res.runtime_tails
+    switch_cpus = res.switch_cpus
+    with open(filename, 'rb') as ff:
+        ff.seek(start)
+        lines = ff.read(end - start).splitlines()
+    for line in lines:
+        if not line or line[0] == '#':
+            continue
+        m = trace_re.match(line)
+        if not m:
+            continue
+        task, tid, cpu, secs, frac, system, event, args = m.groups()
+        cpu = int(cpu)
+        # usecs with the default perf script output, nsecs with perf script --ns
+        nsecs = int(secs) * 1000000000 + int((frac + '00000000')[:9])
+        if event == 'sched_stat_runtime':
+            m = runtime_re.match(args)
+            if m:
+                runtime_tails[cpu] = runtime_tails.get(cpu, 0) + int(m.group(3))
+        elif event == 'sched_switch':
+            m = switch_re.match(args)
+            if not m:
+                continue
+            runtime = runtime_tails.get(cpu, 0)
+            runtime_tails[cpu] = 0
+            row = res.add_row('sched__sched_switch', cpu, nsecs, int(m.group(2)), m.group(1),
+                              runtime, int(m.group(4)), m.group(3))
+            if cpu in switch_cpus:
+                res.stamp(nsecs)
+            else:
+                switch_cpus.add(cpu)
+                res.pending.append((row, PENDING_SWITCH, cpu, runtime))
+        elif event == 'sched_stat_sleep' or event == 'sched_stat_iowait':
+            m = delay_re.match(args)
+            if m:
+                res.stamp(nsecs)
+                res.add_row('sched__' + event, cpu, nsecs, int(m.group(2)), m.group(1),
+                            int(m.group(3)), 0, None)
+        elif event == 'kvm_entry':
+            res.add_kvm('kvm_entry', cpu, nsecs, int(tid), task, False, None)
+        elif event == 'kvm_exit':
+            m = exit_re.match(args)
+            res.add_kvm('kvm_exit', cpu, nsecs, int(tid), task, True,
+                        get_exit_reason_code(m.group(1)) if m else UNKNOWN_EXIT_REASON)
+        else:
+            if event == 'sched_process_fork':
+                m = fork_re.match(args)
+                if m:
+                    res.tasks.append((len(res.events), TASK_FORK, int(m.group(2)), int(m.group(4))))
+            elif event == 'sched_process_exec':
+                m = exec_re.match(args)
+                if m:
+                    res.tasks.append((len(res.events), TASK_EXEC, int(m.group(2)), m.group(1)))
+            name = system + '__' + event
+            res.drops[name] = res.drops.get(name, 0) + 1
+    return res
+
+
+class RangeMerger(object):
+    '''Resolve the pending rows of each range in file order and write the rows to a cdict file.
+    '''
+    def __init__(self, cdict_filename, resolver=None):
+        self.writer = CdictWriter(cdict_filename)
+        self.resolver = resolver
+        # runtime counter of each started cpu (ns)
+        self.runtime_by_cpu = {}
+        # last kvm [entry, exit] nsecs of each tid
+        self.kvm_times = {}
+        self.epoch = None
+        self.name_cache = {}
+        self.drops = {}
+        self.counts = {}
+
+    def get_names(self, pids, comms):
+        if not self.resolver:
+            return comms
+        cache = self.name_cache
+        names = []
+        for pid, comm in zip(pids, comms):
+            try:
+                names.append(cache[(pid, comm)])
+            except KeyError:
+                name = self.resolver.get_task_name(pid, comm) if pid else comm
+                cache[(pid, comm)] = name
+                names.append(name)
+        return names
+
+    def merge(self, res):
+        # merge a range which rows are all in memory
+        self.start_range(res)
+        self.write_rows(res)
+        self.end_range()
+
+    def start_range(self, res, pending_nsecs=None):
+        '''Resolve the pending rows of the next range and update the state with its end state.
+
+        Only the state of res is used, its rows can then be written in several parts with write_rows()
+        pending_nsecs: nsecs of the pending rows indexed by row (default is res.nsecs)
+        '''
+        if pending_nsecs is None:
+            pending_nsecs = res.nsecs
+        # rows not stored and resolved durations of the pending rows indexed by row
+        dropped = set()
+        durations = {}
+        first_nsecs = res.first_nsecs
+        for row, kind, key, value in res.pending:
+            if kind == PENDING_SWITCH:
+                runtime = self.runtime_by_cpu.get(key)
+                if runtime is None:
+                    # first switch on this cpu: only starts the counter
+                    dropped.add(row)
+                    continue
+                durations[row] = runtime + value
+                if first_nsecs is None or pending_nsecs[row] < first_nsecs:
+                    first_nsecs = pending_nsecs[row]
+        if self.epoch is None:
+            self.epoch = first_nsecs
+        epoch = self.epoch
+        if first_nsecs is not None and first_nsecs == epoch:
+            # the handler ignores previous kvm events at time 0
+            dropped.update(res.first_nsecs_rows)
+        for row, kind, key, value in res.pending:
+            if kind == PENDING_KVM:
+                times = self.kvm_times.get(key)
+                previous = times and times[0 if value else 1]
+                if previous is None or previous == epoch:
+                    dropped.add(row)
+                else:
+                    durations[row] = pending_nsecs[row] - previous
+
+        # update the state with the end of range state
+        for cpu, runtime in res.runtime_tails.iteritems():
+            if cpu in res.switch_cpus:
+                self.runtime_by_cpu[cpu] = runtime
+            elif cpu in self.runtime_by_cpu:
+                self.runtime_by_cpu[cpu] += runtime
+        for cpu in res.switch_cpus:
+            self.runtime_by_cpu.setdefault(cpu, 0)
+        for tid, times in res.kvm_times.iteritems():
+            old_times = self.kvm_times.setdefault(tid, [None, None])
+            for index in range(2):
+                if times[index] is not None:
+                    old_times[index] = times[index]
+        for name, count in res.drops.iteritems():
+            self.drops[name] = self.drops.get(name, 0) + count
+        self.dropped = dropped
+        self.durations = durations
+        # task events not applied yet
+        self.tasks = list(reversed(res.tasks))
+        # first row of the next write_rows() call
+        self.row = 0
+
+    def apply_task(self):
+        row, kind, tid, value = self.tasks.pop()
+        if self.resolver:
+            self.resolver.add_task_events([(kind, tid, value)])
+            self.name_cache = {}
+
+    def write_rows(self, res):
+        '''Write the next rows of the current range.
+
+        res: RangeResult (or object with the same column lists) with the rows that follow
+             the rows of the previous call since start_range()
+        '''
+        start = self.row
+        count = len(res.events)
+        self.row += count
+        # kvm_exit events have the exit reason in next_comm
+        next_tids = [pid if event == 'sched__sched_switch' else 0
+                     for event, pid in zip(res.events, res.next_pids)]
+        task_names = []
+        next_names = []
+        first = 0
+        # the rows before each task event are named before applying it
+        while self.tasks and self.tasks[-1][0] <= self.row:
+            index = self.tasks[-1][0] - start
+            task_names.extend(self.get_names(res.pids[first:index], res.comms[first:index]))
+            next_names.extend(self.get_names(next_tids[first:index], res.next_comms[first:index]))
+            self.apply_task()
+            first = index
+        task_names.extend(self.get_names(res.pids[first:], res.comms[first:]))
+        next_names.extend(self.get_names(next_tids[first:], res.next_comms[first:]))
+
+        durations = res.durations
+        resolved = [(row - start, duration) for row, duration in self.durations.iteritems()
+                    if start <= row < self.row]
+        if resolved:
+            durations = list(durations)
+            for index, duration in resolved:
+                durations[index] = duration
+        dropped = [row for row in self.dropped if start <= row < self.row]
+        if dropped:
+            dropped = set(row - start for row in dropped)
+            rows = [row for row in xrange(count) if row not in dropped]
+        else:
+            rows = None
+
+        def select(values):
+            return [values[row] for row in rows] if rows is not None else values
+        events = select(res.events)
+        for event in events:
+            self.counts[event] = self.counts.get(event, 0) + 1
+        epoch = self.epoch
+        self.writer.write_columns({'event': events,
+                                   'cpu': select(res.cpus),
+                                   'nsecs': [nsecs - epoch for nsecs in select(res.nsecs)],
+                                   'pid': select(res.pids),
+                                   'task_name': select(task_names),
+                                   'duration': select(durations),
+                                   'next_pid': select(res.next_pids),
+                                   'next_comm': select(next_names)})
+
+    def end_range(self):
+        # task events after the last row of the range
+        while self.tasks:
+            self.apply_task()
+
+    def close(self):
+        print 'Dropped events (not stored in cdict file):'
+        for name in sorted(self.drops, key=self.drops.get, reverse=True):
+            print '   %6d %s' % (self.drops[name], name)
+        print
+        print 'Events stored in cdict file:'
+        for name in sorted(self.counts, key=self.counts.get, reverse=True):
+            print '   %6d %s' % (self.counts[name], name)
+        print
+        if self.resolver:
+            self.writer.task_names.update(self.resolver.get_name_table())
+        self.writer.epoch = self.epoch
+        return self.writer.close()
+
+def decode_perf_text(text_filename, cdict_filename, resolver=None, processes=None,
+                     range_size=RANGE_SIZE):
+    '''Convert a perf script text output file into a cdict file.
+
+    resolver: optional TaskNameResolver to resolve the final task name of the tids
+    processes: number of worker processes (default is the number of cpus)
+    Returns the number of events stored in the cdict file
+    '''
+    ranges = get_ranges(text_filename, range_size)
+    print 'Parsing %s (%d ranges)...' % (text_filename, len(ranges))
+    merger = RangeMerger(cdict_filename, resolver)
+    processes = processes or cpu_count()
+    pool = Pool(processes)
+    # ranges submitted to the pool and not merged yet, in file order
+    # (bounded so that the parsed ranges do not pile up in memory if merging is slower)
+    in_flight = deque()
+    try:
+        for start, end in ranges:
+            in_flight.append(pool.apply_async(parse_range, ((text_filename, start, end),)))
+            if len(in_flight) >= processes * IN_FLIGHT_FACTOR:
+                merger.merge(in_flight.popleft().get())
+        while in_flight:
+            merger.merge(in_flight.popleft().get())
+    finally:
+        pool.terminate()
+    size = merger.close()
+    print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
+          (cdict_filename, merger.writer.rows, size)
+    return merger.writer.rows
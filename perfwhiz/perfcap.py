@@ -24,8 +24,23 @@ import os
 import sys
 from optparse import OptionParser
 import re
+import shutil
+import signal
 import subprocess
+from capture_info import INFO_ENV
+from capture_info import INFO_SUFFIX
+from capture_info import get_info_resolver
+from capture_info import load_capture_info
+from capture_info import save_capture_info
+from capture_profiles import CALIBRATION_SECONDS
+from capture_profiles import DEFAULT_PROFILE
+from capture_profiles import PROFILES
+from capture_profiles import get_record_args
+from capture_profiles import report_capture
 import perf_formatter
+from mkcdict_perf_script import LIVE_ENV
+from perf_text import decode_perf_text
+from task_names import snapshot_threads
 
 perf_binary = 'perf'
 
@@ -41,7 +56,7 @@ perf_binary = 'perf'
 # By default, qemu-system-x86:13568 becomes qemu.vcpu0:13568 (for example)
 #
 
-def get_curated_latency_table(table):
+def init_task_names(opts):
     try:
         perf_formatter.init(opts)
     except ImportError:
@@ -49,6 +64,7 @@ def get_curated_latency_table(table):
     except ValueError:
         print 'Using default qemu task name mapping (OpenStack credentials not found, use -r or env variables)'
 
+def get_curated_latency_table(table):
     lines = table.split('\n')
     results = []
     for line in lines:
@@ -78,12 +94,11 @@ def get_curated_latency_table(table):
         results.append(line)
     return '\n'.join(results)
 
-def perf_record(opts, cs=True, kvm=True):
-    perf_cmd = [perf_binary, 'record', '-a']
-    if cs:
-        perf_cmd += ['-e', 'sched:*']
-    if kvm:
-        perf_cmd += ['-e', 'kvm:*']
+def perf_record(opts):
+    perf_cmd = [perf_binary, 'record', '-a'] + get_record_args(perf_binary, opts)
+    if opts.tmpfs:
+        # writing to memory lowers the risk of lost events, the file is moved at the end
+        perf_cmd += ['-o', os.path.join(opts.tmpfs, 'perf.data')]
     perf_cmd += ['sleep', str(opts.seconds)]
     print 'Recording with: ' + ' '.join(perf_cmd)
     rc = subprocess.call(perf_cmd)
@@ -91,6 +106,8 @@ def perf_record(opts, cs=True, kvm=True):
         print 'Error recording traces'
         print 'You might need to run this script as root or with sudo'
         return False
+    if opts.tmpfs:
+        shutil.move(os.path.join(opts.tmpfs, 'perf.data'), 'perf.data')
     return True
 
 
@@ -119,6 +136,32 @@ def capture_stats(opts, stats_filename):
     os.chmod(stats_filename, 0664)
 
 
+def live_capture(opts):
+    # stream the traces from perf record to the perf script handlers without perf data file
+    record_cmd = [perf_binary, 'record', '-a'] + get_record_args(perf_binary, opts) + ['-o', '-']
+    script_cmd = [perf_binary, 'script', '-i', '-', '-s', 'mkcdict_perf_script.py']
+    env = dict(os.environ)
+    env[LIVE_ENV] = opts.live_output
+    # stdout may be used by the aggregates
+    print >> sys.stderr, 'Streaming with: %s | %s' % (' '.join(record_cmd), ' '.join(script_cmd))
+    print >> sys.stderr, 'Aggregates sent every second to %s, stop with Ctrl-C' % (opts.live_output)
+    try:
+        record = subprocess.Popen(record_cmd, stdout=subprocess.PIPE)
+        script = subprocess.Popen(script_cmd, stdin=record.stdout, env=env)
+    except OSError:
+        print >> sys.stderr, 'Error: perf does not seems to be installed'
+        return
+    record.stdout.close()
+    try:
+        script.wait()
+    except KeyboardInterrupt:
+        # perf record and perf script are interrupted too, perf script drains the pipe
+        script.wait()
+    if record.wait() not in (0, -signal.SIGINT):
+        print >> sys.stderr, 'Error recording traces'
+    if script.returncode == 255:
+        print >> sys.stderr, 'Error: perf is not built with the python scripting extension'
+
 def capture(opts, run_name):
 
     # If this is set we skip the capture
@@ -132,15 +175,40 @@ def capture(opts, run_name):
     else:
         # need to capture traces
         print 'Capturing perf data for %d seconds...' % (opts.seconds)
+        # the plugin converts the instance names saved in the capture information
+        init_task_names(opts)
+        # snapshot the qemu threads before and after the capture
+        threads = snapshot_threads()
         if not perf_record(opts):
             return
         perf_data_filename = 'perf.data'
+        threads.update(snapshot_threads())
+        perf_formatter.resolver.update(threads)
+        save_capture_info(perf_data_filename + INFO_SUFFIX, perf_formatter.resolver,
+                          perf_binary, perf_data_filename)
         print 'Traces captured in perf.data'
+        report_capture(opts.profile, perf_data_filename)
+
+    # all the conversions (including perf script) use the capture information if available
+    info_filename = perf_data_filename + INFO_SUFFIX
+    if os.path.isfile(info_filename):
+        info = load_capture_info(info_filename)
+        perf_formatter.resolver = get_info_resolver(info)
+        os.environ[INFO_ENV] = info_filename
+        print 'Using capture information from %s (host %s, kernel %s)' % \
+              (info_filename, info['host']['hostname'], info['host']['kernel'])
+    elif opts.offline:
+        print 'Cannot find the capture information file %s (required with --offline)' % (info_filename)
+        return
+    else:
+        init_task_names(opts)
 
     # collect stats
     if opts.all or opts.stats:
         if opts.perf_data:
             print 'Stats capture from provided perf data file not supported'
+        elif opts.profile != 'full':
+            print 'Stats capture requires the full profile'
         else:
             stats_filename = opts.dest_folder + run_name + ".stats"
             capture_stats(opts, stats_filename)
@@ -148,27 +216,99 @@ def capture(opts, run_name):
     # create cdict from the perf data file
 
     if opts.all or opts.switches:
+        cdict_filename = opts.dest_folder + run_name + '.cdict'
+        if opts.native:
+            native_convert(opts, perf_data_filename, cdict_filename)
+            return
+        if opts.text:
+            text_convert(opts, perf_data_filename, run_name, cdict_filename)
+            return
         try:
-            cdict_filename = opts.dest_folder + run_name + '.cdict'
             # try to run this script through the perf tool itself as it is faster
-            rc = subprocess.call([perf_binary, 'script', '-s', 'mkcdict_perf_script.py', '-i', perf_data_filename])
+            if opts.slices > 1:
+                # the time range of the slices is read with the perf.data reader (requires numpy)
+                from perf_slices import convert_slices
+                rc = convert_slices(perf_binary, perf_data_filename, cdict_filename, opts.slices,
+                                    perf_formatter.resolver)
+            else:
+                rc = subprocess.call([perf_binary, 'script', '-s', 'mkcdict_perf_script.py',
+                                      '-i', perf_data_filename])
             if rc == 255:
-                print '   perf is not built with the python scripting extension, parsing text file (slower)...'
-                text_filename = run_name + '.txt'
-                print '   Generating text traces to file %s...' % (text_filename)
-                with open(text_filename, 'w') as ff:
-                    rc = subprocess.call([perf_binary, 'script', '-i', perf_data_filename],
-                                         stdout=ff, stderr=subprocess.PIPE)
-                # parse the text file into a cdict file
-                print '   Feature not implemented'
+                print '   perf is not built with the python scripting extension, decoding perf data file...'
+                if not native_convert(opts, perf_data_filename, cdict_filename):
+                    print '   parsing text traces (slower)...'
+                    text_convert(opts, perf_data_filename, run_name, cdict_filename)
+            elif opts.slices > 1:
+                if not rc:
+                    store_lost_events(perf_data_filename, cdict_filename)
+                    os.chmod(cdict_filename, 0664)
+                    print 'Created file: ' + cdict_filename
             else:
                 # success result is in perf.cdict, so need to rename it
                 os.rename('perf.cdict', cdict_filename)
+                store_lost_events(perf_data_filename, cdict_filename)
                 os.chmod(cdict_filename, 0664)
                 print 'Created file: ' + cdict_filename
         except OSError:
             print 'Error: perf does not seems to be installed'
 
+def store_lost_events(perf_data_filename, cdict_filename):
+    # perf script does not pass the lost event records to the handlers
+    try:
+        # the perf.data reader requires numpy, which the capture host may not have
+        from perf_data import add_lost_events
+    except ImportError as exc:
+        print 'Cannot check for lost events in %s: %s' % (perf_data_filename, exc)
+        return
+    try:
+        lost = add_lost_events(perf_data_filename, cdict_filename)
+    except ValueError as exc:
+        print 'Cannot check for lost events in %s: %s' % (perf_data_filename, exc)
+        return
+    if lost:
+        print 'WARNING: %d events lost in %d ranges, stored in %s' % \
+              (sum(event[3] for event in lost), len(lost), cdict_filename)
+
+def native_convert(opts, perf_data_filename, cdict_filename):
+    # decode the perf data file directly (does not require perf but requires numpy)
+    try:
+        from perf_data import convert_perf_data
+    except ImportError as exc:
+        print 'Cannot decode %s: %s' % (perf_data_filename, exc)
+        return False
+    try:
+        convert_perf_data(perf_data_filename, cdict_filename, perf_formatter.resolver)
+    except ValueError as exc:
+        print 'Error decoding %s: %s' % (perf_data_filename, exc)
+        return False
+    os.chmod(cdict_filename, 0664)
+    print 'Created file: ' + cdict_filename
+    return True
+
+def text_convert(opts, perf_data_filename, run_name, cdict_filename):
+    # parse the perf script text output (does not require the perf python extension)
+    text_filename = run_name + '.txt'
+    print '   Generating text traces to file %s...' % (text_filename)
+    try:
+        # nanosecond timestamps, older perf versions do not have --ns and only print usecs
+        for ns_option in [['--ns'], []]:
+            with open(text_filename, 'w') as ff:
+                process = subprocess.Popen([perf_binary, 'script', '-i', perf_data_filename] + ns_option,
+                                           stdout=ff, stderr=subprocess.PIPE)
+                _, errors = process.communicate()
+            if not process.returncode:
+                break
+    except OSError:
+        print 'Error: perf does not seems to be installed'
+        return
+    if process.returncode:
+        print 'Error generating text traces: ' + errors
+        return
+    decode_perf_text(text_filename, cdict_filename, perf_formatter.resolver, opts.jobs)
+    store_lost_events(perf_data_filename, cdict_filename)
+    os.chmod(cdict_filename, 0664)
+    print 'Created file: ' + cdict_filename
+
 if __name__ == '__main__':
     parser = OptionParser(usage="usage: %prog [options] [<run-name>]")
 
@@ -194,6 +334,123 @@ if __name__ == '__main__':
                       help='capture duration in seconds, defaults to 1 second',
                       metavar='<seconds>')
 
+    parser.add_option('--profile', dest='profile',
+                      action='store',
+                      type='choice',
+                      choices=sorted(PROFILES),
+                      default=DEFAULT_PROFILE,
+                      help='tracepoints to record: sched-min (context switches), kvm-exits (kvm entry/exit), '
+                           'min (both) or full (all sched and kvm tracepoints, required for stats), '
+                           'defaults to %s' % (DEFAULT_PROFILE),
+                      metavar='<profile>')
+
+    parser.add_option('--mmap', dest='mmap',
+                      action='store',
+                      help='size of the per cpu ring buffers (perf record -m): a number of pages, '
+                           'a size (e.g. 16M) or auto to size them from a %d second calibration capture, '
+                           'defaults to the perf default' % (CALIBRATION_SECONDS),
+                      metavar='<pages|size|auto>')
+
+    parser.add_option('--tmpfs', dest='tmpfs',
+                      action='store',
+                      help='write the perf data file to <dir> (e.g. a tmpfs mount) during the capture '
+                           'and move it to the current folder when done',
+                      metavar='<dir>')
+
+    parser.add_option('--native', dest='native',
+                      action='store_true',
+                      default=False,
+                      help='decode the perf data file directly instead of using perf script (faster)')
+
+    parser.add_option('--text', dest='text',
+                      action='store_true',
+                      default=False,
+                      help='parse the perf script text output instead of using the perf python extension (slower)')
+
+    parser.add_option('-j', '--jobs', dest='jobs',
+                      action='store',
+                      type='int',
+                      help='number of processes used to parse text traces (default: number of cpus)',
+                      metavar='<count>')
+
+    parser.add_option('--slices', dest='slices',
+                      action='store',
+                      default=1,
+                      type='int',
+                      help='convert the perf data file with <count> parallel perf script processes',
+                      metavar='<count>')
+
+    parser.add_option('--daemon', dest='daemon',
+                      action='store_true',
+                      default=False,
+                      help='capture continuously and keep the cdict files of the last segments '
+                           '(requires perf 4.11 or later)')
+
+    parser.add_option('--segment', dest='segment',
+                      action='store',
+                      default=10,
+                      type='int',
+                      help='duration of each segment in daemon mode, defaults to 10 seconds',
+                      metavar='<seconds>')
+
+    parser.add_option('--keep', dest='keep',
+                      action='store',
+                      default=6,
+                      type='int',
+                      help='number of segment or snapshot cdict files to keep in daemon or snapshot mode, '
+                           'defaults to 6',
+                      metavar='<count>')
+
+    parser.add_option('--snapshot', dest='snapshot',
+                      action='store_true',
+                      default=False,
+                      help='record in memory and only save a snapshot when a trigger fires or on SIGUSR1 '
+                           '(requires perf 4.15 or later)')
+
+    parser.add_option('--wait-trigger', dest='wait_trigger',
+                      action='store',
+                      type='int',
+                      help='snapshot when a vcpu thread waits more than <usecs> on a run queue within 1 second',
+                      metavar='<usecs>')
+
+    parser.add_option('--exit-rate-trigger', dest='exit_rate_trigger',
+                      action='store',
+                      type='int',
+                      help='snapshot when the kvm exit rate is above <count> per second',
+                      metavar='<count>')
+
+    parser.add_option('--holdoff', dest='holdoff',
+                      action='store',
+                      default=10,
+                      type='int',
+                      help='minimum time between 2 snapshots, defaults to 10 seconds',
+                      metavar='<seconds>')
+
+    parser.add_option('--snapshot-buffer', dest='snapshot_buffer',
+                      action='store',
+                      default='16M',
+                      help='size of the per cpu ring buffer in snapshot mode (perf record -m), defaults to 16M',
+                      metavar='<size>')
+
+    parser.add_option('--live', dest='live',
+                      action='store_true',
+                      default=False,
+                      help='stream the traces from perf record to perf script (no perf data file) and '
+                           'send aggregates every second')
+
+    parser.add_option('--live-output', dest='live_output',
+                      action='store',
+                      default='-',
+                      help='where to send the live aggregates: - for stdout (default), <host>:<port> '
+                           'or a unix socket path',
+                      metavar='<output>')
+
+    parser.add_option('--offline', dest='offline',
+                      action='store_true',
+                      default=False,
+                      help='convert a perf data file captured on another host using its capture information '
+                           'file (<perf data file>.info), requires --use-perf-data')
+
     parser.add_option('--dest-folder', dest='dest_folder',
                       action='store',
                       default='./',
@@ -215,6 +472,13 @@ if __name__ == '__main__':
                       help='source OpenStack credentials from rc file',
                       metavar='<openrc_file>')
 
+    parser.add_option('--nova-cache-ttl', dest='nova_cache_ttl',
+                      action='store',
+                      type='int',
+                      help='time to live of the cached instance names of the Nova plugin, '
+                           'defaults to 3600 seconds',
+                      metavar='<seconds>')
+
     parser.add_option('-p', '--password', dest='passwordd',
                       action='store',
                       help='OpenStack password',
@@ -235,10 +499,13 @@ if __name__ == '__main__':
         sys.exit(2)
     if not opts.dest_folder.endswith('/'):
         opts.dest_folder += '/'
+    if opts.tmpfs and not os.path.isdir(opts.tmpfs):
+        print 'Invalid tmpfs folder: ' + opts.tmpfs
+        sys.exit(2)
 
     # pick at least one command
-    if not (opts.all | opts.switches | opts.stats):
-        print 'Pick at least one of --stats, --switches, --all'
+    if not (opts.all | opts.switches | opts.stats | opts.daemon | opts.snapshot | opts.live):
+        print 'Pick at least one of --stats, --switches, --all, --daemon, --snapshot, --live'
         sys.exit(3)
 
     CFG_FILE = '.mkcdict.cfg'
@@ -259,6 +526,10 @@ if __name__ == '__main__':
                     except AttributeError:
                         pass
 
+    if opts.offline and not opts.perf_data:
+        print '--offline requires --use-perf-data'
+        sys.exit(1)
+
     if opts.perf_data and not os.path.isfile(opts.perf_data):
         print 'Cannot find perf data file: ' + opts.perf_data
         sys.exit(1)
@@ -267,97 +538,17 @@ if __name__ == '__main__':
         perf_binary = opts.perf
         print 'Overriding perf binary with: ' + perf_binary
 
-    capture(opts, run_name)
-
-
-# Unused code - WIP
-# python decode of perf script text output - very slow
-# only when perf python extension is not available
-
-from mkcdict_perf_script import trace_begin
-from mkcdict_perf_script import trace_end
-from mkcdict_perf_script import add_event
-from mkcdict_perf_script import kvm_entry
-from mkcdict_perf_script import kvm_exit
-
-
-def _kvm_entry(cpu, secs, nsecs, pid, comm, args):
-    # kvm:kvm_entry: vcpu 0
-    kvm_entry(cpu, secs, nsecs, pid, comm)
-
-kvm_exit_re = re.compile('reason (\w*) ')
-def _kvm_exit(cpu, secs, nsecs, pid, comm, args):
-    #
-    # kvm:kvm_exit: reason APIC_ACCESS rip 0xffffffff810271ee info 10b0 0
-    m = kvm_exit_re.match(args)
-    if m:
-        kvm_exit(cpu, secs, nsecs, pid, comm, m.group(1))
+    if opts.daemon:
+        # the captured segments are converted with the perf.data reader (requires numpy)
+        from perfcap_daemon import capture_daemon
+        init_task_names(opts)
+        capture_daemon(perf_binary, opts, run_name)
+    elif opts.snapshot:
+        from perfcap_snapshot import capture_snapshots
+        init_task_names(opts)
+        capture_snapshots(perf_binary, opts, run_name)
+    elif opts.live:
+        live_capture(opts)
     else:
-        print 'Dropped mismatch for kvm_exit: ' + args
+        capture(opts, run_name)
 
-
-# sched:sched_switch: prev_comm=qemu-system-x86 prev_pid=28823 prev_prio=120 prev_state=S ==>
-# next_comm=swapper/7 next_pid=0 next_prio=120
-switch_re = re.compile('comm=([\w\-/]+) prev_pid=(\d+) prev_prio=\d+ prev_state=\w* ==> '
-                       'next_comm=([\w\-/]+) next_pid=(\d+) ')
-
-def sched_switch(cpu, secs, nsecs, pid, comm, args):
-
-    print 'sched switch:' + args
-    m = switch_re.match(args)
-    if m:
-        add_event('sched:sched_switch', cpu, secs, nsecs, m.group(2), m.group(1), 0, m.group(4), m.group(3))
-    else:
-        print 'Dropped mismatch for sched_stat_runtime: ' + args
-
-# sched:sched_stat_runtime: comm=qemu-system-x86 pid=28823 runtime=36140 [ns] vruntime=3273999068253 [ns]
-stat_runtime_re = re.compile('comm=([\w\-/]+) pid=(\d+) runtime=(\d)+ ')
-
-def sched_stat_runtime(cpu, secs, nsecs, pid, comm, args):
-    m = stat_runtime_re.match(args)
-    if m:
-        add_event('sched:sched_stat_runtime', cpu, secs, nsecs, m.group(2), m.group(1), m.group(3))
-    else:
-        print 'Dropped mismatch for sched_stat_runtime: ' + args
-
-# sched:sched_stat_sleep: comm=qemu-system-x86 pid=28823 delay=386438 [ns]
-stat_sleep_re = re.compile('comm=([\w\-/]+) pid=(\d+) delay=(\d)+ ')
-
-def sched_stat_sleep(cpu, secs, nsecs, pid, comm, args):
-    m = stat_sleep_re.match(args)
-    if m:
-        add_event('sched:sched_stat_sleep', cpu, secs, nsecs, m.group(2), m.group(1), m.group(3))
-    else:
-        print 'Dropped mismatch for sched_stat_sleep: ' + args
-
-fn_dispatch = {
-    'kvm_entry': _kvm_entry,
-    'kvm_exit': _kvm_exit,
-    'sched_switch': sched_switch,
-    'sched_stat_runtime': sched_stat_runtime,
-    'sched_stat_sleep': sched_stat_sleep
-}
-
-
-def decode_perf_text(filename):
-    #  qemu-system-x86 27637 [006] 622048.897809: kvm:kvm_entry: vcpu 0
-    trace_re = re.compile(' *([\w\-]*) *(\d*) \[(\d*)\] (\d*)\.(\d*): \w*:(\w*): ')
-    with open(filename, 'r') as input:
-        trace_begin()
-        for line in input:
-            if line[0] == '#':
-                continue
-            m = trace_re.match(line)
-            if m:
-                task = m.group(1)
-                pid = int(m.group(2))
-                cpu = int(m.group(3))
-                secs = int(m.group(4))
-                usecs = int(m.group(5))
-                event = m.group(6)
-                event_args = line[m.end():]
-                try:
-                    fn_dispatch[event](cpu, secs, usecs * 1000, pid, task, event_args)
-                except KeyError:
-                    pass
-        trace_end()
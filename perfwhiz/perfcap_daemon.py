@@ -0,0 +1,176 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Continuous capture with a ring buffer of cdict files
+#
+# perf record runs until the daemon is stopped and switches to a new output file
+# every segment (perf record --switch-output, requires perf 4.11 or later).
+# Each finished segment is converted to a cdict file by a single background process
+# (niced) with the native perf.data reader, then deleted. Only the last K cdict files
+# are kept and segments that cannot be converted in time are dropped (oldest first)
+# so that disk and cpu usage stay bounded regardless of how long the daemon runs.
+#
+from collections import deque
+from multiprocessing import Pool
+import os
+import re
+import signal
+import subprocess
+import time
+
+from capture_profiles import get_record_args
+from perf_data import convert_perf_data
+import perf_formatter
+from task_names import snapshot_threads
+
+# niceness of the conversion process
+CONVERT_NICE = 10
+
+def init_converter():
+    # the conversion process is stopped by the daemon, not by Ctrl-C
+    # or the snapshot signal (see perfcap_snapshot.py)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    os.nice(CONVERT_NICE)
+
+def convert_segment(segment, cdict_filename):
+    # runs in the conversion process, returns the cdict file name or None
+    # refresh the qemu threads at the end of each segment (new VMs)
+    perf_formatter.resolver.update(snapshot_threads())
+    try:
+        convert_perf_data(segment, cdict_filename, perf_formatter.resolver)
+        os.chmod(cdict_filename, 0664)
+        return cdict_filename
+    except ValueError as exc:
+        print 'Error decoding %s: %s' % (segment, exc)
+        return None
+    finally:
+        os.remove(segment)
+
+
+class CaptureDaemon(object):
+    '''Convert the perf record output segments and keep the last cdict files.
+    '''
+    def __init__(self, data_filename, keep):
+        self.data_filename = data_filename
+        # perf.data.<timestamp> (timestamp is YYYYmmddHHMMSSmmm)
+        self.segment_re = re.compile(re.escape(os.path.basename(data_filename)) + r'\.(\d+)$')
+        self.keep = keep
+        # finished segments waiting for conversion (oldest first)
+        self.waiting = deque()
+        self.seen = set()
+        # segment being converted and its async result
+        self.converting = None
+        # cdict files kept on disk (oldest first)
+        self.cdicts = deque()
+        self.pool = Pool(1, initializer=init_converter)
+
+    def get_cdict_filename(self, stamp):
+        # run.data.<timestamp> -> run.<timestamp>.cdict
+        return '%s.%s.cdict' % (os.path.splitext(self.data_filename)[0], stamp)
+
+    def find_segments(self):
+        # perf renames each segment when it is complete
+        folder = os.path.dirname(self.data_filename) or '.'
+        segments = []
+        for name in os.listdir(folder):
+            m = self.segment_re.match(name)
+            if m and name not in self.seen:
+                self.seen.add(name)
+                segments.append((m.group(1), os.path.join(folder, name)))
+        self.waiting.extend(sorted(segments))
+
+    def add_cdict(self, cdict_filename):
+        self.cdicts.append(cdict_filename)
+        while len(self.cdicts) > self.keep:
+            os.remove(self.cdicts.popleft())
+
+    def poll(self, wait=False):
+        '''Collect the current conversion and start the next one.
+
+        wait: wait for the current conversion to finish
+        '''
+        if self.converting:
+            segment, result = self.converting
+            if not wait and not result.ready():
+                return
+            cdict_filename = result.get()
+            if cdict_filename:
+                self.add_cdict(cdict_filename)
+            self.converting = None
+        # older segments would be deleted as soon as converted
+        while len(self.waiting) > self.keep:
+            stamp, segment = self.waiting.popleft()
+            print 'Dropping segment %s (conversion too slow)' % (segment)
+            os.remove(segment)
+        if self.waiting:
+            stamp, segment = self.waiting.popleft()
+            result = self.pool.apply_async(convert_segment, (segment, self.get_cdict_filename(stamp)))
+            self.converting = (segment, result)
+
+    def flush(self):
+        # convert all the remaining segments
+        while self.converting or self.waiting:
+            self.poll(wait=True)
+        self.pool.close()
+        self.pool.join()
+
+def record_segments(perf_cmd, daemon, tick=None):
+    '''Run perf record until it exits or is interrupted (SIGINT or SIGTERM)
+    and convert its output segments as they are completed.
+
+    tick(proc): optional function called every second with the perf record process
+    '''
+    print 'Recording with: ' + ' '.join(perf_cmd)
+    stopped = []
+
+    def stop(signum, frame):
+        stopped.append(signum)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    proc = subprocess.Popen(perf_cmd)
+    while not stopped and proc.poll() is None:
+        time.sleep(1)
+        if tick:
+            tick(proc)
+        daemon.find_segments()
+        daemon.poll()
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+        proc.wait()
+    elif proc.returncode:
+        print 'Error recording traces'
+        print 'You might need to run this script as root or with sudo'
+    daemon.find_segments()
+
+def capture_daemon(perf_binary, opts, run_name):
+    '''Capture continuously until interrupted (SIGINT or SIGTERM).
+    '''
+    data_filename = opts.dest_folder + run_name + '.data'
+    perf_cmd = [perf_binary, 'record', '-a'] + get_record_args(perf_binary, opts) + \
+               ['--switch-output=%ds' % (opts.segment), '-o', data_filename]
+    daemon = CaptureDaemon(data_filename, opts.keep)
+    print 'Keeping the last %d cdict files of %d seconds, stop with Ctrl-C' % (opts.keep, opts.segment)
+    record_segments(perf_cmd, daemon)
+    # the last segment is in the perf record output file
+    if os.path.isfile(data_filename):
+        stamp = time.strftime('%Y%m%d%H%M%S000')
+        segment = '%s.%s' % (data_filename, stamp)
+        os.rename(data_filename, segment)
+        daemon.waiting.append((stamp, segment))
+    daemon.flush()
+    print 'Cdict files: ' + ' '.join(daemon.cdicts)
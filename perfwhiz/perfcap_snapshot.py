@@ -0,0 +1,155 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Threshold triggered snapshot capture
+#
+# perf record runs in overwrite mode: the traces only go to the per cpu ring buffers
+# in memory and are written to a new perf.data.<timestamp> file when perf record
+# gets a SIGUSR2 (perf record --overwrite --switch-output, requires perf 4.15 or later).
+# The triggers are checked every second from cheap kernel counters so that nothing is
+# written to disk until a trigger fires:
+# - vcpu run queue wait: time a vcpu thread waited on a run queue (switched out while
+#   runnable) during the last second, from /proc/<pid>/task/<tid>/schedstat
+# - kvm exit rate: from the kvm exits counter in debugfs
+# - external: SIGUSR1 sent to perfcap
+# Snapshots are converted to cdict files in the background (see perfcap_daemon.py).
+#
+import os
+import signal
+import time
+
+from capture_profiles import get_event_args
+from perfcap_daemon import CaptureDaemon
+from perfcap_daemon import record_segments
+from task_names import read_file
+from task_names import vcpu_comm_re
+
+# aggregated kvm exit counter of all VMs
+KVM_EXITS_FILE = '/sys/kernel/debug/kvm/exits'
+
+# how often the list of vcpu threads is refreshed (in checks)
+VCPU_REFRESH = 10
+
+def get_vcpu_tasks():
+    # returns the list of schedstat files of all vcpu threads
+    tasks = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        cmdline = read_file('/proc/%s/cmdline' % (pid))
+        if not cmdline or 'qemu' not in cmdline.split('\x00')[0]:
+            continue
+        task_dir = '/proc/%s/task' % (pid)
+        try:
+            tids = os.listdir(task_dir)
+        except OSError:
+            continue
+        for tid in tids:
+            comm = read_file('%s/%s/comm' % (task_dir, tid))
+            if comm and vcpu_comm_re.match(comm):
+                tasks.append('%s/%s/schedstat' % (task_dir, tid))
+    return tasks
+
+
+class RunDelayTrigger(object):
+    '''Fires when a vcpu thread waited on a run queue longer than a threshold during the last check interval.
+    '''
+    def __init__(self, threshold_usecs):
+        self.threshold = threshold_usecs * 1000
+        self.tasks = []
+        self.checks = 0
+        # last run queue wait time in ns indexed by schedstat file
+        self.run_delays = {}
+
+    def check(self):
+        if not self.checks % VCPU_REFRESH:
+            self.tasks = get_vcpu_tasks()
+        self.checks += 1
+        fired = None
+        run_delays = {}
+        for task in self.tasks:
+            schedstat = read_file(task)
+            if not schedstat:
+                continue
+            # run time, run queue wait time (ns), number of time slices
+            run_delay = int(schedstat.split()[1])
+            run_delays[task] = run_delay
+            delta = run_delay - self.run_delays.get(task, run_delay)
+            if delta > self.threshold and not fired:
+                fired = 'vcpu run queue wait %d usec (%s)' % (delta / 1000, task)
+        self.run_delays = run_delays
+        return fired
+
+
+class ExitRateTrigger(object):
+    '''Fires when the kvm exit rate of all VMs exceeds a threshold.
+    '''
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.exits = None
+        self.time = None
+        if read_file(KVM_EXITS_FILE) is None:
+            raise ValueError('Cannot read the kvm exits counter %s (debugfs mounted?)' % (KVM_EXITS_FILE))
+
+    def check(self):
+        exits = int(read_file(KVM_EXITS_FILE) or 0)
+        now = time.time()
+        fired = None
+        if self.exits is not None:
+            rate = (exits - self.exits) / (now - self.time)
+            if rate > self.threshold:
+                fired = 'kvm exit rate %d/s' % (rate)
+        self.exits = exits
+        self.time = now
+        return fired
+
+def capture_snapshots(perf_binary, opts, run_name):
+    '''Record into memory and save a snapshot when a trigger fires, until interrupted.
+    '''
+    triggers = []
+    if opts.wait_trigger:
+        triggers.append(RunDelayTrigger(opts.wait_trigger))
+    if opts.exit_rate_trigger:
+        try:
+            triggers.append(ExitRateTrigger(opts.exit_rate_trigger))
+        except ValueError as exc:
+            print 'Exit rate trigger disabled: %s' % (exc)
+    data_filename = opts.dest_folder + run_name + '.data'
+    perf_cmd = [perf_binary, 'record', '-a'] + get_event_args(opts.profile) + \
+               ['--overwrite', '--switch-output', '-m', opts.snapshot_buffer, '-o', data_filename]
+    daemon = CaptureDaemon(data_filename, opts.keep)
+    requests = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: requests.append(signum))
+    last_snapshot = [0]
+
+    def tick(proc):
+        fired = [trigger.check() for trigger in triggers]
+        if requests:
+            fired.append('SIGUSR1')
+            del requests[:]
+        fired = [reason for reason in fired if reason]
+        if fired and time.time() - last_snapshot[0] >= opts.holdoff:
+            print 'Snapshot triggered by ' + ', '.join(fired)
+            proc.send_signal(signal.SIGUSR2)
+            last_snapshot[0] = time.time()
+    print 'Waiting for triggers (send SIGUSR1 to pid %d for a snapshot), stop with Ctrl-C' % (os.getpid())
+    record_segments(perf_cmd, daemon, tick)
+    # the buffers dumped when perf record exits were not triggered
+    if os.path.isfile(data_filename):
+        os.remove(data_filename)
+    daemon.flush()
+    print 'Cdict files: ' + ' '.join(daemon.cdicts)
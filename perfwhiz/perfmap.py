@@ -18,45 +18,52 @@
 # ---------------------------------------------------------
 
 
+import atexit
 from optparse import OptionParser
-import csv
 import os
 import sys
 import warnings
-import marshal
-try:
-    # try to use the faster version if available
-    from msgpack import packb
-    from msgpack import unpackb
-except ImportError:
-    # else fall back to the pure python version (slower)
-    from umsgpack import packb
-    from umsgpack import unpackb
-
-import zlib
+import numpy as np
 import pandas
 from pandas import DataFrame
 
 
+import bokeh
 from bokeh.plotting import figure, output_file, show
 from bokeh.models.sources import ColumnDataSource
 from bokeh.models import HoverTool, Range1d
 from bokeh.io import gridplot
 from bokeh.io import vplot
 
+from cdict_convert import convert_df
+from cdict_convert import convert_dir
+from cdict_reader import load_cdict
+from cdict_reader import load_lost_events
+from cdict_reader import load_task_names
+from cdict_remap import load_task_map
+from cdict_remap import remap_cdict
+from cdict_remap import remap_task_names
 from perfmap_common import set_html_file
+from perfmap_common import set_lost_events
+from phase_profile import enable_profile
+from phase_profile import profile_phase
+from phase_profile import save_profile
 
 from perfmap_kvm_exit_types import show_kvm_exit_types
+from perfmap_kvm_exit_types import KVM_EXIT_TYPES_COLUMNS
 from perfmap_sw_kvm_exits import show_sw_kvm_heatmap
+from perfmap_sw_kvm_exits import SW_KVM_HEATMAP_COLUMNS
 
 from perfmap_core import show_core_runs
 from perfmap_core import show_core_locality
+from perfmap_core import CORE_RUNS_COLUMNS
+from perfmap_core import CORE_LOCALITY_COLUMNS
 
 # Global variables
 
-# start analysis after first from_time usec
+# start analysis after first from_time nsec
 from_time = 0
-# cap input file to first cap_time usec, 0 = unlimited
+# cap input file to first cap_time nsec, 0 = unlimited
 cap_time = 0
 
 def get_full_task_name(df, task):
@@ -84,6 +91,9 @@ def get_full_task_name(df, task):
     task = task + ':' + str(tid)
     return (df, task)
 
+SHOW_TIDS_COLUMNS = ['pid', 'task_name']
+SUCCESSORS_COLUMNS = ['event', 'pid', 'task_name', 'next_comm']
+
 def show_successors(df, task, label):
     df, task = get_full_task_name(df, task)
     if not task:
@@ -101,85 +111,40 @@ def show_successors(df, task, label):
     print 'Successors of %s (%s)' % (task, label)
     print pandas.concat([series_count, series_percent], axis=1)
 
-def convert(df, new_cdict):
-    # Convert the old style cdict (marshal based) to the new cdict format
-    # The new format is msgpack based and fixes the runtime reporting bug
-    # by aggregating all runtime durations into the next switch event
-    # and removing the runtime events
-    # A dict of runtime delays accumulated indexed by cpu
-    runtime_by_cpu = {}
-    # aggregate all runtimes per cpu
-    count = len(df)
-    print 'Conversion in progress...'
-    for index in xrange(count):
-        event_name = df['event'].iloc[index]
-        cpu = df['cpu'].iloc[index]
-        if event_name == 'sched__sched_stat_runtime':
-            try:
-                duration = df['duration'].iloc[index]
-                runtime_by_cpu[cpu] += duration
-            except KeyError:
-                # the counter is set in on the first sched switch for each cpu
-                pass
-        elif event_name == 'sched__sched_switch':
-            try:
-                if df['pid'].iloc[index]:
-                    # don't bother to update swapper (pid=0)
-                    runtime = runtime_by_cpu[cpu]
-                    df.set_value(index, 'duration', runtime)
-            except KeyError:
-                pass
-            runtime_by_cpu[cpu] = 0
-    # get rid of all the runtime events
-    df = df[df['event'] != 'sched__sched_stat_runtime']
-    print 'End of conversion, marshaling and compressing...'
-    df.fillna(value=0, inplace=True, downcast='infer')
-    # save new cdict
-    with open(new_cdict, 'w') as ff:
-        res = {'event': df['event'].tolist(),
-               'cpu': df['cpu'].tolist(),
-               'usecs': df['usecs'].tolist(),
-               'pid': df['pid'].tolist(),
-               'task_name': df['task_name'].tolist(),
-               'duration': df['duration'].tolist(),
-               'next_pid': df['next_pid'].tolist(),
-               'next_comm': df['next_comm'].tolist()}
-        compressed = zlib.compress(packb(res))
-        ff.write(compressed)
-        print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
-              (new_cdict, len(df), len(compressed))
-
 def remap(perf_dict, csv_map):
-    # a mapping dict of task names indexed by the tid
-    map_dict = {}
     print 'Remapping task names...'
-    with open(csv_map, 'r') as ff:
-        # 19236,instance-000019f4,emulator,8f81e3a1-3ebd-4015-bbee-e291f0672d02,FULL,5,CSR
-        reader = csv.DictReader(ff, fieldnames=['tid', 'libvirt_id', 'thread_type', 'uuid', 'chain_type',
-                                                'chain_id', 'nvf_name'])
-        for row in reader:
-            task_name = '%s.%02d.%s' % (row['nvf_name'], int(row['chain_id']), row['thread_type'])
-            map_dict[int(row['tid'])] = task_name
-    pids = perf_dict['pid']
-    names = perf_dict['task_name']
-    next_pids = perf_dict['next_pid']
-    next_comms = perf_dict['next_comm']
-    count = 0
-    for index in xrange(len(pids)):
-        try:
-            new_task_name = map_dict[pids[index]]
-            names[index] = new_task_name
-            count += 1
-        except KeyError:
-            pass
-        try:
-            new_task_name = map_dict[next_pids[index]]
-            next_comms[index] = new_task_name
-            count += 1
-        except KeyError:
-            pass
+    count = remap_task_names(perf_dict, load_task_map(csv_map))
     print 'Remapped %d task names' % (count)
 
+def get_columns(options):
+    # returns the list of cdict columns needed for the requested analysis
+    # or None if all columns are needed
+    if options.convert:
+        return None
+    if options.show_tids:
+        columns = set(SHOW_TIDS_COLUMNS)
+    elif options.successor_of_task:
+        columns = set(SUCCESSORS_COLUMNS)
+    else:
+        columns = set()
+        if options.core_runtime or options.core_switches:
+            columns.update(CORE_RUNS_COLUMNS)
+        if options.core_loc:
+            columns.update(CORE_LOCALITY_COLUMNS)
+        if options.switches or options.kvm_exits:
+            columns.update(SW_KVM_HEATMAP_COLUMNS)
+        if options.kvm_exit_types:
+            columns.update(KVM_EXIT_TYPES_COLUMNS)
+        if not columns:
+            return None
+    if options.map:
+        # remapping a name column requires the corresponding tid column
+        if 'task_name' in columns:
+            columns.add('pid')
+        if 'next_comm' in columns:
+            columns.add('next_pid')
+    return list(columns)
+
 # ---------------------------------- MAIN -----------------------------------------
 # Suppress future warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -253,25 +218,57 @@ parser.add_option("--map",
                   metavar="mapping csv file",
                   help="remap task names from mapping csv file"
                   )
+parser.add_option("--remap-to",
+                  dest="remap_to",
+                  action="store",
+                  metavar="new cdict file",
+                  help="save the cdict file with task names remapped from the --map csv file"
+                       " to a new cdict file"
+                  )
 parser.add_option("--convert",
                   dest="convert",
                   action="store",
                   metavar="new cdict file",
                   help="(Deprecated) migrate to new encoding with runtime aggregation into switch"
+                       " (if <cdict_file> is a directory, migrate all cdict files in it to the"
+                       " new cdict directory)"
+                  )
+parser.add_option("--profile",
+                  dest="profile",
+                  action="store",
+                  metavar="json file",
+                  help="save the wall time and peak RSS of each phase (file read, decompress, unpack, remap,"
+                       " DataFrame construction, time filtering and each chart) to a json file"
                   )
 (options, args) = parser.parse_args()
 
+if options.profile:
+    enable_profile()
+    # also saved when exiting early (--show-tids, --successors-of...)
+    atexit.register(save_profile, options.profile,
+                    {'command': sys.argv,
+                     'versions': {'python': sys.version.split()[0], 'numpy': np.__version__,
+                                  'pandas': pandas.__version__, 'bokeh': bokeh.__version__}})
+
 if options.from_time:
-    from_time = int(options.from_time) * 1000
+    from_time = int(options.from_time) * 1000000
 if options.cap_time:
-    # convert to usec
-    cap_time = int(options.cap_time) * 1000 + from_time
+    # convert to nsec
+    cap_time = int(options.cap_time) * 1000000 + from_time
 
 if not args:
     print 'Missing cdict file'
     sys.exit(1)
 
 cdict_file = args[0]
+if options.remap_to and not options.map:
+    print '--remap-to requires --map <mapping csv file>'
+    sys.exit(1)
+
+if options.convert and os.path.isdir(cdict_file):
+    convert_dir(cdict_file, options.convert, from_time, cap_time)
+    sys.exit(0)
+
 if not cdict_file.endswith('.cdict'):
     # automatically add the cdict extension if there is one
     if os.path.isfile(cdict_file + '.cdict'):
@@ -279,38 +276,38 @@ if not cdict_file.endswith('.cdict'):
     else:
         print('input file name must have the .cdict extension')
 
-with open(cdict_file, 'r') as ff:
-    cdict = ff.read()
+if options.remap_to:
+    count = remap_cdict(cdict_file, options.remap_to, load_task_map(options.map))
+    print 'Remapped %d task names into %s' % (count, options.remap_to)
+    sys.exit(0)
 
-decomp = zlib.decompress(cdict)
-try:
-    perf_dict = unpackb(decomp)
-except Exception:
-    # old serialization format
-    perf_dict = marshal.loads(decomp)
+# only the rows within the --from/--cap window are loaded
+perf_dict = load_cdict(cdict_file, get_columns(options), from_time, cap_time)
 
 if options.map:
-    remap(perf_dict, options.map)
+    with profile_phase('remap'):
+        remap(perf_dict, options.map)
 
-df = DataFrame(perf_dict)
+with profile_phase('DataFrame construction'):
+    df = DataFrame(perf_dict)
 set_html_file(cdict_file)
-
-# filter on usecs
-if from_time:
-    df = df[df['usecs'] >= from_time]
-if cap_time:
-    df = df[df['usecs'] <= cap_time]
-
+# only the lost events that overlap the loaded window are shaded in the charts
+lost = [event for event in load_lost_events(cdict_file)
+        if event[2] >= from_time and (not cap_time or event[1] <= cap_time)]
+if lost:
+    print 'WARNING: %d events lost in %d time ranges (shaded in the charts)' % \
+          (sum(event[3] for event in lost), len(lost))
+set_lost_events(lost)
 
 if not options.label:
     options.label = os.path.splitext(os.path.basename(cdict_file))[0]
 
 if options.convert:
-    convert(df, options.convert)
+    convert_df(df, options.convert, load_task_names(cdict_file))
     sys.exit(0)
 
 if options.show_tids:
-    res = df.groupby(['pid', 'task_name']).size()
+    res = df.groupby(['pid', 'task_name'], observed=True).size()
     res.sort_values(ascending=False, inplace=True)
     print 'List of tids and task names sorted by context switches and kvm event count'
     print res
@@ -325,17 +322,23 @@ if not options.task:
     print '--task <task_regex> is required'
     sys.exit(1)
 
+# each chart phase includes the generation of the html file
 if options.core_runtime:
-    show_core_runs(df, options.task, options.label, True)
+    with profile_phase('show_core_runs'):
+        show_core_runs(df, options.task, options.label, True)
 
 if options.core_switches:
-    show_core_runs(df, options.task, options.label, False)
+    with profile_phase('show_core_runs'):
+        show_core_runs(df, options.task, options.label, False)
 
 if options.core_loc:
-    show_core_locality(df, options.task, options.label)
+    with profile_phase('show_core_locality'):
+        show_core_locality(df, options.task, options.label)
 
 if options.switches or options.kvm_exits:
-    show_sw_kvm_heatmap(df, options.task, options.label, options.switches, options.kvm_exits)
+    with profile_phase('show_sw_kvm_heatmap'):
+        show_sw_kvm_heatmap(df, options.task, options.label, options.switches, options.kvm_exits)
 
 if options.kvm_exit_types:
-    show_kvm_exit_types(df, options.task, options.label)
+    with profile_phase('show_kvm_exit_types'):
+        show_kvm_exit_types(df, options.task, options.label)
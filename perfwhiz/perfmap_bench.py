@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# perfmap benchmark
+#
+# Generates synthetic cdict files of increasing sizes (see cdict_gen.py) and times
+# the loading, --show-tids, --successors-of and each chart path of perfmap.
+# Each path runs in its own perfmap process with --profile so that the wall time
+# and peak RSS of a path do not depend on the paths that ran before.
+# The loading time is the sum of the loading phases of the --show-tids run.
+# The results are saved to a JSON file that can be passed as the baseline of a later
+# run to report the paths that got slower (e.g. after upgrading pandas or Bokeh).
+#
+import glob
+import json
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+from cdict_gen import generate_cdict
+from cdict_gen import get_vcpu_name
+from cdict_gen import parse_count
+
+PERFMAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perfmap.py')
+
+# the tasks of the first generated instance
+TASK_RE = r'instance-00000001\.'
+SUCCESSOR_TASK = get_vcpu_name(0, 0)
+
+# benchmarked paths and their perfmap arguments
+PATHS = [('show-tids', ['--show-tids']),
+         ('successors-of', ['--successors-of', SUCCESSOR_TASK]),
+         ('core-runtime', ['-t', TASK_RE, '--core-runtime']),
+         ('core-switch-count', ['-t', TASK_RE, '--core-switch-count']),
+         ('core-locality', ['-t', TASK_RE, '--core-locality']),
+         ('switches', ['-t', TASK_RE, '--switches']),
+         ('kvm-exits', ['-t', TASK_RE, '--kvm-exits']),
+         ('kvm-exit-types', ['-t', TASK_RE, '--kvm-exit-types'])]
+# perfmap phases that make the loading time
+LOAD_PHASES = ['file read', 'zlib decompress', 'unpack', 'time filtering', 'DataFrame construction']
+
+def run_path(cdict_file, args):
+    '''Run perfmap on a cdict file and return the wall time, peak RSS and phases of the run.
+    '''
+    profile_file = cdict_file + '.profile.json'
+    cmd = [sys.executable, PERFMAP, cdict_file, '--profile', profile_file] + args
+    start = time.time()
+    with open(os.devnull, 'w') as null:
+        rc = subprocess.call(cmd, stdout=null, stderr=null)
+    wall = time.time() - start
+    # the html files are written next to the cdict file
+    for html_file in glob.glob(os.path.splitext(cdict_file)[0] + '_*.html'):
+        os.remove(html_file)
+    if rc or not os.path.isfile(profile_file):
+        return {'wall_secs': wall, 'error': 'perfmap exit code %d: %s' % (rc, ' '.join(cmd))}
+    with open(profile_file, 'r') as ff:
+        profile = json.load(ff)
+    os.remove(profile_file)
+    return {'wall_secs': wall, 'peak_rss_mb': profile['peak_rss_mb'], 'phases': profile['phases'],
+            'versions': profile['versions']}
+
+def get_load_result(result):
+    # loading phases of a perfmap run
+    phases = [phase for phase in result.get('phases', []) if phase['name'] in LOAD_PHASES]
+    return {'wall_secs': sum(phase['wall_secs'] for phase in phases),
+            'peak_rss_mb': max([phase['peak_rss_mb'] for phase in phases] or [0]),
+            'phases': phases}
+
+def bench_size(opts, events):
+    '''Generate a cdict file of the given size (unless already there) and run all the paths.
+
+    Returns a dict of results indexed by path name
+    '''
+    cdict_file = os.path.join(opts.dest_folder, 'bench-%d.cdict' % (events))
+    results = {}
+    if not os.path.isfile(cdict_file):
+        print 'Generating %s (%d events)...' % (cdict_file, events)
+        start = time.time()
+        generate_cdict(cdict_file, events, opts.tasks, opts.cores)
+        results['generate'] = {'wall_secs': time.time() - start}
+    for name, args in PATHS:
+        if opts.paths and name not in opts.paths:
+            continue
+        print '   %d events: %s...' % (events, name)
+        results[name] = run_path(cdict_file, args)
+        if 'error' in results[name]:
+            print '   ' + results[name]['error']
+        if name == 'show-tids':
+            results['load'] = get_load_result(results[name])
+    if not opts.keep:
+        os.remove(cdict_file)
+    return results
+
+def print_results(results, baseline, tolerance):
+    '''Print the results table and the comparison with the baseline.
+
+    Returns the number of paths slower than the baseline by more than the tolerance
+    '''
+    regressions = 0
+    print '%12s %-20s %10s %12s %10s' % ('events', 'path', 'wall secs', 'peak RSS MB', 'baseline')
+    for size in sorted(results, key=int):
+        for name in sorted(results[size]):
+            res = results[size][name]
+            ratio = ''
+            base = baseline.get(size, {}).get(name)
+            if base and base.get('wall_secs') and 'error' not in res:
+                change = res['wall_secs'] / base['wall_secs'] - 1
+                ratio = '%+.0f%%' % (change * 100)
+                if change > tolerance:
+                    ratio += ' SLOWER'
+                    regressions += 1
+            if 'error' in res:
+                ratio = 'ERROR'
+            print '%12s %-20s %10.2f %12.1f %10s' % (size, name, res['wall_secs'], res.get('peak_rss_mb', 0), ratio)
+    return regressions
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--sizes', dest='sizes',
+                      action='store',
+                      default='1M,10M,50M',
+                      help='comma separated list of event counts, defaults to 1M,10M,50M',
+                      metavar='<counts>')
+    parser.add_option('--paths', dest='paths',
+                      action='store',
+                      help='comma separated list of paths to run (default all): ' +
+                           ','.join(name for name, _ in PATHS),
+                      metavar='<paths>')
+    parser.add_option('--tasks', dest='tasks',
+                      action='store',
+                      type='int',
+                      default=64,
+                      help='number of tasks in the generated files, defaults to 64',
+                      metavar='<count>')
+    parser.add_option('--cores', dest='cores',
+                      action='store',
+                      type='int',
+                      default=16,
+                      help='number of cores in the generated files, defaults to 16',
+                      metavar='<count>')
+    parser.add_option('--dest-folder', dest='dest_folder',
+                      action='store',
+                      default='./',
+                      help='where to generate the cdict files (default: current folder)',
+                      metavar='<dest folder>')
+    parser.add_option('--keep', dest='keep',
+                      action='store_true',
+                      default=False,
+                      help='keep the generated cdict files (reused by the next runs)')
+    parser.add_option('-o', '--output', dest='output',
+                      action='store',
+                      default='perfmap_bench.json',
+                      help='where to save the results, defaults to perfmap_bench.json',
+                      metavar='<json file>')
+    parser.add_option('--baseline', dest='baseline',
+                      action='store',
+                      help='results of a previous run to compare with',
+                      metavar='<json file>')
+    parser.add_option('--tolerance', dest='tolerance',
+                      action='store',
+                      type='float',
+                      default=0.2,
+                      help='slowdown over the baseline reported as a regression, defaults to 0.2 (20%)',
+                      metavar='<fraction>')
+    (opts, args) = parser.parse_args()
+    if opts.paths:
+        opts.paths = opts.paths.split(',')
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline, 'r') as ff:
+            baseline = json.load(ff)['results']
+
+    results = {}
+    for size in opts.sizes.split(','):
+        events = parse_count(size)
+        results[str(events)] = bench_size(opts, events)
+    with open(opts.output, 'w') as ff:
+        json.dump({'command': sys.argv, 'results': results}, ff, indent=2)
+    print 'Results saved to ' + opts.output
+    regressions = print_results(results, baseline, opts.tolerance)
+    if regressions:
+        print '%d paths slower than the baseline' % (regressions)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -26,15 +26,45 @@ title_style = {'title_text_font_size': '12pt',
 grid_title_style = {'title_text_font_size': '10pt',
                     'title_text_font_style': 'bold'}
 
+# time ranges where events were lost: [cpu, from_nsecs, to_nsecs, count]
+lost_events = []
+LOST_COLOR = '#999999'
+
 def set_html_file(cdict_file):
     global html_file
     html_file = cdict_file.replace('.cdict', '')
 
+def set_lost_events(lost):
+    global lost_events
+    lost_events = lost
+
+def draw_lost_events(p, y_min, y_max, per_cpu=False):
+    # shade the time ranges where events were lost (the events and durations there are not reliable)
+    # per_cpu: the y axis is the cpu, only shade the row of the cpu that lost events
+    if not lost_events:
+        return
+    bottom = []
+    top = []
+    for cpu, _, _, _ in lost_events:
+        if per_cpu and cpu >= 0:
+            bottom.append(cpu - 0.5)
+            top.append(cpu + 0.5)
+        else:
+            bottom.append(y_min)
+            top.append(y_max)
+    p.quad(left=[get_usecs(event[1]) for event in lost_events], right=[get_usecs(event[2]) for event in lost_events],
+           bottom=bottom, top=top, color=LOST_COLOR, alpha=0.3,
+           legend='lost events (%d)' % (sum(event[3] for event in lost_events)))
+
+def get_usecs(nsecs):
+    # times and durations are stored in nsecs but shown in usecs (with decimals for sub-usec values)
+    return nsecs / 1000.0
+
 # calculate the time between the 1st entry and the last entry in msec
 def get_time_span_msec(df):
-    min_usec = df['usecs'].min()
-    max_usec = df['usecs'].max()
-    return (max_usec - min_usec) / 1000
+    min_nsec = df['nsecs'].min()
+    max_nsec = df['nsecs'].max()
+    return (max_nsec - min_nsec) / 1000000
 
 # For sorting
 # 'CSR.1.vcpu0' => '0001.CSR.vcpu0'
@@ -33,7 +33,9 @@ from bokeh.palettes import YlOrRd9
 from perfmap_common import title_style
 from perfmap_common import output_html
 from perfmap_common import get_time_span_msec
+from perfmap_common import get_usecs
 from perfmap_common import get_disc_size
+from perfmap_common import draw_lost_events
 
 # For sorting
 # 'CSR.1.vcpu0' => '0001.CSR.vcpu0'
@@ -94,14 +96,15 @@ def get_color_value_list(min_count, max_count, palette, range_unit):
         value_list = [x + range_unit for x in value_list]
     return value_list
 
+# cdict columns required by each chart
+CORE_RUNS_COLUMNS = ['event', 'task_name', 'cpu', 'duration', 'nsecs']
+CORE_LOCALITY_COLUMNS = ['event', 'task_name', 'cpu', 'duration', 'nsecs', 'pid']
+
 def show_core_runs(df, task_re, label, duration):
     time_span_msec = get_time_span_msec(df)
 
     # remove unneeded columns
-    df = df.drop('next_pid', axis=1)
-    df.drop('pid', axis=1, inplace=True)
-    df.drop('usecs', axis=1, inplace=True)
-    df.drop('next_comm', axis=1, inplace=True)
+    df = df[['event', 'task_name', 'cpu', 'duration']]
 
     # filter out all events except the switch events
     df = df[df.event == 'sched__sched_switch']
@@ -127,10 +130,13 @@ def show_core_runs(df, task_re, label, duration):
         print
         print 'No selection matching "%s"' % (task_re)
         return
-    gb = df.groupby(['task_name', 'cpu'], as_index=False)
+    # task names are categorical, only group the names that are present
+    gb = df.groupby(['task_name', 'cpu'], as_index=False, observed=True)
     if duration:
         # add duration values
         df = gb.aggregate(np.sum)
+        # the aggregated frame is small, revert to plain task names
+        df['task_name'] = df['task_name'].astype(object)
         max_core = df.cpu.max()
 
         dfsum = df.drop('cpu', axis=1)
@@ -142,10 +148,10 @@ def show_core_runs(df, task_re, label, duration):
         # 2   ASA.11.vcpu0     81525
         # 3   ASA.12.vcpu0     56488
         # For each task, the maximum runtime is the time_span_msec (100% of 1 core)
-        # The idle time for each task is therefore time_span_msec * 1000 - sum(duration)
+        # The idle time for each task is therefore time_span_msec * 1000000 - sum(duration) (in nsec)
         dfsum['cpu'] = 'IDLE'
-        time_span_usec = time_span_msec * 1000
-        dfsum['duration'] = time_span_usec - dfsum['duration']
+        time_span_nsec = time_span_msec * 1000000
+        dfsum['duration'] = time_span_nsec - dfsum['duration']
 
         # now we need to reinsert that data back to the df
         dfm = pandas.concat([df, dfsum], ignore_index=True)
@@ -156,7 +162,7 @@ def show_core_runs(df, task_re, label, duration):
         # 2     ASA.1.vcpu0   10      4151  78152
 
         # Add a % column
-        dfm['percent'] = ((dfm['duration'] * 100 * 10) // time_span_usec) / 10
+        dfm['percent'] = ((dfm['duration'] * 100 * 10) // time_span_nsec) / 10
 
         # This is for the legend
         min_count = 0
@@ -181,6 +187,7 @@ def show_core_runs(df, task_re, label, duration):
         dfm = DataFrame(gb.size())
         dfm.reset_index(inplace=True)
         dfm.rename(columns={0: 'count'}, inplace=True)
+        dfm['task_name'] = dfm['task_name'].astype(object)
         min_count = dfm['count'].min()
         max_count = dfm['count'].max()
         range_unit = ''
@@ -320,8 +327,8 @@ def show_core_locality(df, task_re, label):
 
     for task, color in zip(task_list, color_list):
         dfe = gb.get_group(task)
-        # add 1 column to contain the starting time for each run period
-        dfe['start'] = dfe['usecs'] - dfe['duration']
+        # add 1 column to contain the starting time for each run period and the end time in usecs
+        dfe = dfe.assign(start=get_usecs(dfe['nsecs'] - dfe['duration']), usecs=get_usecs(dfe['nsecs']))
         tid = dfe['pid'].iloc[0]
         count = len(dfe)
         legend_text = '%s:%d (%d)' % (task, tid, count)
@@ -333,6 +340,8 @@ def show_core_locality(df, task_re, label):
         # draw segments to show the entire runs
         p.segment('start', 'cpu', 'usecs', 'cpu', line_width=5, line_color=color,
                   source=ColumnDataSource(dfe))
+    if not df.empty:
+        draw_lost_events(p, df['cpu'].min() - 0.5, df['cpu'].max() + 0.5, per_cpu=True)
 
     # specify how to output the plot(s)
     output_html('coreloc', task_re)
@@ -20,7 +20,6 @@
 
 from collections import OrderedDict
 import pandas
-from pandas import Series
 
 from bokeh.plotting import show
 from bokeh.models.sources import ColumnDataSource
@@ -34,72 +33,14 @@ from bokeh.models.widgets import StringFormatter
 
 from perfmap_common import output_html
 from perfmap_common import get_time_span_msec
+from kvm_exit_reasons import get_exit_reason_name
 
-# KVM exit reasons
-# Intel64 and IA32 Architecture Software Developer's Manual Vol 3B, System Programming Guide Part 2
-# Appendix I
-KVM_EXIT_REASONS = [
-    'Exception or NMI',     # 0
-    'External Interrupt',
-    'Triple Fault',
-    'INIT',
-    'Startup IPI',
-    'I/O SMI (System Management Interrupt)',
-    'Other SMI',
-    'Interrupt Window',
-    'NMI window',
-    'Task Switch',
-    'CPUID',                # 10
-    'GETSEC',
-    'HLT',                  # 12
-    'INVD',
-    'INVLPG',
-    'RDPMC',
-    'RDTSC',
-    'RSM',
-    'VMCALL',
-    'VMCLEAR',
-    'VMLAUNCH',             # 20
-    'VMPTRLD',
-    'VMPTRST',
-    'VMREAD',
-    'VMRESUME',
-    'VMWRITE',
-    'VMXOFF',
-    'VMXON',
-    'Control Register Access',
-    'MOV DR',
-    'I/O Instruction',      # 30
-    'RDMSR',
-    'WRMSR',
-    'VM Entry Failure (invalid guest state)',
-    'VM Entry Failure (MSR loading)',
-    'n/a 35',
-    'MWAIT',
-    'Monitor trap flag',
-    'n/a 38',
-    'MONITOR',
-    'PAUSE',                # 40
-    'VM Entry Failure (machine check)',
-    'n/a 42',
-    'TPR below threshold',
-    'APIC Access',
-    'n/a 45',
-    'Access to GDTR or IDTR',
-    'Access to LDTR or TR',
-    'EPT violation',
-    'EPT misconfiguration',
-    'INVEPT',               # 50
-    'RDTSCP',
-    'VMX preemption timer expired',  # 52
-    'INVVPID',
-    'WBINVD',
-    'XSETBV'
-]
+# cdict columns required by the exit type charts
+KVM_EXIT_TYPES_COLUMNS = ['event', 'task_name', 'next_comm', 'nsecs']
 
 def convert_exit_df(df, label):
     # fill in the error reason text from the code in
-    df.next_comm = df.next_comm.apply(lambda x: '(%02d) %s' % (x, KVM_EXIT_REASONS[x]))
+    df.next_comm = df.next_comm.apply(lambda x: '(%02d) %s' % (x, get_exit_reason_name(x)))
     series_percent = df.next_comm.value_counts(normalize=True)
     series_count = df.next_comm.value_counts()
     series_percent = pandas.Series(["{0:.2f}%".format(val * 100) for val in series_percent],
@@ -125,18 +66,17 @@ def show_kvm_exit_types(df, task_re, label):
     df = df[df['event'] == 'kvm_exit']
     df = df[df['task_name'].str.match(task_re)]
     # the next_comm column contains the exit code
-    exit_codes = Series(KVM_EXIT_REASONS)
     # add  new column congaining the exit reason in clear text
-    df['exit_reason'] = df['next_comm'].map(exit_codes)
+    df['exit_reason'] = df['next_comm'].map(get_exit_reason_name)
     time_span_msec = get_time_span_msec(df)
-    df.drop(['cpu', 'duration', 'event', 'next_pid', 'pid', 'next_comm', 'usecs'], inplace=True, axis=1)
+    df = df[['task_name', 'exit_reason']]
 
     # Get the list of exit reasons, sorted alphabetically
     reasons = pandas.unique(df.exit_reason.ravel()).tolist()
     reasons.sort()
 
     # group by task name then exit reasons
-    gb = df.groupby(['task_name', 'exit_reason'])
+    gb = df.groupby(['task_name', 'exit_reason'], observed=True)
     # number of exit types
     size_series = gb.size()
     df = size_series.to_frame('count')
@@ -169,7 +109,7 @@ def show_kvm_exit_types(df, task_re, label):
     output_html('kvm-types', task_re)
 
     # table with counts
-    gb = df.groupby(['exit_reason'])
+    gb = df.groupby(['exit_reason'], observed=True)
     keys = gb.groups.keys()
     dfr_list = []
     for reason in keys:
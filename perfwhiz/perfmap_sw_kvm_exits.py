@@ -27,7 +27,12 @@ from bokeh.io import gridplot
 from perfmap_common import title_style
 from perfmap_common import grid_title_style
 from perfmap_common import output_html
+from perfmap_common import draw_lost_events
 from perfmap_common import get_disc_size
+from perfmap_common import get_usecs
+
+# cdict columns required by the heatmap
+SW_KVM_HEATMAP_COLUMNS = ['event', 'task_name', 'pid', 'duration', 'nsecs']
 
 GREEN = "#5ab738"
 RED = "#f22c40"
@@ -46,7 +51,8 @@ def get_groupby(df, task_re):
     except ValueError:
         # task given: find corresponding tid
         df = df[df['task_name'].str.match(task_re)]
-        gb = df.groupby('task_name')
+        # task names are categorical, only group the names that are present
+        gb = df.groupby('task_name', observed=True)
 
     return gb
 
@@ -121,7 +127,9 @@ def show_sw_kvm_heatmap(df, task_re, label, show_ctx_switches, show_kvm):
 
         dfg = gb.get_group(task)
         # remove any row with zero duration as it confuses the chart library
+        # (sub-usec durations are kept as they are stored in nsec)
         dfg = dfg[dfg['duration'] > 0]
+        dfg = dfg.assign(usecs=get_usecs(dfg['nsecs']), duration=get_usecs(dfg['duration']))
 
         for event in event_list:
             dfe = dfg[dfg.event == event]
@@ -165,6 +173,7 @@ def show_sw_kvm_heatmap(df, task_re, label, show_ctx_switches, show_kvm):
     for p in chart_list:
         p.x_range = shared_x_range
         p.y_range = shared_y_range
+        draw_lost_events(p, duration_min, duration_max)
 
     # specify how to output the plot(s)
     output_html(prefix, task_re)
@@ -0,0 +1,98 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Per phase wall time and memory profiling (perfmap --profile)
+#
+# Code that wants to be profiled wraps each phase in "with profile_phase(name):",
+# which does nothing unless profiling was enabled with enable_profile().
+# A phase entered several times (e.g. the decompression of each column of each chunk)
+# is accumulated into a single record:
+#
+# {"name": phase name, "calls": number of times the phase was entered,
+#  "wall_secs": total wall time,
+#  "peak_rss_mb": peak RSS of the process at the end of the phase,
+#  "rss_growth_mb": how much the phases of that name raised the peak RSS}
+#
+# The peak RSS of a process can only grow, so a phase that allocates less memory than
+# a previous phase has no growth. Version 2 cdict files are memory mapped: the pages are
+# only read from disk when decompressed, so most of the file read time of these files
+# is accounted in the decompression phase.
+#
+from contextlib import contextmanager
+import json
+import resource
+import time
+
+# phase records indexed by name (None when profiling is disabled)
+phases = None
+# phase names in order of first use
+phase_names = []
+start_time = None
+
+def enable_profile():
+    global phases
+    global start_time
+    phases = {}
+    del phase_names[:]
+    start_time = time.time()
+
+def get_peak_rss():
+    # peak RSS of this process in bytes (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_rss():
+    # current RSS of this process in bytes (0 if unknown)
+    try:
+        with open('/proc/self/statm', 'r') as ff:
+            return int(ff.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return 0
+
+@contextmanager
+def profile_phase(name):
+    if phases is None:
+        yield
+        return
+    start_peak = get_peak_rss()
+    start = time.time()
+    try:
+        yield
+    finally:
+        wall = time.time() - start
+        peak = get_peak_rss()
+        record = phases.get(name)
+        if record is None:
+            record = phases[name] = {'name': name, 'calls': 0, 'wall_secs': 0.0,
+                                     'peak_rss_mb': 0.0, 'rss_growth_mb': 0.0}
+            phase_names.append(name)
+        record['calls'] += 1
+        record['wall_secs'] += wall
+        record['peak_rss_mb'] = peak / 1e6
+        record['rss_growth_mb'] += (peak - start_peak) / 1e6
+
+def save_profile(filename, info=None):
+    '''Save the phase records to a JSON file.
+
+    info: optional dict of additional fields (command line, library versions...)
+    '''
+    res = dict(info or {})
+    res['total_secs'] = time.time() - start_time
+    res['peak_rss_mb'] = get_peak_rss() / 1e6
+    res['phases'] = [phases[name] for name in phase_names]
+    with open(filename, 'w') as ff:
+        json.dump(res, ff, indent=2)
+    print 'Profile saved to ' + filename
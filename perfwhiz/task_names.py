@@ -0,0 +1,224 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# Resolution of the qemu thread task names
+#
+# A qemu thread (emulator or vcpu) name gets its thread type appended, and is
+# converted by the plugin (if any) from the libvirt instance, for example
+# qemu-system-x86 becomes qemu-system-x86.vcpu0 (or CSR.01.vcpu0 with the Nova plugin)
+#
+# All the qemu threads are found with a single walk of /proc/*/task/* (snapshot)
+# instead of reading /proc/<tid>/... for each new tid while converting traces.
+# perfcap takes a snapshot at the start and at the end of the capture and saves
+# it in the capture information file so that it can be reused by later conversions
+# (see capture_info.py).
+#
+# The snapshot is only a seed: the sched_process_fork and sched_process_exec events
+# of the trace are applied in time order on top of it so that the threads created
+# during the capture (or the tids reused by other processes) are named correctly
+# without looking at /proc:
+# - a thread forked by a qemu thread belongs to the same instance, its thread type
+#   is given by its task name (qemu names its vcpu threads "CPU <n>/KVM")
+# - a thread forked by any other thread is not a qemu thread
+# - a thread that executes a qemu binary falls back to the snapshot (the instance is
+#   only known from the command line), any other binary makes it a non qemu thread
+# The exit events are not needed: the last switch out of a thread comes after its
+# exit event so the name is kept until the tid is reused.
+# The converters resolve the names of the rows of a tid that come before one of its task
+# events before applying that event (the perf script handlers resolve the rows buffered so far,
+# the perf data converter resolves each (tid, task events count) once) so that the rows of
+# a reused tid keep the name it had at their time.
+#
+# This module only depends on the python standard library so that it can be
+# imported from the perf embedded python interpreter on the capture host.
+#
+import os
+import re
+
+uuid_re = re.compile('-uuid ([a-fA-F0-9\-]*)')
+# /proc/pid/cpuset output
+# /machine/instance-000065d7.libvirt-qemu/emulator
+# /machine/instance-000065d3.libvirt-qemu/vcpu0
+cpuset_re = re.compile('/machine/(instance-[a-fA-F0-9]*).libvirt-qemu/(\w*)')
+# qemu names its vcpu threads "CPU 0/KVM"
+vcpu_comm_re = re.compile(r'CPU (\d+)/KVM')
+
+# kinds of task events (fork: parent tid, child tid - exec: tid, file name)
+TASK_FORK = 0
+TASK_EXEC = 1
+
+def get_event_tid(kind, tid, value):
+    # tid which thread changes with a task event (the child of a fork)
+    return value if kind == TASK_FORK else tid
+
+def read_file(filename):
+    try:
+        with open(filename) as ff:
+            return ff.read()
+    except IOError:
+        # some pids/tids come and go so just forget about this one
+        return None
+
+def is_qemu_binary(filename):
+    return filename.startswith('/usr/bin/qemu-system')
+
+def get_thread_type(name):
+    # thread type of a qemu thread created during the capture (same as the libvirt cpuset)
+    res = vcpu_comm_re.match(name)
+    if res:
+        return 'vcpu' + res.group(1)
+    return 'emulator'
+
+def decode_cmdline(cmdline):
+    # returns the instance uuid of a qemu command line (nul separated tokens) or None
+    cmdline = cmdline.replace('\x00', ' ')
+    if is_qemu_binary(cmdline):
+        res = uuid_re.search(cmdline)
+        if res:
+            return res.group(1)
+    return None
+
+def snapshot_threads(proc='/proc'):
+    '''Find all the qemu threads.
+
+    Returns a dict of [libvirt_name, uuid, thread_type] indexed by tid
+    '''
+    threads = {}
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        # the command line is the same for all the threads of a process
+        cmdline = read_file('%s/%s/cmdline' % (proc, pid))
+        uuid = decode_cmdline(cmdline) if cmdline else None
+        if not uuid:
+            continue
+        task_dir = '%s/%s/task' % (proc, pid)
+        try:
+            tids = os.listdir(task_dir)
+        except OSError:
+            continue
+        for tid in tids:
+            cpuset = read_file('%s/%s/cpuset' % (task_dir, tid))
+            res = cpuset_re.match(cpuset) if cpuset else None
+            if res:
+                threads[int(tid)] = [res.group(1), uuid, res.group(2)]
+    return threads
+
+
+class TaskNameResolver(object):
+    '''Resolve the final task name of a tid from a snapshot of the qemu threads and the task events.
+    '''
+    def __init__(self, threads=None, convert_name=None):
+        '''
+        threads: snapshot of the qemu threads (default is to take a snapshot on first use)
+        convert_name: optional plugin function to convert the libvirt instance name
+        '''
+        self.threads = threads
+        self.convert_name = convert_name
+        # optional plugin function that returns the converted name of an instance uuid
+        # (None if unknown) without side effect, set with convert_name
+        self.get_instance_name = None
+        # threads changed by the task events: [libvirt_name, uuid, None] for a qemu thread
+        # created during the capture, None for a non qemu thread, indexed by tid
+        self.forked = {}
+        # a dict of task names indexed by tid
+        self.name_by_tid = {}
+        # a dict of task names indexed by raw task name for the qemu threads created
+        # during the capture (the thread type depends on the task name), indexed by tid
+        self.names_by_comm = {}
+        # final name of all the qemu threads resolved so far indexed by tid
+        self.qemu_names = {}
+
+    def update(self, threads):
+        # add the threads of another snapshot (the latest snapshot wins)
+        if self.threads is None:
+            self.threads = {}
+        self.threads.update(threads)
+        self.name_by_tid = {}
+        self.names_by_comm = {}
+
+    def get_thread(self, tid):
+        # returns [libvirt_name, uuid, thread_type] of a qemu thread or None
+        try:
+            return self.forked[tid]
+        except KeyError:
+            pass
+        if self.threads is None:
+            self.threads = snapshot_threads()
+        return self.threads.get(tid)
+
+    def forget(self, tid):
+        self.name_by_tid.pop(tid, None)
+        self.names_by_comm.pop(tid, None)
+
+    def add_fork(self, parent_tid, child_tid):
+        thread = self.get_thread(parent_tid)
+        self.forked[child_tid] = [thread[0], thread[1], None] if thread else None
+        self.forget(child_tid)
+
+    def add_exec(self, tid, filename):
+        if is_qemu_binary(filename):
+            # the instance is only known from the snapshot
+            self.forked.pop(tid, None)
+        else:
+            self.forked[tid] = None
+        self.forget(tid)
+
+    def add_task_events(self, task_events):
+        '''Apply a list of task events in time order.
+
+        task_events: list of (TASK_FORK, parent_tid, child_tid) or (TASK_EXEC, tid, filename)
+        '''
+        for kind, tid, value in task_events:
+            if kind == TASK_FORK:
+                self.add_fork(tid, value)
+            else:
+                self.add_exec(tid, value)
+
+    def get_task_name(self, tid, name):
+        if not tid:
+            return name
+        try:
+            return self.name_by_tid[tid]
+        except KeyError:
+            pass
+        try:
+            return self.names_by_comm[tid][name]
+        except KeyError:
+            pass
+        thread = self.get_thread(tid)
+        if not thread:
+            self.name_by_tid[tid] = name
+            return name
+        libvirt_name, uuid, thread_type = thread
+        comm = name
+        if thread_type is None:
+            thread_type = get_thread_type(name)
+        if self.convert_name:
+            name = self.convert_name(name, tid, libvirt_name, uuid, thread_type)
+        # append the thread type to the name
+        name += '.' + thread_type
+        if thread[2] is None:
+            self.names_by_comm.setdefault(tid, {})[comm] = name
+        else:
+            self.name_by_tid[tid] = name
+        self.qemu_names[tid] = name
+        return name
+
+    def get_name_table(self):
+        # returns the final name of all the qemu threads resolved so far indexed by tid
+        return dict(self.qemu_names)
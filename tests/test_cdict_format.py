@@ -0,0 +1,232 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+# Round trips of the cdict file formats (cdict_format.py writer, cdict_reader.py reader)
+
+import marshal
+import os
+import zlib
+
+from msgpack import packb
+import numpy as np
+import pandas
+import pytest
+
+import cdict_format
+from cdict_format import CdictWriter
+from cdict_format import COLUMNS
+from cdict_format import ENC_DELTA64
+from cdict_format import ENC_DICT
+from cdict_format import ENC_INT32
+from cdict_format import ENC_INT64
+from cdict_format import ENC_OBJECT
+from cdict_format import ENC_SHUFFLE32
+from cdict_format import ENC_SHUFFLE64
+from cdict_format import ENC_SHUFFLE_DICT
+from cdict_format import read_chunks
+from cdict_format import update_trailer
+from cdict_format import write_cdict
+from cdict_reader import load_cdict
+from cdict_reader import load_lost_events
+from cdict_reader import load_task_names
+
+# one column per encoding, nsecs is the time column
+ALL_COLUMNS = [('nsecs', ENC_DELTA64),
+               ('int32', ENC_INT32),
+               ('int64', ENC_INT64),
+               ('obj', ENC_OBJECT),
+               ('dict', ENC_DICT),
+               ('shuffle32', ENC_SHUFFLE32),
+               ('shuffle64', ENC_SHUFFLE64),
+               ('shuffle_dict', ENC_SHUFFLE_DICT)]
+
+def make_columns(rows):
+    nsecs = [1449000000000000000 + index * 1234567 - (index % 3) * 1000 for index in range(rows)]
+    return {'nsecs': nsecs,
+            'int32': [(index * 7919) % 65536 - 32768 for index in range(rows)],
+            'int64': [-(1 << 40) + index * 3 for index in range(rows)],
+            'obj': [[index, 'x%d' % index] for index in range(rows)],
+            'dict': [None if index % 5 == 0 else 'name%d' % (index % 4) for index in range(rows)],
+            'shuffle32': [index - 10 for index in range(rows)],
+            'shuffle64': [(index << 33) - 5 for index in range(rows)],
+            # strings and ints share the string table (kvm exit reason codes)
+            'shuffle_dict': [None if index % 7 == 3 else (index % 3 if index % 2 else 'task%d' % (index % 3))
+                             for index in range(rows)]}
+
+def write_file(filename, col_dict, chunk_rows):
+    writer = CdictWriter(filename, columns=ALL_COLUMNS, chunk_rows=chunk_rows)
+    writer.write_columns(col_dict)
+    return writer.close()
+
+def as_list(values):
+    # missing values are NaN in a pandas categorical
+    values = values.astype(object) if hasattr(values, 'categories') else values
+    return [None if value != value else value for value in list(values)]
+
+def check_columns(perf_dict, col_dict):
+    assert sorted(perf_dict) == sorted(col_dict)
+    for name, values in col_dict.items():
+        assert as_list(perf_dict[name]) == values, name
+
+def check_chunks(filename, col_dict):
+    # the standard library chunk reader returns the same values
+    res = dict((name, []) for name in col_dict)
+    for chunk in read_chunks(filename):
+        for name, values in chunk.items():
+            res[name].extend(values)
+    assert res == col_dict
+
+@pytest.mark.parametrize('rows, chunk_rows', [(0, 4), (1, 4), (1, 1), (5, 1), (10, 4), (12, 4), (1000, 256)])
+def test_round_trip(tmpdir, rows, chunk_rows):
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(rows)
+    size = write_file(filename, col_dict, chunk_rows)
+    assert size == os.path.getsize(filename)
+    check_columns(load_cdict(filename), col_dict)
+    check_chunks(filename, col_dict)
+
+@pytest.mark.parametrize('rows, chunk_rows', [(0, 4), (1, 1), (10, 4)])
+def test_round_trip_without_numpy(tmpdir, monkeypatch, rows, chunk_rows):
+    # the perf interpreter writes cdict files with the standard library only
+    monkeypatch.setattr(cdict_format, 'np', None)
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(rows)
+    write_file(filename, col_dict, chunk_rows)
+    check_chunks(filename, col_dict)
+    monkeypatch.undo()
+    check_columns(load_cdict(filename), col_dict)
+
+def test_column_selection(tmpdir):
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(20)
+    write_file(filename, col_dict, 6)
+    perf_dict = load_cdict(filename, columns=['shuffle64', 'dict'])
+    check_columns(perf_dict, dict((name, col_dict[name]) for name in ['shuffle64', 'dict']))
+
+@pytest.mark.parametrize('from_index, to_index', [(0, 0), (3, 8), (4, 4), (5, 19), (8, 12), (19, 0), (7, 7)])
+def test_time_window(tmpdir, from_index, to_index):
+    # chunks of 4 rows: the windows start and end inside and on the boundaries of chunks
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(20)
+    write_file(filename, col_dict, 4)
+    from_nsecs = col_dict['nsecs'][from_index]
+    to_nsecs = col_dict['nsecs'][to_index] if to_index else 0
+    perf_dict = load_cdict(filename, from_nsecs=from_nsecs, to_nsecs=to_nsecs)
+    rows = [index for index, nsecs in enumerate(col_dict['nsecs'])
+            if nsecs >= from_nsecs and (not to_nsecs or nsecs <= to_nsecs)]
+    check_columns(perf_dict, dict((name, [values[index] for index in rows]) for name, values in col_dict.items()))
+
+def test_time_window_outside(tmpdir):
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(20)
+    write_file(filename, col_dict, 4)
+    perf_dict = load_cdict(filename, from_nsecs=col_dict['nsecs'][-1] + 1)
+    check_columns(perf_dict, dict((name, []) for name in col_dict))
+
+def test_categorical(tmpdir):
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(30)
+    write_file(filename, col_dict, 8)
+    perf_dict = load_cdict(filename)
+    for name in ['dict', 'shuffle_dict']:
+        values = perf_dict[name]
+        assert isinstance(values, pandas.Categorical)
+        # only the strings used in the column are categories
+        assert sorted(values.categories, key=str) == sorted(set(col_dict[name]) - set([None]), key=str)
+        assert list(values.isna()) == [value is None for value in col_dict[name]]
+
+def test_write_categorical(tmpdir):
+    # the analyzer writes pandas categoricals (for example when remapping task names)
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = make_columns(25)
+    write_file(filename, col_dict, 10)
+    perf_dict = load_cdict(filename)
+    filename2 = str(tmpdir.join('test2.cdict'))
+    write_file(filename2, perf_dict, 7)
+    check_columns(load_cdict(filename2), col_dict)
+
+def test_trailer_fields(tmpdir):
+    filename = str(tmpdir.join('test.cdict'))
+    col_dict = dict((name, [0, 1, 2]) for name, _ in COLUMNS)
+    col_dict['event'] = ['sched__sched_switch', 'kvm_entry', 'kvm_exit']
+    write_cdict(filename, col_dict, task_names={1001: 'vm1.vcpu0'})
+    assert load_task_names(filename) == {1001: 'vm1.vcpu0'}
+    assert load_lost_events(filename) == []
+    update_trailer(filename, lost=[[2, 10, 20, 5]], epoch=1000)
+    assert load_lost_events(filename) == [[2, 10, 20, 5]]
+    assert load_task_names(filename) == {1001: 'vm1.vcpu0'}
+    check_columns(load_cdict(filename), col_dict)
+
+def make_legacy_columns():
+    return {'event': ['sched__sched_switch', 'kvm_exit', 'kvm_entry'],
+            'cpu': [0, 1, 1],
+            'usecs': [0, 1500, 1700],
+            'pid': [1, 2, 2],
+            'task_name': ['a', 'b', 'b'],
+            'duration': [10, 0, 200],
+            'next_pid': [2, 0, 0],
+            'next_comm': ['b', 'HLT', None]}
+
+def check_legacy(perf_dict, col_dict):
+    assert 'usecs' not in perf_dict
+    assert list(perf_dict['nsecs']) == [usecs * 1000 for usecs in col_dict['usecs']]
+    assert list(perf_dict['duration']) == [duration * 1000 for duration in col_dict['duration']]
+    assert list(perf_dict['pid']) == col_dict['pid']
+    assert list(perf_dict['task_name']) == col_dict['task_name']
+
+@pytest.mark.parametrize('serializer', [packb, marshal.dumps])
+def test_legacy_formats(tmpdir, serializer):
+    filename = str(tmpdir.join('legacy.cdict'))
+    col_dict = make_legacy_columns()
+    with open(filename, 'wb') as ff:
+        ff.write(zlib.compress(serializer(col_dict)))
+    check_legacy(load_cdict(filename), col_dict)
+    perf_dict = load_cdict(filename, columns=['nsecs', 'duration', 'pid', 'task_name'],
+                           from_nsecs=1000000, to_nsecs=1600000)
+    assert sorted(perf_dict) == ['duration', 'nsecs', 'pid', 'task_name']
+    assert list(perf_dict['nsecs']) == [1500000]
+    assert list(perf_dict['duration']) == [0]
+    assert list(perf_dict['pid']) == [2]
+
+def test_legacy_v2(tmpdir):
+    # version 2 files written before the switch to nanoseconds have a usecs column
+    filename = str(tmpdir.join('legacy.cdict'))
+    col_dict = make_legacy_columns()
+    columns = [('usecs', ENC_INT64) if name == 'nsecs' else (name, encoding) for name, encoding in COLUMNS]
+    columns = [(name, ENC_INT64 if name == 'duration' else encoding) for name, encoding in columns]
+    writer = CdictWriter(filename, columns=columns, chunk_rows=2)
+    writer.write_columns(col_dict)
+    writer.close()
+    update_trailer(filename, lost=[[1, 1000, 2000, 3]])
+    check_legacy(load_cdict(filename), col_dict)
+    assert load_lost_events(filename) == [[1, 1000000, 2000000, 3]]
+    perf_dict = load_cdict(filename, columns=['nsecs'], from_nsecs=1600000)
+    assert list(perf_dict['nsecs']) == [1700000]
+    chunks = list(read_chunks(filename, ['nsecs', 'duration']))
+    assert [list(chunk['nsecs']) for chunk in chunks] == [[0, 1500000], [1700000]]
+    assert [list(chunk['duration']) for chunk in chunks] == [[10000, 0], [200000]]
+
+@pytest.mark.parametrize('cut', [1, 8, 16, 100])
+def test_truncated(tmpdir, cut):
+    filename = str(tmpdir.join('test.cdict'))
+    write_file(filename, make_columns(100), 16)
+    with open(filename, 'r+b') as ff:
+        ff.truncate(os.path.getsize(filename) - cut)
+    with pytest.raises(ValueError):
+        load_cdict(filename)
+    with pytest.raises(ValueError):
+        list(read_chunks(filename))
+    with pytest.raises(ValueError):
+        load_lost_events(filename)
@@ -0,0 +1,382 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+# The perf script text decoder (perf_text.py) and the perf.data decoder (perf_data.py)
+# must store the same rows as the perf script handlers (mkcdict_perf_script.py).
+# A small synthetic trace is fed to the handlers and written as a perf.data file and
+# as a perf script text file.
+
+import json
+import random
+import struct
+
+import pytest
+
+from capture_info import INFO_ENV
+from capture_info import get_info_resolver
+from capture_info import load_capture_info
+from cdict_format import read_chunks
+from cdict_format import read_trailer
+import mkcdict_perf_script
+from perf_data import add_lost_events
+from perf_data import convert_perf_data
+from perf_text import decode_perf_text
+
+# qemu threads of the capture information: tid 1001 is a vcpu, 1002 the emulator thread
+INFO = {'threads': {'1001': ['instance-00000001', 'uuid-1', 'vcpu0'],
+                    '1002': ['instance-00000001', 'uuid-1', 'emulator']},
+        'instance_names': {'uuid-1': 'vm1'},
+        'topology': {'cpus': {}, 'nodes': {}}}
+TASKS = [(0, 'swapper/%d'), (1001, 'qemu-kvm'), (1002, 'qemu-kvm'), (2001, 'bash'), (2002, 'python')]
+# tids that only appear after the task events
+LATE_TASKS = [(1003, 'CPU 1/KVM'), (2003, 'bash'), (3001, 'qemu-kvm')]
+# kernel names printed by perf script (70 is unknown and printed as a number)
+EXIT_REASONS = {1: 'EXTERNAL_INTERRUPT', 12: 'HLT', 30: 'IO_INSTRUCTION', 48: 'EPT_VIOLATION', 70: '70'}
+KINDS = ['sched_switch', 'sched_switch', 'sched_stat_runtime', 'sched_stat_runtime', 'sched_stat_sleep',
+         'sched_stat_iowait', 'sched_wakeup', 'kvm_entry', 'kvm_exit', 'kvm_exit']
+CPUS = 4
+
+def make_trace(count, seed=0):
+    '''Returns a synthetic time sorted trace as a list of (nsecs, cpu, kind, common_pid, fields).
+    '''
+    rng = random.Random(seed)
+    tasks = list(TASKS)
+    kvm_tids = [1001]
+    nsecs = 5000000000123
+    events = []
+    for index in range(count):
+        nsecs += rng.randint(100, 5000)
+        if index == count // 4:
+            # new vcpu and other threads, exec of a qemu process
+            for parent, child in [(1001, 1003), (2001, 2003)]:
+                nsecs += 10
+                events.append((nsecs, 0, 'sched_process_fork', parent, {'parent_pid': parent, 'child_pid': child}))
+            nsecs += 10
+            events.append((nsecs, 1, 'sched_process_exec', 3001,
+                           {'filename': '/usr/bin/qemu-system-x86_64', 'pid': 3001}))
+            tasks.extend(LATE_TASKS)
+            kvm_tids.extend([1003, 3001])
+        if index == count // 2:
+            # the vcpu tid 1001 is reused by another process
+            nsecs += 10
+            events.append((nsecs, 2, 'sched_process_exec', 1001, {'filename': '/bin/bash', 'pid': 1001}))
+        cpu = rng.randint(0, CPUS - 1)
+        kind = rng.choice(KINDS)
+        if kind.startswith('kvm'):
+            events.append((nsecs, cpu, kind, rng.choice(kvm_tids), {'exit_reason': rng.choice(sorted(EXIT_REASONS))}))
+            continue
+        tid, comm = rng.choice(tasks)
+        next_tid, next_comm = rng.choice(tasks)
+        events.append((nsecs, cpu, kind, tid,
+                       {'comm': comm.replace('%d', str(cpu)), 'pid': tid, 'runtime': rng.randint(1, 100000),
+                        'delay': rng.randint(1, 10 ** 7),
+                        'next_comm': next_comm.replace('%d', str(cpu)), 'next_pid': next_tid}))
+    return events
+
+def get_comm(tid, cpu):
+    for task_tid, comm in TASKS + LATE_TASKS:
+        if task_tid == tid:
+            return comm.replace('%d', str(cpu))
+
+def feed_handlers(handlers, events):
+    for nsecs, cpu, kind, pid, fields in events:
+        secs, nsecs = divmod(nsecs, 1000000000)
+        common = (cpu, secs, nsecs, pid, get_comm(pid, cpu))
+        if kind == 'sched_switch':
+            handlers.sched__sched_switch('sched__sched_switch', None, *common + (
+                fields['comm'], fields['pid'], 120, 1, fields['next_comm'], fields['next_pid'], 120))
+        elif kind == 'sched_stat_runtime':
+            handlers.sched__sched_stat_runtime('sched__sched_stat_runtime', None, *common + (
+                fields['comm'], fields['pid'], fields['runtime'], 0))
+        elif kind in ('sched_stat_sleep', 'sched_stat_iowait'):
+            getattr(handlers, 'sched__' + kind)('sched__' + kind, None, *common + (
+                fields['comm'], fields['pid'], fields['delay']))
+        elif kind == 'sched_wakeup':
+            handlers.sched__sched_wakeup('sched__sched_wakeup', None, *common + (
+                fields['comm'], fields['pid'], 120, 1, 0))
+        elif kind == 'sched_process_fork':
+            comm = get_comm(pid, cpu)
+            handlers.sched__sched_process_fork('sched__sched_process_fork', None, *common + (
+                comm, fields['parent_pid'], comm, fields['child_pid']))
+        elif kind == 'sched_process_exec':
+            handlers.sched__sched_process_exec('sched__sched_process_exec', None, *common + (
+                fields['filename'], fields['pid'], fields['pid']))
+        elif kind == 'kvm_entry':
+            handlers.kvm__kvm_entry('kvm__kvm_entry', None, *common + (0,))
+        else:
+            handlers.kvm__kvm_exit('kvm__kvm_exit', None, *common + (fields['exit_reason'], 0, 0, 0, 0))
+
+def write_perf_text(filename, events):
+    # perf script --ns output
+    with open(filename, 'w') as ff:
+        ff.write('# ========\n# captured on: Tue Dec  1 20:00:00 2015\n# ========\n#\n')
+        for nsecs, cpu, kind, pid, fields in events:
+            if kind == 'sched_switch':
+                args = 'prev_comm=%s prev_pid=%d prev_prio=120 prev_state=S ==> next_comm=%s next_pid=%d ' \
+                       'next_prio=120' % (fields['comm'], fields['pid'], fields['next_comm'], fields['next_pid'])
+            elif kind == 'sched_stat_runtime':
+                args = 'comm=%s pid=%d runtime=%d [ns] vruntime=0 [ns]' % \
+                       (fields['comm'], fields['pid'], fields['runtime'])
+            elif kind in ('sched_stat_sleep', 'sched_stat_iowait'):
+                args = 'comm=%s pid=%d delay=%d [ns]' % (fields['comm'], fields['pid'], fields['delay'])
+            elif kind == 'sched_wakeup':
+                args = 'comm=%s pid=%d prio=120 target_cpu=000' % (fields['comm'], fields['pid'])
+            elif kind == 'sched_process_fork':
+                comm = get_comm(pid, cpu)
+                args = 'comm=%s pid=%d child_comm=%s child_pid=%d' % \
+                       (comm, fields['parent_pid'], comm, fields['child_pid'])
+            elif kind == 'sched_process_exec':
+                args = 'filename=%s pid=%d old_pid=%d' % (fields['filename'], fields['pid'], fields['pid'])
+            elif kind == 'kvm_entry':
+                args = 'vcpu 0'
+            else:
+                args = 'reason %s rip 0xffffffff810271ee info 0 0' % (EXIT_REASONS[fields['exit_reason']])
+            ff.write('%16s %5d [%03d] %d.%09d: %s:%s: %s\n' %
+                     (get_comm(pid, cpu), pid, cpu, nsecs // 1000000000, nsecs % 1000000000,
+                      'kvm' if kind.startswith('kvm') else 'sched', kind, args))
+
+# perf.data file
+
+COMMON_FIELDS = '''\tfield:unsigned short common_type;\toffset:0;\tsize:2;\tsigned:0;
+\tfield:unsigned char common_flags;\toffset:2;\tsize:1;\tsigned:0;
+\tfield:unsigned char common_preempt_count;\toffset:3;\tsize:1;\tsigned:0;
+\tfield:int common_pid;\toffset:4;\tsize:4;\tsigned:1;
+'''
+COMM_FIELD = '\tfield:char %s[16];\toffset:%d;\tsize:16;\tsigned:1;\n'
+PID_FIELD = '\tfield:pid_t %s;\toffset:%d;\tsize:4;\tsigned:1;\n'
+INT_FIELD = '\tfield:%s %s;\toffset:%d;\tsize:%d;\tsigned:%d;\n'
+# tracepoint id, fields and raw size of each tracepoint
+TRACEPOINTS = {
+    'sched_switch': (316, COMM_FIELD % ('prev_comm', 8) + PID_FIELD % ('prev_pid', 24) +
+                     INT_FIELD % ('int', 'prev_prio', 28, 4, 1) + INT_FIELD % ('long', 'prev_state', 32, 8, 1) +
+                     COMM_FIELD % ('next_comm', 40) + PID_FIELD % ('next_pid', 56) +
+                     INT_FIELD % ('int', 'next_prio', 60, 4, 1), 64),
+    'sched_stat_runtime': (311, COMM_FIELD % ('comm', 8) + PID_FIELD % ('pid', 24) +
+                           INT_FIELD % ('u64', 'runtime', 32, 8, 0) + INT_FIELD % ('u64', 'vruntime', 40, 8, 0), 48),
+    'sched_stat_sleep': (313, COMM_FIELD % ('comm', 8) + PID_FIELD % ('pid', 24) +
+                         INT_FIELD % ('u64', 'delay', 32, 8, 0), 40),
+    'sched_stat_iowait': (314, COMM_FIELD % ('comm', 8) + PID_FIELD % ('pid', 24) +
+                          INT_FIELD % ('u64', 'delay', 32, 8, 0), 40),
+    'sched_wakeup': (320, COMM_FIELD % ('comm', 8) + PID_FIELD % ('pid', 24) +
+                     INT_FIELD % ('int', 'prio', 28, 4, 1) + INT_FIELD % ('int', 'success', 32, 4, 1) +
+                     INT_FIELD % ('int', 'target_cpu', 36, 4, 1), 40),
+    'sched_process_fork': (330, COMM_FIELD % ('parent_comm', 8) + PID_FIELD % ('parent_pid', 24) +
+                           COMM_FIELD % ('child_comm', 28) + PID_FIELD % ('child_pid', 44), 48),
+    'sched_process_exec': (331, '\tfield:__data_loc char[] filename;\toffset:8;\tsize:4;\tsigned:1;\n' +
+                           PID_FIELD % ('pid', 12) + PID_FIELD % ('old_pid', 16), 20),
+    'kvm_entry': (900, INT_FIELD % ('unsigned int', 'vcpu_id', 8, 4, 0), 16),
+    'kvm_exit': (901, INT_FIELD % ('unsigned int', 'exit_reason', 8, 4, 0) +
+                 INT_FIELD % ('unsigned long', 'guest_rip', 16, 8, 0) + INT_FIELD % ('u32', 'isa', 24, 4, 0) +
+                 INT_FIELD % ('u64', 'info1', 32, 8, 0) + INT_FIELD % ('u64', 'info2', 40, 8, 0), 48)}
+
+# perf_event_attr.sample_type: IP, TID, TIME, CPU, PERIOD, RAW, IDENTIFIER
+SAMPLE_TYPE = 1 | 2 | 4 | 128 | 256 | 1024 | (1 << 16)
+# perf_event_attr.sample_id_all (the lost records have the time and cpu)
+SAMPLE_ID_ALL = 1 << 18
+ATTR_SIZE = 112
+PERF_RECORD_COMM = 3
+PERF_RECORD_LOST = 2
+PERF_RECORD_SAMPLE = 9
+PERF_RECORD_FINISHED_ROUND = 68
+HEADER_TRACING_DATA = 1 << 1
+
+def pad8(data):
+    return data + '\0' * (-len(data) % 8)
+
+def comm16(comm):
+    # perf copies the comm with garbage after the nul
+    return (comm + '\0garbage' + '\0' * 16)[:16]
+
+def get_raw(kind, pid, fields):
+    tp_id, _, size = TRACEPOINTS[kind]
+    raw = bytearray(size)
+    struct.pack_into('<HBBi', raw, 0, tp_id, 0, 0, pid)
+    if kind == 'sched_switch':
+        raw[8:24] = comm16(fields['comm'])
+        struct.pack_into('<iiq', raw, 24, fields['pid'], 120, 1)
+        raw[40:56] = comm16(fields['next_comm'])
+        struct.pack_into('<ii', raw, 56, fields['next_pid'], 120)
+    elif kind in ('sched_stat_runtime', 'sched_stat_sleep', 'sched_stat_iowait', 'sched_wakeup'):
+        raw[8:24] = comm16(fields['comm'])
+        struct.pack_into('<i', raw, 24, fields['pid'])
+        if kind == 'sched_stat_runtime':
+            struct.pack_into('<QQ', raw, 32, fields['runtime'], 0)
+        elif kind != 'sched_wakeup':
+            struct.pack_into('<Q', raw, 32, fields['delay'])
+    elif kind == 'sched_process_fork':
+        comm = comm16(get_comm(pid, 0))
+        raw[8:24] = comm
+        raw[28:44] = comm
+        struct.pack_into('<ii', raw, 24, fields['parent_pid'], 0)
+        struct.pack_into('<i', raw, 44, fields['child_pid'])
+    elif kind == 'sched_process_exec':
+        filename = fields['filename'] + '\0'
+        struct.pack_into('<Iii', raw, 8, (len(filename) << 16) | size, fields['pid'], fields['pid'])
+        raw += filename
+    elif kind == 'kvm_exit':
+        struct.pack_into('<IQIQQ', raw, 8, fields['exit_reason'], 0xffffffff810271ee, 0, 0, 0)
+    return str(raw)
+
+def get_record(record_type, body):
+    return struct.pack('<IHH', record_type, 0, 8 + len(body)) + body
+
+def get_sample(event):
+    nsecs, cpu, kind, pid, fields = event
+    raw = get_raw(kind, pid, fields)
+    # the raw size (u32) and raw data are padded to 8 bytes
+    raw += '\0' * (-(len(raw) + 4) % 8)
+    return get_record(PERF_RECORD_SAMPLE, struct.pack('<QQiiQIIQI', TRACEPOINTS[kind][0], 0xffffffff81000000,
+                                                      pid, pid, nsecs, cpu, 0, 1, len(raw)) + raw)
+
+def get_tracing_data():
+    data = '\027\010\104tracing0.6\0' + struct.pack('<BBI', 0, 8, 4096)
+    data += 'header_page\0' + struct.pack('<Q', 0) + 'header_event\0' + struct.pack('<Q', 0)
+    # no ftrace formats, then the event formats of each system
+    data += struct.pack('<I', 0)
+    systems = {}
+    for kind in TRACEPOINTS:
+        systems.setdefault('kvm' if kind.startswith('kvm') else 'sched', []).append(kind)
+    data += struct.pack('<I', len(systems))
+    for system, kinds in sorted(systems.items()):
+        data += system + '\0' + struct.pack('<I', len(kinds))
+        for kind in sorted(kinds):
+            tp_id, fields, _ = TRACEPOINTS[kind]
+            text = 'name: %s\nID: %d\nformat:\n%s%s\nprint fmt: "..."\n' % (kind, tp_id, COMMON_FIELDS, fields)
+            data += struct.pack('<Q', len(text)) + text
+    # no kallsyms, printk formats and saved cmdlines
+    return data + struct.pack('<IIQ', 0, 0, 0)
+
+def write_perf_data(filename, events, lost=()):
+    '''Write the events into a perf.data file.
+
+    lost: list of (event index, cpu, count) lost records written after an event (at its time)
+    The samples are grouped by cpu in rounds of 100 like perf record (not in time order).
+    '''
+    lost = dict((index, (cpu, count)) for index, cpu, count in lost)
+    data = ''.join(get_record(PERF_RECORD_COMM, struct.pack('<II', tid, tid) + pad8(comm + '\0'))
+                   for tid, comm in TASKS + LATE_TASKS if tid)
+    for start in range(0, len(events), 100):
+        data += ''.join(get_sample(event) for event in sorted(events[start:start + 100], key=lambda event: event[1]))
+        for index in range(start, min(start + 100, len(events))):
+            if index in lost:
+                cpu, count = lost[index]
+                # id, lost, then the sample id: tid, time, cpu, identifier
+                data += get_record(PERF_RECORD_LOST, struct.pack('<QQQQIIQ', 1, count, 0, events[index][0], cpu, 0, 0))
+        data += get_record(PERF_RECORD_FINISHED_ROUND, '')
+    attrs = ''
+    for tp_id, _, _ in sorted(TRACEPOINTS.values()):
+        attr = bytearray(ATTR_SIZE)
+        struct.pack_into('<IIQQQQ', attr, 0, 2, ATTR_SIZE, tp_id, 1, SAMPLE_TYPE, 0)
+        struct.pack_into('<Q', attr, 40, SAMPLE_ID_ALL)
+        # no id section
+        attrs += str(attr) + struct.pack('<QQ', 0, 0)
+    tracing_data = get_tracing_data()
+    header_size = 104
+    data_offset = header_size + len(attrs)
+    tracing_offset = data_offset + len(data) + 16
+    with open(filename, 'wb') as ff:
+        ff.write('PERFILE2' + struct.pack('<QQQQQQQQ', header_size, ATTR_SIZE + 16, header_size, len(attrs),
+                                          data_offset, len(data), 0, 0))
+        ff.write(struct.pack('<4Q', HEADER_TRACING_DATA, 0, 0, 0))
+        ff.write(attrs + data)
+        ff.write(struct.pack('<QQ', tracing_offset, len(tracing_data)) + tracing_data)
+
+def get_resolver(info_filename):
+    return get_info_resolver(load_capture_info(info_filename))
+
+def read_cdict(filename):
+    # all the rows and the trailer fields of a cdict file
+    columns = {}
+    for chunk in read_chunks(filename):
+        for name, values in chunk.items():
+            columns.setdefault(name, []).extend(values)
+    with open(filename, 'rb') as ff:
+        trailer = read_trailer(ff)[0]
+    return columns, dict((name, trailer.get(name)) for name in ['epoch', 'lost', 'task_names'])
+
+def convert_with_handlers(events, perf_data_filename):
+    # same as perf script -s mkcdict_perf_script.py followed by the lost event check of perfcap
+    handlers = reload(mkcdict_perf_script)
+    handlers.trace_begin()
+    feed_handlers(handlers, events)
+    handlers.trace_end()
+    add_lost_events(perf_data_filename, 'perf.cdict')
+    return read_cdict('perf.cdict')
+
+@pytest.fixture
+def trace(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    with open('perf.data.info', 'w') as ff:
+        json.dump(INFO, ff)
+    monkeypatch.setenv(INFO_ENV, str(tmpdir.join('perf.data.info')))
+    events = make_trace(3000)
+    write_perf_text('perf.txt', events)
+    return events
+
+def check_same(res, ref):
+    columns, trailer = res
+    ref_columns, ref_trailer = ref
+    assert trailer == ref_trailer
+    assert sorted(columns) == sorted(ref_columns)
+    for name in ref_columns:
+        # strict comparison (the kvm exit reasons are ints)
+        assert [(value, type(value)) for value in columns[name]] == \
+               [(value, type(value)) for value in ref_columns[name]], name
+
+@pytest.mark.parametrize('range_size, processes', [(1 << 20, 1), (4096, 2), (700, 3)])
+def test_text_same_as_handlers(trace, range_size, processes):
+    # small ranges start with sched_switch and kvm rows paired with the previous ranges
+    lost = [(1000, 2, 17), (2000, 0, 5)]
+    write_perf_data('perf.data', trace, lost)
+    ref = convert_with_handlers(trace, 'perf.data')
+    assert len(ref[1]['lost']) == 2
+    decode_perf_text('perf.txt', 'text.cdict', get_resolver('perf.data.info'), processes, range_size)
+    add_lost_events('perf.data', 'text.cdict')
+    check_same(read_cdict('text.cdict'), ref)
+
+def test_native_same_as_handlers(trace):
+    write_perf_data('perf.data', trace)
+    ref = convert_with_handlers(trace, 'perf.data')
+    convert_perf_data('perf.data', 'native.cdict', get_resolver('perf.data.info'))
+    check_same(read_cdict('native.cdict'), ref)
+
+def test_native_lost_events(trace):
+    # the native decoder zeroes the runtime of the switches and drops the kvm rows which
+    # previous event is before a lost event on the same cpu (unreliable durations)
+    lost = [(1000, 2, 17), (2000, 0, 5)]
+    write_perf_data('perf.data', trace, lost)
+    ref_columns, ref_trailer = convert_with_handlers(trace, 'perf.data')
+    convert_perf_data('perf.data', 'native.cdict', get_resolver('perf.data.info'))
+    columns, trailer = read_cdict('native.cdict')
+    assert trailer == ref_trailer
+    lost_ranges = [(from_nsecs, to_nsecs) for _, from_nsecs, to_nsecs, _ in trailer['lost']]
+
+    def spans_lost(row, values):
+        end = values['nsecs'][row]
+        start = end - values['duration'][row]
+        return any(start < to_nsecs <= end for _, to_nsecs in lost_ranges)
+    ref_rows = zip(*[ref_columns[name] for name in sorted(ref_columns)])
+    rows = zip(*[columns[name] for name in sorted(columns)])
+    kept = [row for row in range(len(ref_rows))
+            if ref_columns['event'][row] not in ('kvm_entry', 'kvm_exit') or not spans_lost(row, ref_columns)]
+    assert len(kept) < len(ref_rows)
+    assert len(rows) == len(kept)
+    duration_index = sorted(ref_columns).index('duration')
+    for row, ref_row in zip(rows, [ref_rows[index] for index in kept]):
+        if row != ref_row:
+            # switch which runtime spans a lost event
+            assert row[duration_index] == 0
+            assert row[:duration_index] + row[duration_index + 1:] == \
+                ref_row[:duration_index] + ref_row[duration_index + 1:]
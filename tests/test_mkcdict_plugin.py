@@ -0,0 +1,104 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+# Service chain name cache of the mkcdict plugin, against a stand-in nova client
+
+import json
+import pytest
+import time
+
+import mkcdict_plugin
+
+AUTH_URL = 'http://controller:5000/v2.0'
+
+def instance_name(nvf, chain_id):
+    return 'ESC_Day0-3__62940__MT__MTPerftest_FULL_%02dESC_Day0-31.1__0__%s__0' % (chain_id, nvf)
+
+class Server(object):
+    def __init__(self, uuid, name, status='ACTIVE'):
+        self.id = uuid
+        self.name = name
+        self.status = status
+
+class Servers(object):
+    def __init__(self, servers):
+        self.servers = servers
+        self.calls = []
+
+    def list(self, detailed=True, search_opts=None):
+        self.calls.append(search_opts)
+        return self.servers
+
+class NovaClient(object):
+    def __init__(self, servers):
+        self.servers = Servers(servers)
+
+class Options(object):
+    nova_cache_ttl = None
+
+def write_cache(names, saved):
+    with open(mkcdict_plugin.CACHE_FILE, 'w') as ff:
+        json.dump({'auth_url': AUTH_URL,
+                   'saved': saved,
+                   'changes_since': '2015-12-01T20:00:00Z',
+                   'names': names}, ff)
+
+def read_cache():
+    with open(mkcdict_plugin.CACHE_FILE, 'r') as ff:
+        return json.load(ff)
+
+def init_plugin(tmpdir, monkeypatch, servers):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(mkcdict_plugin, 'by_uuid', {})
+    nova_client = NovaClient(servers)
+    assert mkcdict_plugin.plugin_init(Options(), nova_client=nova_client, auth_url=AUTH_URL)
+    return nova_client
+
+def test_full_list(tmpdir, monkeypatch):
+    nova_client = init_plugin(tmpdir, monkeypatch, [Server('u1', instance_name('CSR', 1)),
+                                                    Server('u2', instance_name('ASA', 2)),
+                                                    Server('u3', 'not-a-chain')])
+    assert nova_client.servers.calls == [{'all_tenants': 1}]
+    assert mkcdict_plugin.by_uuid == {'u1': 'CSR.01', 'u2': 'ASA.02'}
+    cache = read_cache()
+    assert cache['auth_url'] == AUTH_URL
+    assert cache['names'] == {'u1': 'CSR.01', 'u2': 'ASA.02'}
+
+def test_changes_since_refresh(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    write_cache({'u1': 'CSR.01', 'u2': 'ASA.02'}, time.time() - 2 * mkcdict_plugin.CACHE_TTL)
+    nova_client = init_plugin(tmpdir, monkeypatch, [Server('u2', instance_name('ASA', 2), 'DELETED'),
+                                                    Server('u3', instance_name('CSR', 3))])
+    assert nova_client.servers.calls == [{'all_tenants': 1, 'changes-since': '2015-12-01T20:00:00Z'}]
+    assert mkcdict_plugin.by_uuid == {'u1': 'CSR.01', 'u3': 'CSR.03'}
+    cache = read_cache()
+    assert cache['names'] == {'u1': 'CSR.01', 'u3': 'CSR.03'}
+    assert cache['changes_since'] != '2015-12-01T20:00:00Z'
+
+def test_cache_hit(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    write_cache({'u1': 'CSR.01'}, time.time())
+    nova_client = init_plugin(tmpdir, monkeypatch, [Server('u2', instance_name('ASA', 2))])
+    assert nova_client.servers.calls == []
+    assert mkcdict_plugin.by_uuid == {'u1': 'CSR.01'}
+
+def test_no_novaclient_no_credentials(tmpdir, monkeypatch):
+    # the callers skip the plugin on ImportError, the credentials must not be read first
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(mkcdict_plugin, 'Client', None)
+    for varname in ['OS_USERNAME', 'OS_AUTH_URL', 'OS_TENANT_NAME', 'OS_PASSWORD']:
+        monkeypatch.delenv(varname, raising=False)
+    with pytest.raises(ImportError):
+        mkcdict_plugin.plugin_init()